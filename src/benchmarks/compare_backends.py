@@ -0,0 +1,154 @@
+# Benchmark: transformer embeddings vs lexical embeddings (hashing + SVD)
+
+"""
+
+Compares the two embedding backends on the same rows:
+
+    - Speed: rows/s encoding the same sample of texts with each backend
+    - Cluster quality of each backend (clusters.parquet of clustering.py), on a sample:
+        silhouette (cosine, higher is better), Davies-Bouldin (lower is better),
+        NMI between the clusters and the source (category) of the review
+    - Agreement between the two clusterings (adjusted Rand index, NMI)
+
+Both backends must be embedded and clustered first (embedding.embed + lexical_embedding.embed_lexical
+and clustering.cluster for each model name).
+
+Output: data/benchmarks/compare_backends.json
+
+"""
+
+import json
+import time
+from pathlib import Path
+import numpy as np
+import pyarrow.parquet as pq
+from sklearn.metrics import silhouette_score, davies_bouldin_score, adjusted_rand_score, normalized_mutual_info_score
+
+from src.pipeline.embedding import default_model, open_embeddings, read_positions, model_dir_for, load_model, encode_texts, text_col
+from src.pipeline.lexical_embedding import lexical_model_name, load_encoder, encode
+from src.pipeline.clustering import output_dir_for
+from src.pipeline.dedup import spacy_files, iter_texts
+
+
+# Output of the benchmarks
+benchmarks_dir = Path("data/benchmarks")
+
+
+def sample_positions(total, sample_rows, seed):
+
+    """
+    Sorted random positions of the rows used for the metrics.
+
+    """
+    if sample_rows >= total:
+        return np.arange(total)
+    return np.sort(np.random.default_rng(seed).choice(total, size=sample_rows, replace=False))
+
+
+def read_clusters(model_name):
+
+    """
+    Cluster and source of every row (clusters.parquet, row order).
+
+    """
+    table = pq.read_table(output_dir_for(model_name) / "clusters.parquet", columns=["row_id", "source", "cluster"])
+    return table["cluster"].to_numpy(), table["source"].to_pylist()
+
+
+def quality(vectors, labels, sources):
+
+    """
+    Metrics of one clustering on the sample.
+
+    """
+    metrics = {"clusters": int(len(np.unique(labels)))}
+    if metrics["clusters"] > 1:
+        metrics["silhouette"] = float(silhouette_score(vectors, labels, metric="cosine"))
+        metrics["davies_bouldin"] = float(davies_bouldin_score(vectors, labels))
+    metrics["nmi_source"] = float(normalized_mutual_info_score(sources, labels))
+    return metrics
+
+
+def first_texts(n):
+
+    """
+    First n texts of the spacy output (same texts for the speed test of both backends).
+
+    """
+    texts = []
+    for _, batch in iter_texts(spacy_files(), 10000, columns=(text_col,)):
+        texts.extend(t or "" for t in batch[text_col].to_pylist())
+        if len(texts) >= n:
+            break
+    return texts[:n]
+
+
+def speed(model_name, lexical_name, n_texts):
+
+    """
+    Rows/s of each backend encoding the same texts.
+
+    """
+    texts = first_texts(n_texts)
+    result = {"texts": len(texts)}
+
+    model = load_model(model_name)
+    begin = time.time()
+    encode_texts(model, texts)
+    result["transformer_rows_s"] = len(texts) / max(time.time() - begin, 1e-9)
+
+    # The model is loaded before the time is measured
+    lexical_dir = model_dir_for(lexical_name)
+    load_encoder(lexical_dir)
+
+    begin = time.time()
+    encode(lexical_dir, texts)
+    result["lexical_rows_s"] = len(texts) / max(time.time() - begin, 1e-9)
+
+    result["speedup"] = result["lexical_rows_s"] / max(result["transformer_rows_s"], 1e-9)
+    return result
+
+
+def compare_backends(model_name=default_model, lexical_dim=256, sample_rows=20000, speed_texts=5000, seed=42):
+
+    """
+    Runs the comparison and saves the result in data/benchmarks/compare_backends.json
+
+    """
+    lexical_name = lexical_model_name(lexical_dim)
+
+    labels_a, sources = read_clusters(model_name)
+    labels_b, _ = read_clusters(lexical_name)
+    if len(labels_a) != len(labels_b):
+        print("The two clusterings don't have the same rows, embed and cluster both with the same input.")
+        return
+
+    positions = sample_positions(len(labels_a), sample_rows, seed)
+    sample_sources = [sources[i] for i in positions]
+
+    result = {
+        "transformer": {"model": model_name},
+        "lexical": {"model": lexical_name},
+    }
+    result["transformer"].update(quality(read_positions(open_embeddings(model_name), positions), labels_a[positions], sample_sources))
+    result["lexical"].update(quality(read_positions(open_embeddings(lexical_name), positions), labels_b[positions], sample_sources))
+
+    # Agreement on all the rows (only the labels, no vectors)
+    result["agreement"] = {
+        "ari": float(adjusted_rand_score(labels_a, labels_b)),
+        "nmi": float(normalized_mutual_info_score(labels_a, labels_b)),
+    }
+
+    if speed_texts > 0:
+        result["speed"] = speed(model_name, lexical_name, speed_texts)
+
+    benchmarks_dir.mkdir(parents=True, exist_ok=True)
+    with open(benchmarks_dir / "compare_backends.json", "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    compare_backends()
@@ -0,0 +1,206 @@
+# Import time budget of the src package
+
+"""
+
+Measures how long it takes to import every module of src in a new python process
+(python -X importtime, the cumulative time of the module with everything it imports)
+and compares it with a budget, so a heavy import at module level (a model, spacy,
+sklearn, pandas...) is found before it slows down every CLI call and every spawned worker.
+
+    - Every module is imported alone in a fresh process, the median of --runs is used
+    - default_budget_ms for all the modules, budgets_ms for the modules that need a heavy
+      library to do their work (the clustering and benchmark modules)
+    - Modules that can't be imported (optional dependency not installed) are reported, not failed
+    - It also measures the start of a pool of the pipeline (worker_init.make_pool) with the
+      models of the stages, the time until all the workers answer (each one in a new process,
+      with the default start method or --start-method spawn like Windows)
+
+Results are saved in data/benchmarks/import_times.json. Exit code 1 if a module is over its budget.
+
+Run: python -m src.benchmarks.import_budget (--runs 5 --budget-ms 400 --pool-workers 2 --start-method spawn)
+
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+from src.benchmarks.stage_benchmarks import benchmarks_dir
+
+
+# Package measured
+package_dir = Path(__file__).resolve().parents[1]
+
+# Budget of every module (ms)
+default_budget_ms = 400
+
+# Modules that import a heavy library at module level on purpose
+budgets_ms = {
+    "src.pipeline.density_clustering": 3000, # umap and hdbscan
+    "src.pipeline.lexical_embedding": 3000, # sklearn
+    "src.benchmarks.compare_backends": 3000, # sklearn metrics
+}
+
+
+def list_modules():
+
+    """
+    Names of all the modules of the package (src.pipeline.ingestion...).
+
+    """
+    modules = []
+    for path in sorted(package_dir.rglob("*.py")):
+        if "__pycache__" in path.parts:
+            continue
+        parts = path.relative_to(package_dir.parent).with_suffix("").parts
+        modules.append(".".join(parts))
+    return modules
+
+
+def child_env():
+
+    """
+    Environment of the measured processes (the package is in PYTHONPATH).
+
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(package_dir.parent)] + [p for p in [env.get("PYTHONPATH")] if p])
+    return env
+
+
+def import_time(module, runs=3):
+
+    """
+    Median cumulative import time (ms) of one module in a new process.
+    Returns (ms, None) or (None, error message) if it can't be imported.
+
+    """
+    env = child_env()
+
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+
+        # Lines: "import time: self [us] | cumulative | imported package"
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == module:
+                times.append(int(fields[1]) / 1000)
+                break
+
+    if len(times) == 0:
+        return None, "module not found in the importtime output"
+    return statistics.median(times), None
+
+
+def answer(_):
+    return os.getpid()
+
+
+def pool_startup(workers, models, start_method=None):
+
+    """
+    Seconds to create a pool of the pipeline with the models of a stage and get an answer
+    from every worker (models loaded in the parent if fork is used, in each worker otherwise).
+    Runs in the measured process (see measure_pool).
+
+    """
+    import multiprocessing
+    from src.pipeline.worker_init import make_pool, uses_fork
+
+    if start_method is not None:
+        multiprocessing.set_start_method(start_method, force=True)
+
+    begin = time.perf_counter()
+    with make_pool(workers, models) as p:
+        pids = set(p.map(answer, range(workers * 4), chunksize=1))
+    seconds = time.perf_counter() - begin
+
+    return {"workers": workers, "models": models, "fork": uses_fork(), "seconds": seconds, "answered": len(pids)}
+
+
+def measure_pool(workers, models, start_method=None):
+
+    """
+    pool_startup in a new process, so the models loaded by one measurement are not reused by the next.
+    Returns the result of pool_startup or raises RuntimeError with the error of the process.
+
+    """
+    code = ("import json; from src.benchmarks.import_budget import pool_startup; "
+            f"print(json.dumps(pool_startup({workers}, {models!r}, {start_method!r})))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=child_env())
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_imports(runs=3, budget_ms=None, pool_workers=2, start_method=None):
+
+    """
+    Import time of every module against its budget, and start time of the pools.
+    Returns the result dictionary (also saved in data/benchmarks/import_times.json).
+
+    """
+    default = budget_ms if budget_ms is not None else default_budget_ms
+
+    modules = {}
+    over = []
+    for module in list_modules():
+        ms, error = import_time(module, runs)
+        budget = budgets_ms.get(module, default)
+
+        if error is not None:
+            modules[module] = {"error": error, "budget_ms": budget}
+            print(f"{module:40} {'-':>9}   not measured ({error})")
+            continue
+
+        modules[module] = {"ms": ms, "budget_ms": budget}
+        flag = "OVER BUDGET" if ms > budget else ""
+        if ms > budget:
+            over.append(module)
+        print(f"{module:40} {ms:8.1f} ms (budget {budget} ms) {flag}")
+
+    pools = []
+    if pool_workers > 0:
+        for models in [[], ["fasttext"], ["spacy"], ["fasttext", "spacy"]]:
+            try:
+                pool = measure_pool(pool_workers, models, start_method)
+            except RuntimeError as e: # model file not found...
+                print(f"pool with {models or 'no models'}: not measured ({e})")
+                continue
+            pools.append(pool)
+            print(f"pool of {pool['workers']} workers with {', '.join(models) or 'no models'}: "
+                  f"{pool['seconds']:.2f}s ({'fork' if pool['fork'] else 'spawn'})")
+
+    result = {"python": sys.version.split()[0], "runs": runs, "modules": modules, "pools": pools,
+              "start_method": start_method, "over_budget": over}
+
+    benchmarks_dir.mkdir(parents=True, exist_ok=True)
+    with open(benchmarks_dir / "import_times.json", "w") as f:
+        json.dump(result, f, indent=2)
+
+    if len(over) > 0:
+        print(f"\n{len(over)} modules over the import budget: {', '.join(over)}")
+    else:
+        print("\nAll the modules are inside the import budget.")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of every module of src against a budget")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--budget-ms", type=float, default=None, help=f"budget of every module (default {default_budget_ms})")
+    parser.add_argument("--pool-workers", type=int, default=2, help="workers of the pool start measurement (0 to skip)")
+    parser.add_argument("--start-method", default=None, choices=["fork", "spawn", "forkserver"])
+    args = parser.parse_args()
+
+    result = check_imports(args.runs, args.budget_ms, args.pool_workers, args.start_method)
+    sys.exit(1 if len(result["over_budget"]) > 0 else 0)
@@ -0,0 +1,454 @@
+# Benchmark suite: throughput and memory of every text function and pipeline stage
+
+"""
+
+Measures the pipeline with synthetic reviews (synthetic_reviews.py), so every change to the
+text functions or the stages can be compared with the same input:
+
+    - Text functions: rows/s and peak memory of clean, clean_group, clean_column, is_english,
+      is_english_batch, join_summary_review, join_summary_review_column and spacy_processing
+    - End to end: rows/s of save_to_parquet and embedding_parquet (parallel process_file) with
+      different numbers of cores, process_file (one process) and merge_par
+
+Each measure runs in a new process (spawn), so the peak memory (RSS) of one function is not
+mixed with the others and the imports are not counted in the time. The time is the best of
+`repeat` runs. For the stages the peak of the largest worker is saved too.
+
+The result is saved in data/benchmarks/stages_<date>.json and compared with a baseline
+(data/benchmarks/baseline.json): a function is a regression when its rows/s is more than
+`threshold` lower than the baseline, or its memory more than `threshold` higher. The memory
+of a function is its peak minus the RSS before it runs (input and models already loaded).
+
+Run from the root of the repository (the fastText model is loaded from models/):
+    python -m src.benchmarks.stage_benchmarks --rows 20000 --cores 1,2,4
+    python -m src.benchmarks.stage_benchmarks --save-baseline     (saves the result as the new baseline)
+
+The exit code is 1 if there is a regression, so it can be used in CI.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+from src.benchmarks.synthetic_reviews import generate_reviews, generate_texts
+from src.pipeline.memory import peak_rss_mb, current_rss_mb, peak_children_rss_mb
+
+
+# Results and baseline
+benchmarks_dir = Path("data/benchmarks")
+baseline_path = benchmarks_dir / "baseline.json"
+
+# Text functions measured
+text_functions = [
+    "clean", "clean_group", "clean_column",
+    "is_english", "is_english_batch",
+    "join_summary_review", "join_summary_review_column",
+    "spacy_processing",
+]
+
+
+def run_isolated(function, *args):
+
+    """
+    Runs function(*args) in a new process (spawn) and returns its result.
+    A Process is used instead of a Pool because the stages start their own pools
+    (the workers of a Pool can't have children).
+
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=send_result, args=(sender, function, args))
+    process.start()
+    sender.close()
+
+    result = receiver.recv()
+    process.join()
+
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def send_result(sender, function, args):
+
+    """
+    Runs the function in the child process and sends the result (or the error) to the parent.
+
+    """
+    try:
+        sender.send(function(*args))
+    except Exception as e:
+        sender.send(RuntimeError(f"{function.__name__} failed: {e!r}"))
+    finally:
+        sender.close()
+
+
+def function_inputs(name, n_rows, seed):
+
+    """
+    Input of one text function, prepared before the time starts:
+    the raw texts for the cleaning, the clean texts for the rest.
+
+    """
+    import pyarrow as pa
+    from src.text.clean_text import clean_column
+    from src.text.combine_columns import join_summary_review_column
+
+    reviews, summaries = generate_texts(n_rows, seed)
+    if name.startswith("clean"):
+        return reviews, summaries
+
+    clean_reviews = clean_column(pa.array(reviews, type=pa.string()))
+    clean_summaries = clean_column(pa.array(summaries, type=pa.string()))
+
+    if name.startswith("is_english"):
+        return clean_reviews.to_pylist(), None
+    if name == "join_summary_review":
+        return clean_reviews.to_pylist(), clean_summaries.to_pylist()
+    if name == "join_summary_review_column":
+        return clean_reviews, clean_summaries
+
+    # spacy_processing receives the joined texts
+    return join_summary_review_column(clean_summaries, clean_reviews).to_pylist(), None
+
+
+def measure_function(name, n_rows, seed, repeat):
+
+    """
+    Runs in the child process: rows/s (best of repeat) and memory of one text function.
+    function_rss_mb: peak RSS minus the RSS after the input and the models are loaded
+    (the memory used by the function, without the fixed cost of the process).
+
+    """
+    import pyarrow as pa
+    from src.text import clean_text, lang_detection, combine_columns, spacy_process
+    from src.pipeline.worker_init import load_models
+
+    first, second = function_inputs(name, n_rows, seed)
+
+    # The models are loaded on first use, load them before measuring (same as a started worker)
+    load_models(["fasttext", "spacy"])
+
+    calls = {
+        "clean": lambda: [clean_text.clean(t) for t in first],
+        "clean_group": lambda: clean_text.clean_group(first),
+        "clean_column": lambda: clean_text.clean_column(pa.array(first, type=pa.string())),
+        "is_english": lambda: [lang_detection.is_english(t) for t in first],
+        "is_english_batch": lambda: lang_detection.is_english_batch(first),
+        "join_summary_review": lambda: combine_columns.join_summary_review(second, first),
+        "join_summary_review_column": lambda: combine_columns.join_summary_review_column(second, first),
+        "spacy_processing": lambda: spacy_process.spacy_processing(first),
+    }
+
+    base_rss = current_rss_mb()
+    times = []
+    for _ in range(repeat):
+        # The lemma cache starts empty in every run (cold cache, like a new worker)
+        spacy_process.clear_lemma_cache()
+        begin = time.perf_counter()
+        calls[name]()
+        times.append(time.perf_counter() - begin)
+
+    seconds = min(times)
+    peak = peak_rss_mb()
+    return {
+        "rows": n_rows,
+        "seconds": seconds,
+        "rows_s": n_rows / max(seconds, 1e-9),
+        "base_rss_mb": base_rss,
+        "peak_rss_mb": peak,
+        "function_rss_mb": max(peak - base_rss, 0.0),
+    }
+
+
+def prepare_workdir(workdir, raw_file):
+
+    """
+    Directory with the structure the stages expect (data/raw, data/processed/spacy and models/).
+    The model directory of the repository is linked, not copied.
+
+    """
+    workdir = Path(workdir)
+    (workdir / "data" / "raw").mkdir(parents=True, exist_ok=True)
+    (workdir / "data" / "processed" / "spacy").mkdir(parents=True, exist_ok=True)
+
+    target = workdir / "data" / "raw" / Path(raw_file).name
+    if not target.exists():
+        os.symlink(Path(raw_file).resolve(), target)
+
+    models = Path("models").resolve()
+    if models.exists() and not (workdir / "models").exists():
+        os.symlink(models, workdir / "models")
+
+    return workdir
+
+
+def count_rows(files):
+
+    """
+    Rows of parquet files (from the footers).
+
+    """
+    import pyarrow.parquet as pq
+    return sum(pq.read_metadata(f).num_rows for f in files)
+
+
+def measure_stage(stage, workdir, workers, batch_size):
+
+    """
+    Runs in the child process: one end to end stage in workdir.
+    rows_s uses the input rows of the stage (raw rows for save_to_parquet, english rows for the rest).
+
+    """
+    os.chdir(workdir)
+
+    # The stages use paths relative to the current directory, imported after chdir
+    from src.pipeline import ingestion, spacy_for_embedding, merge_parquet
+    from src.load_data import multiple_files
+
+    processed = Path("data/processed")
+    spacy_dir = processed / "spacy"
+
+    if stage == "save_to_parquet":
+        rows = sum(1 for f in multiple_files() for _ in open_lines(f))
+        shutil.rmtree(processed, ignore_errors=True)
+        spacy_dir.mkdir(parents=True)
+        begin = time.perf_counter()
+        ingestion.save_to_parquet(workers=workers, batch_size=batch_size)
+
+    elif stage in ("embedding_parquet", "process_file"):
+        inputs = sorted(processed.glob("*.parquet"))
+        rows = count_rows(inputs)
+        shutil.rmtree(spacy_dir, ignore_errors=True)
+        spacy_dir.mkdir(parents=True)
+        begin = time.perf_counter()
+        if stage == "embedding_parquet":
+            spacy_for_embedding.embedding_parquet(workers=workers)
+        else:
+            for f_path in inputs:
+                spacy_for_embedding.process_file(f_path)
+
+    elif stage == "merge_par":
+        rows = count_rows(spacy_dir.glob("*_spacy.parquet"))
+        shutil.rmtree(spacy_dir / "dataset_embedding_spacy", ignore_errors=True)
+        begin = time.perf_counter()
+        merge_parquet.merge_par()
+
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+
+    seconds = time.perf_counter() - begin
+    return {
+        "rows": rows,
+        "workers": workers,
+        "seconds": seconds,
+        "rows_s": rows / max(seconds, 1e-9),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_worker_rss_mb": peak_children_rss_mb(),
+    }
+
+
+def open_lines(f_path):
+
+    """
+    Lines of a raw file (.json or .json.gz).
+
+    """
+    import gzip
+    opener = gzip.open if str(f_path).endswith(".gz") else open
+    with opener(f_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield line
+
+
+def core_counts(cores):
+
+    """
+    Numbers of cores to measure, only the ones this machine has.
+
+    """
+    available = os.cpu_count() or 1
+    if cores is None:
+        return sorted({c for c in [1, 2, 4, available] if c <= available})
+
+    for c in sorted(set(cores)):
+        if not 1 <= c <= available:
+            print(f"WARNING: {c} cores skipped, this machine has {available}.")
+    return sorted({c for c in cores if 1 <= c <= available})
+
+
+def run_benchmarks(rows=20000, seed=42, repeat=3, cores=None, functions=True, end_to_end=True,
+                   batch_size=5000, keep_workdir=False):
+
+    """
+    Runs the benchmarks and returns the result (dictionary).
+
+    rows: synthetic reviews used by the functions and the stages
+    cores: list of numbers of workers for the parallel stages (default: 1, 2, 4 and all)
+
+    """
+    result = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "settings": {"rows": rows, "seed": seed, "repeat": repeat, "batch_size": batch_size},
+        "functions": {},
+        "end_to_end": {},
+    }
+
+    if functions:
+        for name in text_functions:
+            result["functions"][name] = run_isolated(measure_function, name, rows, seed, repeat)
+            print(f"{name}: {result['functions'][name]['rows_s']:.0f} rows/s, "
+                  f"{result['functions'][name]['function_rss_mb']:.1f} MB over the base "
+                  f"(peak {result['functions'][name]['peak_rss_mb']:.0f} MB)")
+
+    if end_to_end:
+        workdir = Path(tempfile.mkdtemp(prefix="stage_benchmarks_"))
+        try:
+            raw_file = generate_reviews(workdir / "synthetic_reviews.json.gz", rows, seed)
+            prepare_workdir(workdir / "run", raw_file)
+
+            # Every stage uses the output of the one before (the last run of each stage is kept)
+            stages = [(stage, k) for stage in ["save_to_parquet", "embedding_parquet"] for k in core_counts(cores)]
+            stages += [("process_file", 1), ("merge_par", 1)]
+
+            for stage, workers in stages:
+                name = f"{stage}@{workers}"
+                result["end_to_end"][name] = run_isolated(measure_stage, stage, str((workdir / "run").resolve()),
+                                                          workers, batch_size)
+                print(f"{name}: {result['end_to_end'][name]['rows_s']:.0f} rows/s, "
+                      f"{result['end_to_end'][name]['seconds']:.1f} s")
+        finally:
+            if keep_workdir:
+                print(f"Work directory kept: {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    return result
+
+
+def flatten(result):
+
+    """
+    Metrics of a result as {"functions.clean": {...}, "end_to_end.save_to_parquet@2": {...}}.
+
+    """
+    metrics = {}
+    for group in ["functions", "end_to_end"]:
+        for name, values in result.get(group, {}).items():
+            metrics[f"{group}.{name}"] = values
+    return metrics
+
+
+def compare(result, baseline, threshold=0.10):
+
+    """
+    Compares a result with the baseline.
+    Returns a list of rows (name, metric, baseline, new, change, regression).
+
+    rows_s lower than baseline * (1 - threshold) or memory higher than
+    baseline * (1 + threshold) is a regression. The memory of the functions is function_rss_mb
+    (peak - base), of the stages peak_rss_mb (baselines without function_rss_mb use the peak too).
+
+    """
+    if result["settings"] != baseline["settings"]:
+        print(f"WARNING: the settings are different from the baseline "
+              f"({result['settings']} vs {baseline['settings']}), the comparison is not exact.")
+
+    rows = []
+    new_metrics = flatten(result)
+    for name, old in flatten(baseline).items():
+        if name not in new_metrics:
+            continue
+        new = new_metrics[name]
+
+        change = new["rows_s"] / max(old["rows_s"], 1e-9) - 1
+        rows.append((name, "rows_s", old["rows_s"], new["rows_s"], change, change < -threshold))
+
+        memory = "function_rss_mb" if "function_rss_mb" in old and "function_rss_mb" in new else "peak_rss_mb"
+        change = new[memory] / max(old[memory], 1e-9) - 1
+        rows.append((name, memory, old[memory], new[memory], change, change > threshold))
+
+    return rows
+
+
+def print_comparison(rows):
+
+    """
+    Prints the comparison as a table.
+
+    """
+    print(f"\n{'benchmark':45} {'metric':16} {'baseline':>12} {'new':>12} {'change':>8}")
+    for name, metric, old, new, change, regression in rows:
+        flag = "  REGRESSION" if regression else ""
+        print(f"{name:45} {metric:16} {old:12.1f} {new:12.1f} {100 * change:7.1f}%{flag}")
+
+
+def save_result(result, path):
+
+    """
+    Saves a result as json.
+
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Throughput and memory benchmarks of the pipeline")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cores", default=None, help="comma separated, for example 1,2,4")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed change before a regression (0.10 = 10%%)")
+    parser.add_argument("--baseline", default=str(baseline_path))
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--skip-functions", action="store_true")
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    args = parser.parse_args(argv)
+
+    cores = [int(c) for c in args.cores.split(",")] if args.cores else None
+    result = run_benchmarks(args.rows, args.seed, args.repeat, cores, not args.skip_functions,
+                            not args.skip_end_to_end, args.batch_size)
+
+    output = benchmarks_dir / f"stages_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    save_result(result, output)
+    print(f"\nResult saved in {output}")
+
+    if args.save_baseline:
+        save_result(result, Path(args.baseline))
+        print(f"Baseline saved in {args.baseline}")
+        return 0
+
+    if not Path(args.baseline).exists():
+        print("No baseline to compare (use --save-baseline).")
+        return 0
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+
+    rows = compare(result, baseline, args.threshold)
+    print_comparison(rows)
+
+    regressions = [row for row in rows if row[-1]]
+    print(f"\n{len(regressions)} regressions (threshold {100 * args.threshold:.0f}%)")
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+# Synthetic Amazon reviews for the benchmarks
+
+"""
+
+Generates NDJSON files with the same fields as the Amazon review files
+(reviewText, summary, asin, overall, unixReviewTime, plus reviewerID and verified
+like the real files), so the pipeline can be measured without downloading the data.
+
+The same seed always gives the same file. The mix tries to look like the real data:
+
+    - Length of reviewText: log-normal number of words (median ~35, a few very long reviews)
+    - Summary: 1 to 8 words, sometimes empty or missing
+    - overall: mostly 5 and 4 stars, few 2 and 3 (like the real ratings)
+    - asin: a few products have most of the reviews (Zipf)
+    - unixReviewTime: 2000 to 2018, more reviews in the last years
+    - Non-english reviews (spanish, german, french, portuguese), emojis, URLs, punctuation,
+      contractions, upper case words, line breaks and empty reviews
+
+Run: python -m src.benchmarks.synthetic_reviews --rows 100000 --output data/raw/synthetic.json.gz
+
+"""
+
+import io
+import gzip
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+
+
+# Pieces of english reviews
+english_openers = [
+    "I bought this for my", "This is the best", "Honestly this", "We ordered this", "My wife loves this",
+    "I was looking for a", "After two weeks of use the", "Arrived on time and the", "Do not buy this",
+    "I have been using this", "Five stars for this", "The quality of this", "Not what I expected, the",
+]
+english_subjects = [
+    "product", "book", "case", "charger", "phone", "blender", "jacket", "toy", "game", "headphones",
+    "battery", "cable", "lamp", "shoes", "watch", "pan", "coffee maker", "keyboard", "mouse", "camera",
+    "novel", "story", "dress", "backpack", "bottle", "screen protector", "speaker", "tent", "knife",
+]
+english_phrases = [
+    "works great", "broke after a few days", "is exactly as described", "doesn't fit well",
+    "the price was good", "I would buy it again", "the color is different than the picture",
+    "customer service was very helpful", "it stopped working", "really easy to use",
+    "the battery life is amazing", "the size is smaller than expected", "my kids love it",
+    "it's not worth the money", "the material feels cheap", "shipping was fast",
+    "the instructions were confusing", "I can't recommend it enough", "it does the job",
+    "better than the one I had before", "the sound quality is good for the price",
+    "it smells weird", "the author keeps you reading until the end", "the characters are well written",
+    "I returned it", "it won't charge anymore", "good value", "perfect gift", "very comfortable",
+]
+english_connectors = ["and", "but", "also", "so", "because", "although", "and honestly", "however"]
+english_summaries = [
+    "Great", "Five stars", "Love it", "Not bad", "Terrible", "Broke fast", "Good value", "Perfect gift",
+    "Works as expected", "Disappointed", "Smaller than expected", "Highly recommend", "Meh",
+    "Do not buy", "Exactly what I needed", "Good but pricey", "Best purchase this year",
+]
+
+# Reviews in other languages (filtered by the language detection)
+other_languages = [
+    "Muy buen producto, llegó rápido y funciona perfectamente, lo recomiendo",
+    "No me gustó, la calidad es muy mala y se rompió en una semana",
+    "Sehr gutes Produkt, schnelle Lieferung und alles funktioniert wie beschrieben",
+    "Die Qualität ist leider schlecht, ich würde es nicht wieder kaufen",
+    "Très bon produit, je le recommande à tout le monde, livraison rapide",
+    "Pas du tout ce que j'attendais, la taille est trop petite",
+    "Produto muito bom, chegou antes do prazo e funciona bem",
+    "Ottimo prodotto, consegna veloce, lo consiglio",
+]
+
+emojis = ["😀", "😍", "👍", "👎", "🔥", "💯", "😡", "🙏", "⭐", "✨", "😂", "🤔", "📦", "❤"]
+
+urls = ["https://www.amazon.com/dp/B00X4WHP5E", "http://bit.ly/2xYz9Q", "www.youtube.com/watch?v=abc123",
+        "https://imgur.com/a/k2Lm9"]
+
+punctuation = [".", "!", "!!!", "?", "...", ",", ";", ":)", " - "]
+
+# Share of the ratings 1 to 5 (similar to the real files)
+rating_share = [0.07, 0.05, 0.08, 0.19, 0.61]
+rating_cumulative = np.cumsum(rating_share)[:-1]
+
+
+def pick(rng, items):
+
+    """
+    Random element of a list (faster than rng.choice for python lists).
+
+    """
+    return items[int(rng.integers(len(items)))]
+
+
+def english_review(rng, n_words):
+
+    """
+    English review with about n_words words made of random phrases.
+
+    """
+    parts = [pick(rng, english_openers), pick(rng, english_subjects), pick(rng, english_phrases)]
+    words = sum(len(p.split()) for p in parts)
+
+    while words < n_words:
+        piece = f"{pick(rng, english_connectors)} {pick(rng, english_phrases)}"
+        if rng.random() < 0.25:
+            piece += pick(rng, punctuation)
+        parts.append(piece)
+        words += len(piece.split())
+
+    text = " ".join(parts)
+
+    # Some reviews have words in upper case for emphasis
+    if rng.random() < 0.05:
+        text = text.replace(pick(rng, english_phrases), pick(rng, english_phrases).upper(), 1)
+
+    return text + pick(rng, punctuation)
+
+
+def add_noise(rng, text, emoji_share, url_share):
+
+    """
+    Adds emojis, URLs and line breaks to some texts.
+
+    """
+    if rng.random() < emoji_share:
+        text = text + " " + "".join(pick(rng, emojis) for _ in range(int(rng.integers(1, 4))))
+    if rng.random() < url_share:
+        words = text.split(" ")
+        words.insert(int(rng.integers(0, len(words) + 1)), pick(rng, urls))
+        text = " ".join(words)
+    if rng.random() < 0.02:
+        text = text.replace(". ", ".\n", 1)
+    return text
+
+
+def make_review(rng, n_products, start_time, end_time, non_english_share, emoji_share, url_share):
+
+    """
+    One review as a dictionary (same fields as the Amazon files).
+
+    """
+    overall = float(np.searchsorted(rating_cumulative, rng.random(), side="right") + 1)
+
+    # Log-normal length: median ~35 words, long tail
+    n_words = int(min(2000, max(1, rng.lognormal(mean=3.55, sigma=0.9))))
+
+    if rng.random() < non_english_share:
+        review = " ".join(pick(rng, other_languages) for _ in range(1 + n_words // 15))
+        summary = pick(rng, other_languages).split(",")[0]
+    else:
+        review = english_review(rng, n_words)
+        summary = pick(rng, english_summaries)
+
+    review = add_noise(rng, review, emoji_share, url_share)
+
+    # Empty texts happen in the real data
+    if rng.random() < 0.005:
+        review = ""
+
+    # More recent years have more reviews
+    position = rng.power(3)
+    unix_time = int(start_time + position * (end_time - start_time))
+    unix_time -= unix_time % 86400 # the real files have the day only
+
+    # Zipf: a few products have most of the reviews
+    product = int(min(n_products, rng.zipf(1.3))) - 1
+
+    row = {
+        "overall": overall,
+        "verified": bool(rng.random() < 0.85),
+        "reviewerID": f"A{int(rng.integers(0, 36 ** 8)):013d}",
+        "asin": f"B{product:09d}",
+        "reviewText": review,
+        "unixReviewTime": unix_time,
+    }
+
+    # Summary is empty or missing in some rows
+    if rng.random() < 0.01:
+        summary = ""
+    if rng.random() < 0.97:
+        row["summary"] = add_noise(rng, summary, emoji_share / 2, 0.0)
+
+    return row
+
+
+def time_range(start_year, end_year):
+
+    """
+    First and last second (unix time) of the years.
+
+    """
+    start_time = int(np.datetime64(f"{start_year}-01-01", "s").astype(np.int64))
+    end_time = int(np.datetime64(f"{end_year}-12-31", "s").astype(np.int64))
+    return start_time, end_time
+
+
+def generate_reviews(path, n_rows=100000, seed=42, n_products=50000, non_english_share=0.08,
+                     emoji_share=0.10, url_share=0.04, start_year=2000, end_year=2018):
+
+    """
+    Writes n_rows synthetic reviews to path as NDJSON (.json, or gzip if the name ends with .gz).
+    Returns the path.
+
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    start_time, end_time = time_range(start_year, end_year)
+
+    with open(path, "wb") as raw:
+        # mtime=0: the gzip header has no date, so the same seed gives the same bytes
+        binary = gzip.GzipFile(filename="", mode="wb", fileobj=raw, mtime=0) if path.name.endswith(".gz") else raw
+        with io.TextIOWrapper(binary, encoding="utf-8") as f:
+            for _ in range(n_rows):
+                row = make_review(rng, n_products, start_time, end_time, non_english_share, emoji_share, url_share)
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    return path
+
+
+def generate_texts(n_rows=10000, seed=42, n_products=50000, non_english_share=0.08, emoji_share=0.10, url_share=0.04):
+
+    """
+    Lists (reviewText, summary) of synthetic reviews in memory, used by the function benchmarks.
+
+    """
+    rng = np.random.default_rng(seed)
+    start_time, end_time = time_range(2000, 2018)
+
+    reviews = []
+    summaries = []
+    for _ in range(n_rows):
+        row = make_review(rng, n_products, start_time, end_time, non_english_share, emoji_share, url_share)
+        reviews.append(row["reviewText"])
+        summaries.append(row.get("summary", ""))
+
+    return reviews, summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic Amazon reviews (NDJSON)")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="data/raw/synthetic.json.gz")
+    args = parser.parse_args()
+
+    print(f"Saved {generate_reviews(args.output, args.rows, args.seed)}")
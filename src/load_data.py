@@ -6,20 +6,23 @@
     
 """
 
-import pandas as pd
 from pathlib import Path
+from src.raw_reader import read_raw_table
 
 # Define root
 root= "amazon-reviews"
 
 
 # Function to read data
-def load_info(file_path):
+def load_info(file_path, selected_only=False):
     
     """
     Reads a big file from Amazon's reviews (.json o .json.gz).
     Returns a pandas data frame.
 
+    selected_only: if True only the text and context columns (select_columns.py)
+    are parsed with the Arrow reader (raw_reader.py), much faster and less memory.
+
     """
 
     f_path= Path(file_path)
@@ -32,8 +35,14 @@ def load_info(file_path):
 
     print(f"Reading file: {f_path.name} ...")
 
+    # pandas is only imported here, listing the files (multiple_files) doesn't need it
+    import pandas as pd
+
     # Read JSON file 
-    df = pd.read_json(f_path, lines=True)
+    if selected_only:
+        df = read_raw_table(f_path).to_pandas()
+    else:
+        df = pd.read_json(f_path, lines=True)
 
     print(f" Loaded {len(df)} rows and {len(df.columns)} columns.")
     return df
@@ -0,0 +1,319 @@
+# Index to assign new reviews to the closest cluster
+
+"""
+
+This module builds a small index from the cluster centroids (clustering.py) to assign
+new reviews without running the clustering again.
+
+    - The new texts go through the same steps as the corpus:
+      clean -> is_english -> join_summary_review -> spacy_processing -> embedding
+      (sentence-transformers, or TF-IDF + SVD if the index was built from lexical embeddings)
+    - Cosine similarity with the centroids (normalized vectors, one matrix product = BLAS)
+    - Optional exemplars: the rows closest to each centroid, a review close to an
+      exemplar is assigned to its cluster even if it is far from the centroid
+    - Optional IVF (many centroids): the centroids are grouped in lists and only
+      the closest lists are searched (nprobe)
+    - Optional int8 quantization of the centroids (4x less disk and memory)
+    - novel flag: the distance is bigger than the novel threshold (percentile of the
+      distances of the corpus), the review doesn't fit any cluster
+
+The arrays are saved as .npy and loaded memory-mapped, so loading the index is instant.
+
+Output: data/clusters/<embeddings directory>/index/
+
+"""
+
+import json
+import time
+import numpy as np
+import pyarrow as pa
+
+from src.text.clean_text import clean_column
+from src.text.lang_detection import is_english_batch
+from src.text.combine_columns import join_summary_review_column
+from src.text.spacy_process import spacy_processing
+from src.pipeline.embedding import (default_model, open_embeddings, read_positions, load_model, encode_texts,
+                                    model_dir_for, lexical_prefix)
+from src.pipeline.clustering import output_dir_for, load_model as load_centroids
+from src.pipeline.merge_parquet import save_json
+
+
+def index_dir_for(model_name, dedup=False):
+
+    """
+    Directory of the assignment index of one model.
+
+    """
+    return output_dir_for(model_name, dedup) / "index"
+
+
+def normalize_rows(vectors):
+
+    """
+    Unit-length rows (cosine similarity = dot product).
+
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize_rows(vectors):
+
+    """
+    int8 quantization with one scale per row: vector ~ int8 values * scale
+
+    """
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+def sample_vectors(shards, sample_rows, seed=42):
+
+    """
+    Random rows of the embeddings (read from the memory-mapped shards), used to set the
+    novel threshold and to choose the exemplars.
+    Output: (vectors, row positions)
+
+    """
+    total = sum(vectors.shape[0] for vectors, _ in shards)
+    positions = np.arange(total)
+    if sample_rows < total:
+        positions = np.sort(np.random.default_rng(seed).choice(total, size=sample_rows, replace=False))
+
+    return read_positions(shards, positions), positions
+
+
+def build_index(model_name=default_model, dedup=False, exemplars=0, ivf_lists=None, quantize=False,
+                novel_percentile=99, sample_rows=100000, seed=42):
+
+    """
+    Builds the assignment index from the centroids of fit_clusters.
+
+    exemplars: rows closest to each centroid saved as exemplars (0: only centroids)
+    ivf_lists: number of IVF lists (None: brute force, good up to a few thousand centroids)
+    quantize: save the centroids as int8
+    novel_percentile: a new review is novel if its distance is bigger than this percentile
+                      of the distances of the corpus (estimated with sample_rows rows)
+
+    """
+    saved = load_centroids(output_dir_for(model_name, dedup))
+    if saved is None:
+        print("No centroids found, run clustering.fit_clusters first.")
+        return
+
+    centroids = normalize_rows(saved[0])
+    n_clusters = centroids.shape[0]
+
+    out_dir = index_dir_for(model_name, dedup)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old in out_dir.glob("*.npy"):
+        old.unlink()
+
+    # Sample of the corpus: cosine distance to the closest centroid
+    sample, _ = sample_vectors(open_embeddings(model_name, dedup), sample_rows, seed)
+    sample = normalize_rows(sample)
+    scores = sample @ centroids.T
+    labels = np.argmax(scores, axis=1)
+    distances = 1 - scores[np.arange(len(sample)), labels]
+    threshold = float(np.percentile(distances, novel_percentile))
+
+    if quantize:
+        values, scales = quantize_rows(centroids)
+        np.save(out_dir / "centroids_int8.npy", values)
+        np.save(out_dir / "centroid_scales.npy", scales)
+    else:
+        np.save(out_dir / "centroids.npy", centroids)
+
+    # Exemplars: rows of the sample closest to each centroid
+    n_exemplars = 0
+    if exemplars > 0:
+        exemplar_vectors = []
+        exemplar_clusters = []
+        for cluster in range(n_clusters):
+            members = np.flatnonzero(labels == cluster)
+            closest = members[np.argsort(distances[members], kind="stable")[:exemplars]]
+            exemplar_vectors.append(sample[closest])
+            exemplar_clusters.append(np.full(len(closest), cluster, dtype=np.int32))
+        np.save(out_dir / "exemplars.npy", np.concatenate(exemplar_vectors))
+        np.save(out_dir / "exemplar_clusters.npy", np.concatenate(exemplar_clusters))
+        n_exemplars = int(sum(len(c) for c in exemplar_clusters))
+
+    # IVF: k-means over the centroids, the centroids of each list are saved together
+    if ivf_lists is not None:
+        from sklearn.cluster import KMeans
+
+        ivf_lists = min(ivf_lists, n_clusters)
+        coarse = KMeans(ivf_lists, n_init=1, random_state=seed).fit(centroids)
+        order = np.argsort(coarse.labels_, kind="stable").astype(np.int32)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(coarse.labels_, minlength=ivf_lists)))).astype(np.int64)
+        np.save(out_dir / "ivf_centroids.npy", normalize_rows(coarse.cluster_centers_))
+        np.save(out_dir / "ivf_order.npy", order)
+        np.save(out_dir / "ivf_offsets.npy", offsets)
+
+    info = {
+        "model": model_name,
+        "dedup": dedup,
+        "n_clusters": n_clusters,
+        "dim": int(centroids.shape[1]),
+        "novel_threshold": threshold,
+        "novel_percentile": novel_percentile,
+        "quantized": quantize,
+        "n_exemplars": n_exemplars,
+        "ivf_lists": ivf_lists,
+    }
+    save_json(info, out_dir / "_index.json")
+
+    print(f"Index saved in {out_dir}: {n_clusters} clusters, {n_exemplars} exemplars, "
+          f"novel threshold {threshold:.4f} (cosine distance, p{novel_percentile})")
+
+
+def load_index(model_name=default_model, dedup=False):
+
+    """
+    Loads the index (arrays memory-mapped, nothing is read until it is used).
+    Output: dictionary with the settings (_index.json) and the arrays.
+    The embedding model is loaded the first time a text is assigned (assign_texts).
+
+    """
+    out_dir = index_dir_for(model_name, dedup)
+    with open(out_dir / "_index.json", "r") as f:
+        index = json.load(f)
+
+    for path in out_dir.glob("*.npy"):
+        index[path.stem] = np.load(path, mmap_mode="r")
+
+    index["encoder"] = None
+    return index
+
+
+def centroid_rows(index, ids):
+
+    """
+    Centroids (float32) of the given cluster ids, int8 values are dequantized.
+
+    """
+    if index["quantized"]:
+        return index["centroids_int8"][ids].astype(np.float32) * index["centroid_scales"][ids][:, None]
+    return np.asarray(index["centroids"][ids], dtype=np.float32)
+
+
+def search(index, vectors, nprobe=8, block=65536):
+
+    """
+    Closest cluster of each vector.
+    Output: (cluster ids, cosine distances, novel flags)
+
+    """
+    queries = normalize_rows(vectors)
+    n_clusters = index["n_clusters"]
+
+    clusters = np.empty(len(queries), dtype=np.int32)
+    similarity = np.empty(len(queries), dtype=np.float32)
+
+    if index["ivf_lists"] is None:
+        # Brute force: all the centroids, in blocks so int8 centroids are dequantized by parts
+        similarity[:] = -np.inf
+        for start in range(0, n_clusters, block):
+            ids = np.arange(start, min(start + block, n_clusters))
+            scores = queries @ centroid_rows(index, ids).T
+            best = np.argmax(scores, axis=1)
+            best_scores = scores[np.arange(len(queries)), best]
+            better = best_scores > similarity
+            clusters[better] = ids[best[better]]
+            similarity[better] = best_scores[better]
+    else:
+        # IVF: only the centroids of the nprobe closest lists
+        coarse = queries @ np.asarray(index["ivf_centroids"]).T
+        nprobe = min(nprobe, coarse.shape[1])
+        lists = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+        offsets = index["ivf_offsets"]
+        for i, query in enumerate(queries):
+            ids = np.concatenate([index["ivf_order"][offsets[l]:offsets[l + 1]] for l in lists[i]])
+            scores = centroid_rows(index, ids) @ query
+            best = np.argmax(scores)
+            clusters[i] = ids[best]
+            similarity[i] = scores[best]
+
+    # Exemplars: a closer exemplar gives its cluster
+    if index["n_exemplars"] > 0:
+        scores = queries @ np.asarray(index["exemplars"]).T
+        best = np.argmax(scores, axis=1)
+        best_scores = scores[np.arange(len(queries)), best]
+        better = best_scores > similarity
+        clusters[better] = index["exemplar_clusters"][best[better]]
+        similarity[better] = best_scores[better]
+
+    distances = 1 - similarity
+    return clusters, distances, distances > index["novel_threshold"]
+
+
+def prepare_texts(reviews, summaries=None):
+
+    """
+    Same steps as the ingestion and spacy stages for new reviews.
+    Output: (texts ready to embed, English flags). Texts of non English reviews are None.
+
+    """
+    if summaries is None:
+        summaries = [None] * len(reviews)
+
+    clean_review = clean_column(pa.array(reviews, type=pa.string()))
+    clean_summary = clean_column(pa.array(summaries, type=pa.string()))
+    english = np.array(is_english_batch(clean_review), dtype=bool)
+
+    joined = join_summary_review_column(clean_summary, clean_review).to_pylist()
+    positions = np.flatnonzero(english)
+    processed = spacy_processing([joined[i] for i in positions]) if len(positions) > 0 else []
+
+    texts = [None] * len(reviews)
+    for i, text in zip(positions, processed):
+        texts[i] = text
+    return texts, english
+
+
+def assign_texts(index, reviews, summaries=None, nprobe=8):
+
+    """
+    Assigns a batch of new reviews (list of reviewText, optional list of summary).
+
+    Output: dictionary of arrays: cluster (-1 if the review is not English), distance
+            (cosine, nan if not English), novel (doesn't fit any cluster), english
+
+    """
+    texts, english = prepare_texts(reviews, summaries)
+
+    clusters = np.full(len(reviews), -1, dtype=np.int32)
+    distances = np.full(len(reviews), np.nan, dtype=np.float32)
+    novel = np.zeros(len(reviews), dtype=bool)
+
+    positions = np.flatnonzero(english)
+    if len(positions) > 0:
+        if index["model"].startswith(lexical_prefix):
+            # Imported here, sklearn is only needed by the lexical indexes
+            from src.pipeline.lexical_embedding import encode
+            vectors = encode(model_dir_for(index["model"], index["dedup"]), [texts[i] for i in positions])
+        else:
+            if index["encoder"] is None:
+                index["encoder"] = load_model(index["model"])
+            vectors = encode_texts(index["encoder"], [texts[i] for i in positions])
+        clusters[positions], distances[positions], novel[positions] = search(index, vectors, nprobe)
+
+    return {"cluster": clusters, "distance": distances, "novel": novel, "english": english}
+
+
+def measure_latency(index, reviews, repeats=200):
+
+    """
+    Latency of assign_texts with one review per call (ms): p50, p99 and max.
+
+    """
+    times = []
+    for i in range(repeats):
+        begin = time.perf_counter()
+        assign_texts(index, [reviews[i % len(reviews)]])
+        times.append(1000 * (time.perf_counter() - begin))
+
+    times = np.array(times)
+    return {"p50_ms": float(np.percentile(times, 50)), "p99_ms": float(np.percentile(times, 99)), "max_ms": float(times.max())}
@@ -0,0 +1,207 @@
+# Chunk sizes from a memory budget
+
+"""
+
+Instead of a number of rows, the stages can receive a memory budget (MB) for the whole run:
+the parent process plus all the workers. The size of the next chunk is calculated while
+the stage runs:
+
+    - Chunks are sized in bytes, not rows: the raw reader stops a chunk when it has the
+      target bytes, and the spacy stage divides the target by the bytes per row of each
+      row group. Long-review categories get fewer rows and short-review categories more.
+    - The workers send their RSS (start of the chunk, end and peak) with the metrics of
+      every chunk (metrics.run_with_metrics). With the RSS of the parent this gives the
+      memory of the run, and how much it grows per byte of chunk (growth).
+    - target = (budget - memory without data) / growth, it grows at most 2x per chunk
+      (the first chunks are small) and is halved when the RSS of the run is near the budget
+      and still growing (the memory freed by a process is not always returned to the system,
+      so an RSS that stays high is not a reason to keep shrinking).
+
+The spacy stage sends the row groups to the pool before they are processed, so the target
+is shared with the workers in a multiprocessing.Value (init_worker, called by the pool
+initializer of worker_init.py).
+
+The RSS of a forked worker includes the pages it shares with the parent, so they are counted
+more than once and the budget is conservative (the processes use a bit less than the budget).
+
+The chunk boundaries change from run to run, so an interrupted file resumes correctly but the
+final parquet can have different row groups than an uninterrupted run (same rows, same order).
+With a fixed batch_size the output is always the same.
+
+"""
+
+import os
+from multiprocessing import Value
+from src.pipeline.memory import current_rss_mb, peak_rss_mb
+
+
+MB = 1024 ** 2
+
+# Target bytes of the chunks of the workers (set by init_worker, None when the budget is not used)
+shared_target = None
+
+
+def init_worker(target):
+
+    """
+    Called when a worker starts (worker_init.py): the workers read the target bytes of the parent
+    from the shared value. None when the stage has no memory budget.
+
+    """
+    global shared_target
+    shared_target = target
+
+
+def worker_rows(bytes_per_row, default_rows, min_rows=500):
+
+    """
+    Rows of the next batch in a worker: target bytes of the parent / bytes per row.
+    default_rows is used when the stage runs without a budget.
+
+    """
+    if shared_target is None:
+        return default_rows
+    return max(min_rows, int(shared_target.value / max(bytes_per_row, 1)))
+
+
+class BatchSizer:
+
+    """
+    Calculates the size (bytes) of the next chunk from the memory budget and the RSS
+    of the parent and the workers. Used in the parent process.
+
+    budget_mb: memory of the whole run (parent and workers)
+    workers: number of worker processes
+    start_mb: size of the first chunks, before the growth is known
+    headroom: share of the budget used, the rest is left for the peaks between two chunks
+
+    """
+
+    def __init__(self, budget_mb, workers, start_mb=4, min_mb=0.25, max_mb=512, max_rows=200000, headroom=0.85):
+        self.budget = budget_mb * MB
+        self.workers = workers
+        self.min_bytes = int(min_mb * MB)
+        self.max_bytes = int(max_mb * MB)
+        self.max_rows = max_rows
+        self.headroom = headroom
+
+        # RSS of the parent before the stage starts (memory without data)
+        self.parent_base = current_rss_mb() * MB
+
+        # pid: {"base", "peak", "current"} RSS in bytes of each worker
+        self.seen = {}
+
+        # Bytes of memory per byte of chunk (learned), and largest chunk sent until now
+        self.growth = None
+        self.largest = 0
+        self.shrinks = 0
+        self.last_current = 0
+        self.warned = False
+
+        self.target = self.clamp(min(start_mb * MB, self.free() / (4 * max(workers, 1))))
+
+        # Target shared with the workers (spacy stage)
+        self.shared = Value("d", float(self.target))
+
+    def clamp(self, target):
+        return int(min(self.max_bytes, max(self.min_bytes, target)))
+
+    def base(self):
+
+        """
+        Memory of the run without data: parent and workers at the start of their first chunk
+        (the workers not seen yet count as the mean of the others, or as the parent).
+
+        """
+        bases = [w["base"] for w in self.seen.values()]
+        mean = sum(bases) / len(bases) if len(bases) > 0 else self.parent_base
+        return self.parent_base + sum(bases) + max(0, self.workers - len(bases)) * mean
+
+    def free(self):
+
+        """
+        Bytes of the budget that can be used by the chunks.
+
+        """
+        return self.budget * self.headroom - self.base()
+
+    def limits(self):
+
+        """
+        (max rows, max bytes) of the next chunk, used by the raw reader (read_raw_batches).
+
+        """
+        return self.max_rows, self.target
+
+    def observe(self, chunk_metrics, chunk_bytes):
+
+        """
+        Updates the target with the RSS sent by the worker of one chunk.
+        chunk_bytes: size of the chunk (raw bytes or Arrow bytes of the batches)
+
+        """
+        pid = chunk_metrics.get("pid")
+        if pid is None or "peak_rss_mb" not in chunk_metrics:
+            return
+
+        parent = current_rss_mb() * MB
+        parent_peak = parent
+
+        # Without a pool (process_file) the chunk runs in this process, there are no workers
+        if pid == os.getpid():
+            parent_peak = chunk_metrics["peak_rss_mb"] * MB
+        else:
+            worker = self.seen.setdefault(pid, {"base": chunk_metrics["rss_start_mb"] * MB})
+            worker["peak"] = chunk_metrics["peak_rss_mb"] * MB
+            worker["current"] = chunk_metrics["rss_mb"] * MB
+        self.largest = max(self.largest, chunk_bytes)
+
+        # Both the peaks and the largest chunk are maxima of the whole run, so the growth
+        # is the memory of the run at its worst over the biggest chunk that caused it
+        peak = parent_peak + sum(w["peak"] for w in self.seen.values())
+        if self.largest > 0:
+            self.growth = max(1.0, (peak - self.base()) / self.largest)
+
+        free = self.free()
+        if free <= self.min_bytes * self.workers and not self.warned:
+            print(f"WARNING: memory budget of {self.budget / MB:.0f} MB is too small, the processes use "
+                  f"{self.base() / MB:.0f} MB without data. Using the smallest chunks.")
+            self.warned = True
+
+        target = free / self.growth if self.growth is not None else self.target
+
+        # Grow slowly (the growth of bigger chunks is not known yet), shrink right away
+        target = min(target, 2 * self.target)
+
+        # RSS of the run right now near the budget and growing: half the chunk
+        current = parent + sum(w["current"] for w in self.seen.values())
+        if current > self.budget * self.headroom and current > self.last_current:
+            target = min(target, self.target / 2)
+            self.shrinks += 1
+        self.last_current = current
+
+        self.target = self.clamp(target)
+        self.shared.value = float(self.target)
+
+    def summary(self):
+
+        """
+        Values of the sizer at the end of the stage.
+
+        """
+        peak = peak_rss_mb() * MB + sum(w.get("peak", 0) for w in self.seen.values())
+        return {
+            "budget_mb": self.budget / MB,
+            "target_mb": self.target / MB,
+            "largest_chunk_mb": self.largest / MB,
+            "growth": self.growth,
+            "peak_run_mb": peak / MB,
+            "shrinks": self.shrinks,
+        }
+
+    def report(self, stage):
+        s = self.summary()
+        growth = f"{s['growth']:.1f}" if s["growth"] is not None else "-"
+        print(f"[{stage}] memory budget {s['budget_mb']:.0f} MB: last chunk target {s['target_mb']:.1f} MB, "
+              f"largest {s['largest_chunk_mb']:.1f} MB, growth {growth}x, peak of the workers + parent "
+              f"{s['peak_run_mb']:.0f} MB, {s['shrinks']} shrinks")
@@ -0,0 +1,217 @@
+# Checkpoints to resume a file that was interrupted
+
+"""
+
+This module saves the progress of a file while it is being processed so an interrupted
+run can continue where it stopped instead of starting from scratch.
+
+    - Every processed chunk is saved as a small parquet file (part) in a <source>.parts directory
+    - A manifest (_checkpoint.json) records the committed parts and the input position
+      each one corresponds to (byte offset for raw JSON, row group for parquet)
+    - When the file is finished the parts are copied in order to the final parquet
+      (same row groups as an uninterrupted run) and the parts directory is deleted
+
+"""
+
+import os
+import json
+import shutil
+from pathlib import Path
+import pyarrow.parquet as pq
+from src.features.select_columns import context_cols
+
+
+# Same writer options used by the pipeline for the final files
+# Statistics (min, max) only for the context columns, used to filter row groups when reading
+writer_options = {"compression": "snappy", "write_statistics": context_cols + ["source"]}
+
+
+def input_info(input_path):
+
+    """
+    Returns size and modification time of the input, used to check that the
+    checkpoint belongs to the same input file.
+
+    """
+    stat = Path(input_path).stat()
+    return {"input": str(input_path), "input_size": stat.st_size, "input_mtime_ns": stat.st_mtime_ns}
+
+
+def save_manifest(manifest, parts_dir):
+
+    """
+    Saves the manifest. It is written to a temporary file and then renamed,
+    so an interruption never leaves a half-written manifest.
+
+    """
+    path = Path(parts_dir) / "_checkpoint.json"
+    temp = Path(parts_dir) / "_checkpoint.json.tmp"
+
+    with open(temp, "w") as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temp, path)
+
+
+def start_checkpoint(parts_dir, input_path, settings):
+
+    """
+    Loads the checkpoint of an interrupted run or creates a new one.
+
+    parts_dir: directory for the parts and the manifest (<source>.parts)
+    input_path: file being processed
+    settings: values that change the output (batch size, columns...). If the input file
+              or the settings changed, the old parts can't be used and it starts from scratch.
+
+    Output: manifest (dictionary). manifest["position"] is where the input should continue,
+            manifest["done"] has all the committed input ranges (also the ones out of order).
+
+    """
+    parts_dir = Path(parts_dir)
+    path = parts_dir / "_checkpoint.json"
+
+    info = input_info(input_path)
+
+    if path.exists():
+        with open(path, "r") as f:
+            manifest = json.load(f)
+
+        same_input = all(manifest.get(k) == v for k, v in info.items())
+        if same_input and manifest.get("settings") == settings:
+            return manifest
+
+        print(f"Checkpoint in {parts_dir} is from a different input or settings. Starting from scratch...")
+
+    # New checkpoint - delete old parts
+    if parts_dir.exists():
+        shutil.rmtree(parts_dir)
+    parts_dir.mkdir(parents=True)
+
+    manifest = dict(info)
+    manifest["settings"] = settings
+    manifest["position"] = 0
+    manifest["parts"] = []
+    manifest["done"] = []
+
+    save_manifest(manifest, parts_dir)
+    return manifest
+
+
+def write_part(part_path, tables):
+
+    """
+    Writes one or more tables (one row group each) in a part file.
+    Written to a temporary name and renamed so the part is complete or doesn't exist.
+
+    """
+    part_path = Path(part_path)
+    temp = part_path.with_name(part_path.name + ".tmp")
+
+    writer = None
+    rows = 0
+    for table in tables:
+        if writer is None:
+            writer = pq.ParquetWriter(temp, table.schema, **writer_options)
+        writer.write_table(table)
+        rows += table.num_rows
+
+    if writer is None:
+        return 0
+
+    writer.close()
+    os.replace(temp, part_path)
+    return rows
+
+
+def commit_part(manifest, parts_dir, part_name, rows, start, end):
+
+    """
+    Records a part that is already written (for example by a worker process) for the
+    input range [start, end). part_name is None if the range had no rows to save.
+
+    The ranges can be committed in any order, manifest["position"] is the end of the
+    committed ranges that are contiguous from the beginning of the input.
+    Committing the same range again replaces the old entry (the part is never copied twice).
+
+    """
+    manifest["parts"] = [part for part in manifest["parts"] if part["start"] != start]
+    if part_name is not None:
+        manifest["parts"].append({"file": part_name, "rows": rows, "start": start, "end": end})
+
+    manifest["done"] = [done for done in manifest["done"] if done[0] != start]
+    manifest["done"].append([start, end])
+
+    # Move the position while the next range is committed
+    position = 0
+    for range_start, range_end in sorted(manifest["done"]):
+        if range_start != position:
+            break
+        position = range_end
+    manifest["position"] = position
+
+    save_manifest(manifest, parts_dir)
+
+
+def part_name_for(start):
+
+    """
+    Name of the part for the input range that starts in start.
+    The name comes from the input position so it is unique and sorts in input order.
+
+    """
+    return f"part-{start:015d}.parquet"
+
+
+def commit(manifest, parts_dir, tables, start, end):
+
+    """
+    Commits the result of the input range [start, end).
+
+    tables: list of tables to save in the part (empty list if the chunk had no rows to save)
+    The manifest position moves to end, so a restart continues after this chunk.
+
+    """
+    tables = [t for t in tables if t is not None and t.num_rows > 0]
+
+    part_name = None
+    rows = 0
+    if len(tables) > 0:
+        part_name = part_name_for(start)
+        rows = write_part(Path(parts_dir) / part_name, tables)
+
+    commit_part(manifest, parts_dir, part_name, rows, start, end)
+
+
+def finish_checkpoint(manifest, parts_dir, final_path, temp_path):
+
+    """
+    Copies all the committed parts (row group by row group, in input order) to the final
+    parquet file and deletes the parts directory.
+
+    The file is written in temp_path and renamed to final_path at the end.
+    Returns False if there was nothing to save (no final file is created).
+
+    """
+    parts_dir = Path(parts_dir)
+    parts = sorted(manifest["parts"], key=lambda part: part["start"])
+
+    writer = None
+    for part in parts:
+        pf = pq.ParquetFile(parts_dir / part["file"])
+
+        if writer is None:
+            writer = pq.ParquetWriter(temp_path, pf.schema_arrow, **writer_options)
+
+        # Each row group of the part is written as the same row group in the final file
+        for i in range(pf.num_row_groups):
+            writer.write_table(pf.read_row_group(i))
+
+    saved = writer is not None
+    if saved:
+        writer.close()
+        Path(temp_path).rename(final_path)
+
+    shutil.rmtree(parts_dir)
+    return saved
@@ -0,0 +1,301 @@
+# Module to cluster the embeddings without loading them all in memory
+
+"""
+
+The embeddings are read shard by shard (memory-mapped, see embedding.py) in batches,
+so the memory used depends on the batch size and not on the number of reviews.
+
+    - Mini-batch k-means: every batch moves the centroids a little (each centroid with a
+      learning rate 1 / number of rows it has seen), k-means++ on the first batch to start
+    - The batch size comes from a memory budget (memory_mb)
+    - Warm start: the centroids and counts of the last run are loaded and the training
+      continues from them (for example after new sources were embedded)
+    - Second pass: cluster id and distance of every row, saved with asin, source, overall
+    - Throughput (rows/s) and peak memory (RSS) are printed for each pass
+
+Output: data/clusters/<embeddings directory>/
+    - centroids.npy, counts.npy, _model.json: the centroid model
+    - clusters.parquet: row_id, asin, source, overall, cluster, distance
+
+"""
+
+import json
+import time
+import shutil
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.pipeline.embedding import default_model, model_dir_for, open_embeddings
+from src.pipeline.merge_parquet import save_json
+from src.pipeline.memory import peak_rss_mb
+from src.pipeline import dedup as dedup_stage
+
+
+# Output for the clusters
+clusters_dir = Path("data/clusters")
+
+
+def output_dir_for(model_name, dedup=False):
+
+    """
+    Directory of the clusters of one embeddings directory.
+
+    """
+    return clusters_dir / model_dir_for(model_name, dedup).name
+
+
+def batch_rows_for(memory_mb, dim, n_clusters):
+
+    """
+    Rows per batch so one batch fits in memory_mb:
+    float32 copy of the vectors (dim x 4 bytes) + distances to every centroid (n_clusters x 4 bytes),
+    x2 for the temporary arrays. At least n_clusters rows (needed to start k-means++).
+
+    """
+    row_bytes = 2 * 4 * (dim + n_clusters)
+    return max(n_clusters, int(memory_mb * 1024 ** 2 // row_bytes))
+
+
+def iter_batches(shards, batch_rows):
+
+    """
+    Yields float32 batches of at most batch_rows rows reading the shards in order.
+    Only the rows of the batch are read from the memory-mapped files.
+
+    """
+    for vectors, _ in shards:
+        for start in range(0, vectors.shape[0], batch_rows):
+            yield np.asarray(vectors[start:start + batch_rows], dtype=np.float32)
+
+
+def nearest_centroid(batch, centroids, centroid_norms):
+
+    """
+    Closest centroid of each row and the euclidean distance to it.
+    ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2 (one matrix product for the whole batch)
+
+    """
+    scores = batch @ centroids.T
+    scores *= -2
+    scores += centroid_norms
+
+    labels = np.argmin(scores, axis=1)
+    squared = scores[np.arange(len(batch)), labels] + np.einsum("ij,ij->i", batch, batch)
+
+    return labels, np.sqrt(np.maximum(squared, 0))
+
+
+def update_centroids(batch, labels, centroids, counts):
+
+    """
+    Mini-batch k-means step: each centroid moves to the mean of its rows with
+    learning rate (rows of the batch) / (all the rows it has seen).
+
+    """
+    n_clusters, dim = centroids.shape
+
+    batch_counts = np.bincount(labels, minlength=n_clusters)
+
+    # Sum of the rows of each centroid: rows sorted by label and added by blocks
+    order = np.argsort(labels, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(batch_counts)[:-1]))
+    used = batch_counts > 0
+    sums = np.zeros((n_clusters, dim), dtype=np.float64)
+    sums[used] = np.add.reduceat(batch[order].astype(np.float64), starts[used], axis=0)
+
+    counts[used] += batch_counts[used]
+
+    # c = c + (sum - n * c) / counts
+    rate = (batch_counts[used] / counts[used])[:, None]
+    centroids[used] += rate * (sums[used] / batch_counts[used][:, None] - centroids[used])
+
+
+def load_model(out_dir):
+
+    """
+    Loads the centroids, counts and settings saved by fit_clusters (None if they don't exist).
+
+    """
+    if not (out_dir / "_model.json").exists():
+        return None
+
+    with open(out_dir / "_model.json", "r") as f:
+        info = json.load(f)
+
+    return np.load(out_dir / "centroids.npy"), np.load(out_dir / "counts.npy"), info
+
+
+def fit_clusters(model_name=default_model, dedup=False, n_clusters=100, memory_mb=256,
+                 epochs=1, warm_start=False, seed=42):
+
+    """
+    Fits the centroids reading the embeddings in batches.
+
+    n_clusters: number of clusters
+    memory_mb: memory budget of one batch (sets the batch size)
+    epochs: passes over all the embeddings
+    warm_start: continue from the centroids of the last run (same n_clusters) instead of k-means++
+
+    Output: centroids array [n_clusters x dim] (also saved in data/clusters)
+
+    """
+    shards = open_embeddings(model_name, dedup)
+    if len(shards) == 0:
+        print("No embeddings to cluster.")
+        return None
+
+    dim = shards[0][0].shape[1]
+    total_rows = sum(vectors.shape[0] for vectors, _ in shards)
+    batch_rows = batch_rows_for(memory_mb, dim, n_clusters)
+
+    out_dir = output_dir_for(model_name, dedup)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    centroids = None
+    counts = np.zeros(n_clusters, dtype=np.float64)
+    rows_seen = 0
+
+    saved = load_model(out_dir) if warm_start else None
+    if saved is not None:
+        saved_centroids, saved_counts, info = saved
+        if saved_centroids.shape == (n_clusters, dim):
+            centroids, counts = saved_centroids.astype(np.float64), saved_counts.astype(np.float64)
+            rows_seen = info["rows_seen"]
+            print(f"Warm start from {out_dir} ({rows_seen} rows seen).")
+        else:
+            print(f"Saved model has shape {saved_centroids.shape}, expected {(n_clusters, dim)}. Starting from k-means++...")
+
+    print(f"{total_rows} rows, batches of {batch_rows} rows, {n_clusters} clusters.")
+
+    begin = time.time()
+    for epoch in range(epochs):
+        for batch in iter_batches(shards, batch_rows):
+
+            # First batch of a new model: k-means++ to choose the initial centroids
+            if centroids is None:
+                if len(batch) < n_clusters:
+                    continue
+                # sklearn is only imported here, so the query layer can import the paths of this module fast
+                from sklearn.cluster import kmeans_plusplus
+                centroids, _ = kmeans_plusplus(batch, n_clusters, random_state=seed)
+                centroids = centroids.astype(np.float64)
+
+            centroid_norms = np.einsum("ij,ij->i", centroids, centroids).astype(np.float32)
+            labels, _ = nearest_centroid(batch, centroids.astype(np.float32), centroid_norms)
+            update_centroids(batch, labels, centroids, counts)
+            rows_seen += len(batch)
+
+        print(f"Epoch {epoch + 1}/{epochs} done.")
+
+    if centroids is None:
+        print(f"Not enough rows for {n_clusters} clusters (batches of {batch_rows} rows).")
+        return None
+
+    seconds = time.time() - begin
+    print(f"Fit: {epochs * total_rows / max(seconds, 1e-9):.0f} rows/s, peak RSS {peak_rss_mb():.0f} MB")
+
+    # Save the model (centroids first, _model.json last so it only exists with the arrays complete)
+    np.save(out_dir / "centroids.npy", centroids.astype(np.float32))
+    np.save(out_dir / "counts.npy", counts)
+    save_json({"model": model_name, "dedup": dedup, "n_clusters": n_clusters, "dim": dim,
+               "rows_seen": rows_seen, "seed": seed}, out_dir / "_model.json")
+
+    return centroids.astype(np.float32)
+
+
+def assign_clusters(model_name=default_model, dedup=False, memory_mb=256):
+
+    """
+    Cluster id and distance to the centroid of every row (second pass over the embeddings).
+    With dedup=True the result of each unique text is saved in memory-mapped files and given
+    back to all its rows at the end (dedup.fan_out), batch by batch.
+
+    Output: clusters.parquet with the index columns + cluster + distance
+
+    """
+    out_dir = output_dir_for(model_name, dedup)
+    saved = load_model(out_dir)
+    if saved is None:
+        print(f"No model in {out_dir}, run fit_clusters first.")
+        return
+
+    centroids, _, info = saved
+    centroids = centroids.astype(np.float32)
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    batch_rows = batch_rows_for(memory_mb, centroids.shape[1], centroids.shape[0])
+
+    temp = out_dir / "clusters.parquet.tmp"
+    writer = None
+    shards = open_embeddings(model_name, dedup)
+
+    if dedup:
+        # Results by text_id on disk (memory-mapped), given back to the rows at the end
+        n_unique = sum(vectors.shape[0] for vectors, _ in shards)
+        work_dir = out_dir / "assign_tmp"
+        work_dir.mkdir(parents=True, exist_ok=True)
+        unique_ids = dedup_stage.memmap_array(work_dir / "text_id.npy", n_unique)
+        unique_clusters = dedup_stage.memmap_array(work_dir / "cluster.npy", n_unique, dtype=np.int32)
+        unique_distances = dedup_stage.memmap_array(work_dir / "distance.npy", n_unique, dtype=np.float32)
+
+    begin = time.time()
+    rows = 0
+    for vectors, index_path in shards:
+        index = pq.read_table(index_path)
+
+        for start in range(0, vectors.shape[0], batch_rows):
+            batch = np.asarray(vectors[start:start + batch_rows], dtype=np.float32)
+            labels, distances = nearest_centroid(batch, centroids, centroid_norms)
+
+            if dedup:
+                unique_ids[rows:rows + len(batch)] = index["text_id"].to_numpy()[start:start + len(batch)]
+                unique_clusters[rows:rows + len(batch)] = labels
+                unique_distances[rows:rows + len(batch)] = distances
+                rows += len(batch)
+                continue
+            rows += len(batch)
+
+            table = index.slice(start, len(batch))
+            table = table.append_column("cluster", pa.array(labels.astype(np.int32)))
+            table = table.append_column("distance", pa.array(distances.astype(np.float32)))
+
+            if writer is None:
+                writer = pq.ParquetWriter(temp, table.schema, compression="snappy")
+            writer.write_table(table)
+
+    if dedup:
+        if rows > 0:
+            # The unique texts are in text_id order, so the ids are already sorted for fan_out,
+            # which reads only the values of the rows of each batch
+            values = {"cluster": unique_clusters[:rows], "distance": unique_distances[:rows]}
+            for table in dedup_stage.fan_out(unique_ids[:rows], values):
+                if writer is None:
+                    writer = pq.ParquetWriter(temp, table.schema, compression="snappy")
+                writer.write_table(table)
+            del values
+
+        del unique_ids, unique_clusters, unique_distances
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if writer is None:
+        print("No embeddings to assign.")
+        return
+
+    writer.close()
+    temp.replace(out_dir / "clusters.parquet")
+
+    seconds = time.time() - begin
+    print(f"Assign: {rows / max(seconds, 1e-9):.0f} rows/s, peak RSS {peak_rss_mb():.0f} MB")
+    print(f"Clusters saved in {out_dir / 'clusters.parquet'}")
+
+
+def cluster(model_name=default_model, dedup=False, n_clusters=100, memory_mb=256, epochs=1, warm_start=False, seed=42):
+
+    """
+    Clustering stage: fit the centroids and assign every row.
+
+    """
+    centroids = fit_clusters(model_name, dedup, n_clusters, memory_mb, epochs, warm_start, seed)
+    if centroids is not None:
+        assign_clusters(model_name, dedup, memory_mb)
@@ -0,0 +1,501 @@
+# Module to remove duplicated reviews before embedding
+
+"""
+
+Amazon reviews repeat a lot (same text in many ASINs, short reviews like "great product").
+This module finds duplicated texts in the spacy output (clean_embedding_text) so the
+embedding and clustering only need to process each text once.
+
+    - Exact duplicates: 64-bit hash of the text
+    - Near duplicates: MinHash signatures + LSH (bands), only for texts with enough words.
+      The candidates of a band are only merged if their signatures are similar enough
+      (threshold), and every row is merged into a representative it was compared with
+    - Every row gets a text_id (row_id of its canonical text), saved in row_map.parquet
+    - The canonical texts are saved in unique_texts.parquet (text_id, text, count)
+
+Everything is done out-of-core: the hashes are spilled to bucket files on disk and the
+arrays with one value per row are memory-mapped, so it works with hundreds of millions of rows.
+
+row_id: position of the row when the spacy files are read in order (sorted by name).
+
+"""
+
+import gc
+import shutil
+import hashlib
+import zlib
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Input: spacy output files
+input_dir = Path("data/processed/spacy")
+
+# Output for the dedup tables
+output_dir = Path("data/processed/dedup")
+
+# Prime used for the MinHash permutations (bigger than any 32-bit hash)
+minhash_prime = np.uint64(4294967311)
+
+
+def spacy_files():
+
+    """
+    Returns the <source>_spacy.parquet files in the order used to number the rows.
+    The old merged file (dataset_embedding_spacy.parquet) and the temporary files of an
+    interrupted spacy stage (<source>.temp_spacy.parquet) are not sources, same as merge_parquet.
+
+    """
+    files = []
+    for f_path in sorted(input_dir.glob("*_spacy.parquet")):
+        if f_path.name == "dataset_embedding_spacy.parquet" or f_path.name.endswith(".temp_spacy.parquet"):
+            continue
+        files.append(f_path)
+    return files
+
+
+def iter_texts(files, batch_size, columns=("clean_embedding_text",)):
+
+    """
+    Reads the files in order and yields (first row_id, record batch).
+
+    """
+    row_id = 0
+    for f_path in files:
+        for batch in pq.ParquetFile(f_path).iter_batches(batch_size=batch_size, columns=list(columns)):
+            yield row_id, batch
+            row_id += batch.num_rows
+
+
+def text_hashes(texts):
+
+    """
+    64-bit hash (blake2b) of each text. Stable between runs and python versions.
+
+    """
+    hashes = np.empty(len(texts), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        digest = hashlib.blake2b((text or "").encode("utf-8"), digest_size=8).digest()
+        hashes[i] = int.from_bytes(digest, "little")
+    return hashes
+
+
+def minhash_parameters(num_perm, seed):
+
+    """
+    Random parameters (a, b) of the hash permutations: h(x) = (a * x + b) mod prime
+    a is smaller than 2^31 so a * x doesn't overflow 64 bits.
+
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 2**31 - 1, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, 2**31 - 1, size=num_perm).astype(np.uint64)
+    return a, b
+
+
+def minhash_signatures(texts, a, b, min_tokens):
+
+    """
+    MinHash signature of each text using word bigrams as shingles.
+    Texts with less than min_tokens words are skipped (for short texts the
+    exact duplicates are enough and near duplicates give false matches).
+    A bigram needs two words, so min_tokens is at least 2.
+
+    Output: (positions of the texts with signature, signatures array [texts x num_perm])
+
+    """
+    positions = []
+    shingle_hashes = []
+    starts = []
+    total = 0
+    min_tokens = max(2, min_tokens)
+
+    for i, text in enumerate(texts):
+        words = (text or "").split()
+        if len(words) < min_tokens:
+            continue
+
+        # Set of bigrams, hashed with crc32 (fast and stable)
+        shingles = set(zip(words, words[1:]))
+        hashes = [zlib.crc32(f"{w1} {w2}".encode("utf-8")) for w1, w2 in shingles]
+
+        positions.append(i)
+        starts.append(total)
+        shingle_hashes.extend(hashes)
+        total += len(hashes)
+
+    if len(positions) == 0:
+        return np.array([], dtype=np.int64), np.empty((0, len(a)), dtype=np.uint64)
+
+    x = np.array(shingle_hashes, dtype=np.uint64)
+    starts = np.array(starts, dtype=np.int64)
+
+    # For each permutation, the minimum hash of the shingles of each text (reduceat by text)
+    signatures = np.empty((len(positions), len(a)), dtype=np.uint64)
+    for j in range(len(a)):
+        permuted = (a[j] * x + b[j]) % minhash_prime
+        signatures[:, j] = np.minimum.reduceat(permuted, starts)
+
+    return np.array(positions, dtype=np.int64), signatures
+
+
+def band_keys(signatures, bands):
+
+    """
+    Splits the signature in bands and hashes each band to one 64-bit key.
+    Two texts with the same key in any band are near-duplicate candidates.
+    Output: array [texts x bands]
+
+    """
+    rows = signatures.shape[1] // bands
+    keys = np.empty((signatures.shape[0], bands), dtype=np.uint64)
+
+    with np.errstate(over="ignore"):
+        for band in range(bands):
+            # The band number is mixed in the key so the same values in different bands don't match
+            key = np.full(signatures.shape[0], np.uint64(band + 1) * np.uint64(0x9E3779B97F4A7C15), dtype=np.uint64)
+            for j in range(band * rows, (band + 1) * rows):
+                key = (key ^ signatures[:, j]) * np.uint64(0x100000001B3)
+            keys[:, band] = key
+
+    return keys
+
+
+class BucketSpill:
+
+    """
+    Writes (key, row_id) pairs to n_buckets parquet files on disk, by key.
+    All the rows with the same key end in the same bucket, so each bucket can
+    be processed alone in memory.
+
+    """
+
+    def __init__(self, spill_dir, n_buckets):
+        self.spill_dir = Path(spill_dir)
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        self.n_buckets = n_buckets
+        self.writers = {}
+        self.schema = pa.schema([("key", pa.uint64()), ("row_id", pa.int64())])
+
+    def path(self, bucket):
+        return self.spill_dir / f"bucket-{bucket:04d}.parquet"
+
+    def add(self, keys, row_ids):
+        buckets = keys % np.uint64(self.n_buckets)
+        order = np.argsort(buckets, kind="stable")
+        keys, row_ids, buckets = keys[order], row_ids[order], buckets[order]
+        bounds = np.searchsorted(buckets, np.arange(self.n_buckets + 1, dtype=np.uint64))
+
+        for bucket in range(self.n_buckets):
+            start, end = bounds[bucket], bounds[bucket + 1]
+            if start == end:
+                continue
+            if bucket not in self.writers:
+                self.writers[bucket] = pq.ParquetWriter(self.path(bucket), self.schema)
+            self.writers[bucket].write_table(pa.table([keys[start:end], row_ids[start:end]], schema=self.schema))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def buckets(self):
+        # Yields (keys, row_ids) of each bucket
+        for bucket in sorted(self.writers):
+            table = pq.read_table(self.path(bucket))
+            yield table["key"].to_numpy(), table["row_id"].to_numpy()
+
+
+def memmap_array(path, n_rows, dtype=np.int64, width=None):
+
+    """
+    Creates an array with one value per row saved on disk (memory-mapped).
+    width: values per row (2D array) or None for one value.
+
+    """
+    shape = (max(n_rows, 1),) if width is None else (max(n_rows, 1), width)
+    return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+def exact_groups(spill, canonical):
+
+    """
+    Exact duplicates: in each bucket the rows are sorted by hash and every row points
+    to the smallest row_id with the same hash (canonical row).
+
+    """
+    for keys, row_ids in spill.buckets():
+        order = np.lexsort((row_ids, keys))
+        keys, row_ids = keys[order], row_ids[order]
+
+        # First row of each group of equal hashes
+        is_first = np.ones(len(keys), dtype=bool)
+        is_first[1:] = keys[1:] != keys[:-1]
+        group_first = np.maximum.accumulate(np.where(is_first, np.arange(len(keys)), 0))
+
+        canonical[row_ids] = row_ids[group_first]
+
+
+def signature_similarity(signatures, rows, others, chunk=100000):
+
+    """
+    Share of equal MinHash values of each pair (rows[i], others[i]), an estimate of
+    the Jaccard similarity of their bigrams. Read in chunks, the signatures are on disk.
+
+    """
+    similarity = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), chunk):
+        a = signatures[rows[start:start + chunk]]
+        b = signatures[others[start:start + chunk]]
+        similarity[start:start + chunk] = np.mean(a == b, axis=1)
+    return similarity
+
+
+def candidate_representatives(spill, signatures, best, threshold):
+
+    """
+    Near duplicate candidates: in each group of rows with the same band key, every row is
+    compared with the smallest row_id of the group and, if their signatures are similar
+    enough, that row_id becomes its candidate representative (the smallest one of all its bands).
+
+    """
+    for keys, row_ids in spill.buckets():
+        order = np.lexsort((row_ids, keys))
+        keys, row_ids = keys[order], row_ids[order]
+
+        # Smallest row of each group of equal keys
+        is_first = np.ones(len(keys), dtype=bool)
+        is_first[1:] = keys[1:] != keys[:-1]
+        first = row_ids[np.maximum.accumulate(np.where(is_first, np.arange(len(keys)), 0))]
+
+        pair = first != row_ids
+        rows, others = row_ids[pair], first[pair]
+        if len(rows) == 0:
+            continue
+
+        similar = signature_similarity(signatures, rows, others) >= threshold
+        np.minimum.at(best, rows[similar], others[similar])
+
+
+def propagate_labels(spill, labels, signatures, threshold=0.8, max_rounds=100):
+
+    """
+    Near duplicates: every row is merged into a representative it was compared with,
+    never through a chain of matches (A like B and B like C doesn't put A with C).
+
+    The candidate representative of a row always has a smaller row_id. Each round the rows
+    whose candidate is already resolved take its representative: directly if the candidate is
+    a representative itself (already compared), after comparing the signatures otherwise.
+    A row that is not similar enough to that representative stays a text of its own.
+
+    labels: row_id of the representative of each row (starts with the row itself)
+
+    """
+    n_rows = len(labels)
+    best = memmap_array(Path(signatures.filename).with_name("best.npy"), n_rows)
+    best[:] = labels[:]
+
+    candidate_representatives(spill, signatures, best, threshold)
+
+    # Rows with a candidate, in row_id order
+    pending = []
+    for start in range(0, n_rows, 10_000_000):
+        rows = np.arange(start, min(start + 10_000_000, n_rows), dtype=np.int64)
+        pending.append(rows[best[rows] != rows])
+    pending = np.concatenate(pending)
+    merged = 0
+
+    for round_number in range(max_rounds):
+        if len(pending) == 0:
+            print(f"Near duplicates: {merged} rows merged after {round_number} rounds.")
+            del best
+            return
+
+        candidate = best[pending]
+
+        # Resolved: the candidate is not waiting for its own representative
+        position = np.minimum(np.searchsorted(pending, candidate), len(pending) - 1)
+        ready = pending[position] != candidate
+
+        rows, candidate = pending[ready], candidate[ready]
+        representative = labels[candidate]
+
+        # Candidate merged into another row: compare with that row before merging
+        accept = representative == candidate
+        check = ~accept
+        if np.any(check):
+            accept[check] = signature_similarity(signatures, rows[check], representative[check]) >= threshold
+
+        labels[rows[accept]] = representative[accept]
+        merged += int(np.count_nonzero(accept))
+        pending = pending[~ready]
+
+    print(f"WARNING: near duplicates not resolved after {max_rounds} rounds, "
+          f"{len(pending)} rows kept as texts of their own ({merged} rows merged).")
+    del best
+
+
+def dedup(near=True, num_perm=64, bands=8, min_tokens=5, threshold=0.8, n_buckets=64, batch_size=50000, seed=42):
+
+    """
+    Dedup stage over the spacy output.
+
+    near: also find near duplicates with MinHash/LSH (exact duplicates are always removed)
+    num_perm, bands: MinHash size and number of LSH bands. Two texts are candidates if all the
+                     values of one band match, roughly when the Jaccard similarity of their
+                     bigrams is over (1/bands)^(bands/num_perm) (about 0.77 with 64 and 8)
+    threshold: share of equal MinHash values needed to merge two candidates (estimated Jaccard)
+    min_tokens: texts with less words are only deduplicated exactly (at least 2, one bigram)
+    n_buckets: number of spill files (more buckets, less memory per bucket)
+
+    Output (data/processed/dedup):
+    - row_map.parquet: row_id, asin, source, overall, text_id for every input row
+    - unique_texts.parquet: text_id, clean_embedding_text, count (rows with this text)
+
+    """
+    files = spacy_files()
+
+    if len(files) == 0:
+        print("No spacy files to deduplicate in data/processed/spacy.")
+        return
+
+    n_rows = sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+    print(f"{len(files)} files found with {n_rows} rows.")
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    work_dir = output_dir / "_work"
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir()
+
+    # Step 1 - Hash every text and spill (hash, row_id) by bucket
+    print("Hashing texts...")
+    spill = BucketSpill(work_dir / "exact", n_buckets)
+    for first, batch in iter_texts(files, batch_size):
+        hashes = text_hashes(batch["clean_embedding_text"].to_pylist())
+        spill.add(hashes, np.arange(first, first + batch.num_rows, dtype=np.int64))
+    spill.close()
+
+    # Step 2 - Exact duplicates: canonical row of each row
+    canonical = memmap_array(work_dir / "canonical.npy", n_rows)
+    exact_groups(spill, canonical)
+    shutil.rmtree(work_dir / "exact")
+
+    # Flag of the canonical rows and labels for the near duplicates (each row starts with its own label)
+    is_canonical = memmap_array(work_dir / "is_canonical.npy", n_rows, dtype=bool)
+    labels = memmap_array(work_dir / "labels.npy", n_rows)
+    for start in range(0, n_rows, batch_size):
+        rows = np.arange(start, min(start + batch_size, n_rows), dtype=np.int64)
+        is_canonical[rows] = canonical[rows] == rows
+        labels[rows] = rows
+
+    print(f"Exact duplicates: {n_rows - int(np.count_nonzero(is_canonical[:n_rows]))} rows.")
+
+    # Step 3 - Near duplicates, only for the canonical texts
+
+    if near:
+        print("Computing MinHash signatures...")
+        a, b = minhash_parameters(num_perm, seed)
+        spill = BucketSpill(work_dir / "bands", n_buckets)
+
+        # Signature of every row (32 bits per value), to compare the candidates
+        signatures_file = memmap_array(work_dir / "signatures.npy", n_rows, dtype=np.uint32, width=num_perm)
+
+        for first, batch in iter_texts(files, batch_size):
+            rows = np.arange(first, first + batch.num_rows, dtype=np.int64)
+            keep = is_canonical[rows]
+            if not np.any(keep):
+                continue
+
+            texts = [t for t, k in zip(batch["clean_embedding_text"].to_pylist(), keep) if k]
+            positions, signatures = minhash_signatures(texts, a, b, min_tokens)
+            if len(positions) == 0:
+                continue
+
+            keys = band_keys(signatures, bands)
+            row_ids = np.repeat(rows[keep][positions], bands)
+            spill.add(keys.reshape(-1), row_ids)
+            signatures_file[rows[keep][positions]] = (signatures & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+
+        spill.close()
+        propagate_labels(spill, labels, signatures_file, threshold)
+        del signatures_file
+        shutil.rmtree(work_dir / "bands")
+
+    # Step 4 - text_id of every row: near duplicate group of its exact canonical row
+    # Count the rows of each text_id
+    counts = memmap_array(work_dir / "counts.npy", n_rows)
+    counts[:] = 0
+    for start in range(0, n_rows, batch_size):
+        text_ids = labels[canonical[start:start + batch_size]]
+        ids, c = np.unique(text_ids, return_counts=True)
+        counts[ids] += c
+
+    # Step 5 - Write the row map and the unique texts in input order
+    print("Writing row map and unique texts...")
+    row_map_writer = None
+    unique_writer = None
+    unique_count = 0
+
+    for first, batch in iter_texts(files, batch_size, columns=("clean_embedding_text", "asin", "source", "overall")):
+        rows = np.arange(first, first + batch.num_rows, dtype=np.int64)
+        text_ids = labels[canonical[rows]]
+
+        row_map = pa.table({
+            "row_id": rows,
+            "asin": batch["asin"],
+            "source": batch["source"],
+            "overall": batch["overall"],
+            "text_id": text_ids,
+        })
+        if row_map_writer is None:
+            row_map_writer = pq.ParquetWriter(output_dir / "row_map.parquet", row_map.schema, compression="snappy")
+        row_map_writer.write_table(row_map)
+
+        # The canonical text of a group is the row whose row_id is the text_id
+        is_unique = text_ids == rows
+        if np.any(is_unique):
+            unique = pa.table({
+                "text_id": rows[is_unique],
+                "clean_embedding_text": batch["clean_embedding_text"].filter(pa.array(is_unique)),
+                "count": counts[rows[is_unique]],
+            })
+            if unique_writer is None:
+                unique_writer = pq.ParquetWriter(output_dir / "unique_texts.parquet", unique.schema, compression="snappy")
+            unique_writer.write_table(unique)
+            unique_count += unique.num_rows
+
+    row_map_writer.close()
+    if unique_writer is not None:
+        unique_writer.close()
+
+    del canonical, labels, counts, is_canonical
+    gc.collect()
+    shutil.rmtree(work_dir)
+
+    print(f"{n_rows} rows, {unique_count} unique texts ({100 * (1 - unique_count / n_rows):.1f}% removed).")
+
+
+def fan_out(unique_ids, values, batch_size=50000):
+
+    """
+    Gives the results computed for the unique texts back to every row.
+
+    unique_ids: sorted array with the text_id of each result
+    values: dictionary {column: array aligned with unique_ids}
+
+    Yields tables with the row map columns (row_id, asin, source, overall, text_id)
+    plus the result columns, in input order.
+
+    """
+    unique_ids = np.asarray(unique_ids)
+
+    for batch in pq.ParquetFile(output_dir / "row_map.parquet").iter_batches(batch_size=batch_size):
+        table = pa.Table.from_batches([batch])
+        position = np.searchsorted(unique_ids, batch["text_id"].to_numpy())
+
+        for col, array in values.items():
+            table = table.append_column(col, pa.array(np.asarray(array)[position]))
+
+        yield table
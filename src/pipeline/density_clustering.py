@@ -0,0 +1,249 @@
+# Module to cluster with UMAP + HDBSCAN fitting only a sample
+
+"""
+
+UMAP and HDBSCAN don't scale to the whole corpus (time and memory grow faster than the
+number of rows), so the density clustering is done in two phases:
+
+    - Phase 1 (fit_density): UMAP and HDBSCAN are fitted on a stratified sample of the
+      embeddings (same share of every source x overall group, with a minimum per group)
+    - Phase 2 (assign_density): the rest of the rows are projected with the fitted UMAP
+      (transform) and assigned with hdbscan.approximate_predict, in chunks sent to a pool
+      of worker processes (all the cores)
+
+Output columns: cluster (-1 is noise), probability (strength of the assignment),
+membership (soft clustering, highest membership of the row) and outlier (True for noise).
+
+Output: data/clusters/<embeddings directory>/density/
+
+"""
+
+import time
+import joblib
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from multiprocessing import Pool, cpu_count
+
+import umap
+import hdbscan
+
+from src.pipeline.embedding import default_model, model_dir_for, open_embeddings, read_positions
+from src.pipeline.clustering import output_dir_for
+from src.pipeline.parallel import ordered_map
+from src.pipeline.memory import peak_rss_mb
+
+
+# Models loaded in each worker (initializer)
+worker_models = {}
+
+
+def density_dir_for(model_name):
+
+    """
+    Directory of the density clustering of one model (the embeddings of all the rows).
+
+    """
+    return output_dir_for(model_name) / "density"
+
+
+def stratified_sample(shards, sample_size, min_per_group=100, seed=42):
+
+    """
+    Chooses sample_size rows with the same share of each source x overall group as the
+    whole corpus. Small groups get at least min_per_group rows (or all their rows).
+    Only the source and overall columns of the index are read.
+
+    Output: sorted array with the positions of the rows (row order of the shards)
+
+    """
+    group_ids = {}
+    groups = []
+    for _, index_path in shards:
+        index = pq.read_table(index_path, columns=["source", "overall"])
+        sources = pc.fill_null(index["source"], "").combine_chunks().dictionary_encode()
+        ratings = pc.fill_null(index["overall"], 0).to_numpy()
+
+        # Groups of this shard (source code, overall) mapped to one number for all the shards
+        pairs, local = np.unique(np.stack([sources.indices.to_numpy(), ratings]), axis=1, return_inverse=True)
+        names = sources.dictionary.to_pylist()
+        mapping = np.array([group_ids.setdefault((names[int(code)], rating), len(group_ids)) for code, rating in pairs.T])
+        groups.append(mapping[local.reshape(-1)])
+
+    groups = np.concatenate(groups)
+
+    total = len(groups)
+    if sample_size >= total:
+        return np.arange(total)
+
+    # Positions sorted by group once (stable: row order inside each group), one slice per group
+    order = np.argsort(groups, kind="stable")
+    bounds = np.cumsum(np.bincount(groups))[:-1]
+
+    rng = np.random.default_rng(seed)
+    chosen = []
+    for positions in np.split(order, bounds):
+        size = max(int(round(sample_size * len(positions) / total)), min_per_group)
+        size = min(size, len(positions))
+        chosen.append(rng.choice(positions, size=size, replace=False))
+
+    return np.sort(np.concatenate(chosen))
+
+
+def fit_density(model_name=default_model, sample_size=200000, min_per_group=100, n_components=5,
+                n_neighbors=15, min_cluster_size=100, min_samples=None, seed=42):
+
+    """
+    Phase 1: fits UMAP and HDBSCAN on a stratified sample of the embeddings.
+
+    sample_size: rows of the sample (UMAP + HDBSCAN need a few minutes for ~200k rows)
+    n_components, n_neighbors: UMAP settings (a few dimensions is enough for HDBSCAN)
+    min_cluster_size, min_samples: HDBSCAN settings
+
+    The models are saved with joblib (umap.joblib, hdbscan.joblib).
+
+    """
+    shards = open_embeddings(model_name)
+    out_dir = density_dir_for(model_name)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    positions = stratified_sample(shards, sample_size, min_per_group, seed)
+    sample = read_positions(shards, positions)
+    print(f"Sample of {len(sample)} rows.")
+
+    begin = time.time()
+    reducer = umap.UMAP(n_components=n_components, n_neighbors=n_neighbors, min_dist=0.0,
+                        metric="cosine", random_state=seed)
+    reduced = reducer.fit_transform(sample)
+    print(f"UMAP fitted in {time.time() - begin:.0f} s")
+
+    begin = time.time()
+    # prediction_data is needed to assign new rows (approximate_predict, membership_vector)
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples, prediction_data=True)
+    clusterer.fit(reduced)
+    n_clusters = int(clusterer.labels_.max()) + 1
+    print(f"HDBSCAN fitted in {time.time() - begin:.0f} s: {n_clusters} clusters, "
+          f"{100 * np.mean(clusterer.labels_ == -1):.1f}% noise in the sample")
+
+    joblib.dump(reducer, out_dir / "umap.joblib")
+    joblib.dump(clusterer, out_dir / "hdbscan.joblib")
+    np.save(out_dir / "sample_positions.npy", positions)
+
+    print(f"Models saved in {out_dir}, peak RSS {peak_rss_mb():.0f} MB")
+
+
+def load_worker_models(model_dir, density_dir):
+
+    """
+    Pool initializer: every worker loads the models once (not once per chunk).
+
+    """
+    worker_models["reducer"] = joblib.load(density_dir / "umap.joblib")
+    worker_models["clusterer"] = joblib.load(density_dir / "hdbscan.joblib")
+    worker_models["model_dir"] = model_dir
+    worker_models["shard"] = None
+
+
+def worker_shard(vectors_file, index_file):
+
+    """
+    Vectors (memory-mapped) and index table of the shard of a chunk, opened once per worker
+    and reused while the chunks of the same shard arrive (the chunks are sent in shard order).
+    Only one shard is kept, the previous one is released when the next one is opened.
+
+    """
+    shard = worker_models["shard"]
+    if shard is None or shard[0] != (vectors_file, index_file):
+        model_dir = worker_models["model_dir"]
+        vectors = np.load(model_dir / vectors_file, mmap_mode="r")
+        index = pq.read_table(model_dir / index_file)
+        shard = ((vectors_file, index_file), vectors, index)
+        worker_models["shard"] = shard
+    return shard[1], shard[2]
+
+
+def assign_chunk(task):
+
+    """
+    Phase 2 for one chunk: UMAP transform + approximate_predict.
+    Input: tuple (vectors file, index file, start, end, soft)
+    Output: table with the index columns of the chunk + cluster, probability, membership, outlier
+
+    """
+    vectors_file, index_file, start, end, soft = task
+
+    vectors, index = worker_shard(vectors_file, index_file)
+    batch = np.asarray(vectors[start:end], dtype=np.float32)
+
+    reduced = worker_models["reducer"].transform(batch)
+    labels, probabilities = hdbscan.approximate_predict(worker_models["clusterer"], reduced)
+
+    # Soft clustering: highest membership of the row (the probability if there are no clusters)
+    if soft and worker_models["clusterer"].labels_.max() >= 0:
+        membership = hdbscan.membership_vector(worker_models["clusterer"], reduced).max(axis=1)
+    else:
+        membership = probabilities
+
+    table = index.slice(start, end - start)
+    table = table.append_column("cluster", pa.array(labels.astype(np.int32)))
+    table = table.append_column("probability", pa.array(probabilities.astype(np.float32)))
+    table = table.append_column("membership", pa.array(np.asarray(membership, dtype=np.float32)))
+    table = table.append_column("outlier", pa.array(labels == -1))
+
+    return table
+
+
+def assign_density(model_name=default_model, chunk_rows=20000, workers=None, max_in_flight=None, soft=True):
+
+    """
+    Phase 2: assigns every row with the fitted models, chunks in parallel.
+
+    chunk_rows: rows sent to a worker at once
+    workers: number of processes (default: all the cores)
+    soft: compute the membership column (soft clustering, slower with many clusters)
+
+    Output: density_clusters.parquet (row_id, asin, source, overall, cluster, probability, membership, outlier)
+
+    """
+    model_dir = model_dir_for(model_name)
+    out_dir = density_dir_for(model_name)
+    if not (out_dir / "hdbscan.joblib").exists():
+        print(f"No models in {out_dir}, run fit_density first.")
+        return
+
+    if workers is None:
+        workers = cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    # Chunks of every shard (only the file names are sent to the workers, not the vectors)
+    tasks = []
+    for vectors, index_path in open_embeddings(model_name):
+        for start in range(0, vectors.shape[0], chunk_rows):
+            end = min(start + chunk_rows, vectors.shape[0])
+            tasks.append((Path(vectors.filename).name, index_path.name, start, end, soft))
+
+    temp = out_dir / "density_clusters.parquet.tmp"
+    writer = None
+    rows = 0
+
+    begin = time.time()
+    with Pool(workers, initializer=load_worker_models, initargs=(model_dir, out_dir)) as p:
+        for table in ordered_map(p, assign_chunk, tasks, max_in_flight):
+            if writer is None:
+                writer = pq.ParquetWriter(temp, table.schema, compression="snappy")
+            writer.write_table(table)
+            rows += table.num_rows
+
+    if writer is None:
+        print("No embeddings to assign.")
+        return
+
+    writer.close()
+    temp.replace(out_dir / "density_clusters.parquet")
+
+    seconds = time.time() - begin
+    print(f"Assign: {rows} rows, {rows / max(seconds, 1e-9):.0f} rows/s with {workers} workers, "
+          f"peak RSS {peak_rss_mb():.0f} MB (main process)")
@@ -0,0 +1,426 @@
+# Module to create the embeddings of clean_embedding_text
+
+"""
+
+This module encodes the spacy output (clean_embedding_text) with a sentence-transformers
+model on CPU and saves the vectors so the clustering can read them without loading
+the whole corpus in memory.
+
+    - The rows are read in order from the <source>_spacy.parquet files (same row_id as dedup.py),
+      or only the unique texts of the dedup stage (dedup=True)
+    - Each window of texts is sorted by length and split in batches of similar length,
+      so there is almost no padding
+    - Vectors are saved in shards of shard_size rows: shard-00000.npy (float16, can be opened
+      with np.load(..., mmap_mode="r")) + shard-00000.index.parquet (row_id, asin, source, overall)
+    - Every text is looked up first in the embedding cache (embedding_cache.py), only the
+      texts that are not there are encoded
+    - _manifest.json records the finished shards. If the run is interrupted it continues
+      from the first shard that is not in the manifest
+
+Output: data/embeddings/<model name>/ (<model name>__dedup/ for the unique texts)
+
+"""
+
+import os
+import json
+import time
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.pipeline.dedup import spacy_files, output_dir as dedup_dir
+from src.pipeline.merge_parquet import save_json
+from src.pipeline.checkpoint import input_info
+from src.pipeline.embedding_cache import EmbeddingCache
+
+
+# Output for the embeddings (one directory per model)
+embeddings_dir = Path("data/embeddings")
+
+# Model used by default (small and fast on CPU)
+default_model = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Text column to encode
+text_col = "clean_embedding_text"
+
+# Start of the names of the lexical models (lexical_embedding.py), they are not sentence-transformers
+lexical_prefix = "hashing-svd-"
+
+
+def model_dir_for(model_name, dedup=False):
+
+    """
+    Directory of the embeddings of one model (the "/" of the model name is not valid in a path).
+    The embeddings of the unique texts (dedup=True) are saved apart from the ones of all the rows.
+
+    """
+    name = model_name.replace("/", "__")
+    if dedup:
+        name += "__dedup"
+    return embeddings_dir / name
+
+
+def load_model(model_name, threads=None):
+
+    """
+    Loads the sentence-transformers model on CPU.
+    threads: number of threads used by torch (None: torch default, all the cores)
+
+    """
+    # Imported here so the modules that only read the shards don't need torch
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+    return SentenceTransformer(model_name, device="cpu")
+
+
+def input_files(dedup=False):
+
+    """
+    Files to encode and the columns saved in the index.
+
+    dedup=False: all the rows of the spacy files, index with row_id, asin, source, overall
+    dedup=True: only the unique texts (unique_texts.parquet), index with text_id, count
+                (dedup.fan_out gives the results back to every row)
+
+    """
+    if dedup:
+        return [dedup_dir / "unique_texts.parquet"], ["text_id", "count"]
+
+    return spacy_files(), ["asin", "source", "overall"]
+
+
+def row_groups_of(files):
+
+    """
+    List of (file, row group, first row, rows) of all the files in order.
+    Used to read only the row groups of one shard.
+
+    """
+    row_groups = []
+    first = 0
+
+    for f_path in files:
+        metadata = pq.read_metadata(f_path)
+        for rg in range(metadata.num_row_groups):
+            rows = metadata.row_group(rg).num_rows
+            row_groups.append((f_path, rg, first, rows))
+            first += rows
+
+    return row_groups
+
+
+def read_rows(row_groups, start, end, columns):
+
+    """
+    Reads the rows [start, end) of the files (only the row groups needed).
+
+    """
+    tables = []
+
+    for f_path, rg, first, rows in row_groups:
+        if first + rows <= start or first >= end:
+            continue
+
+        table = pq.ParquetFile(f_path).read_row_group(rg, columns=columns)
+
+        # Only the part of the row group inside the range
+        offset = max(start - first, 0)
+        tables.append(table.slice(offset, min(end, first + rows) - first - offset))
+
+    return pa.concat_tables(tables)
+
+
+def length_batches(lengths, tokens_per_batch, max_batch_size):
+
+    """
+    Sorts the texts by length and splits them in batches with a limited number of tokens
+    (rows x longest text of the batch), so short texts go in big batches and long texts
+    in small ones. Output: list of arrays with the positions of each batch.
+
+    """
+    order = np.argsort(lengths, kind="stable")
+
+    batches = []
+    start = 0
+    for i in range(len(order)):
+        # The batch is padded to its longest text, the last one because they are sorted.
+        # A text longer than tokens_per_batch goes alone in its batch (never an empty one)
+        size = i - start + 1
+        if i > start and (size > max_batch_size or size * lengths[order[i]] > tokens_per_batch):
+            batches.append(order[start:i])
+            start = i
+
+    if start < len(order):
+        batches.append(order[start:])
+
+    return batches
+
+
+def encode_texts(model, texts, tokens_per_batch=16384, max_batch_size=256, normalize=True):
+
+    """
+    Encodes a list of texts in length-sorted batches.
+    The length is estimated with the number of words (+2 for the special tokens) and limited
+    to the maximum length of the model, the tokenizer is only run once inside encode.
+
+    Output: float32 array [texts x dim] in the same order as texts
+
+    """
+    max_length = model.max_seq_length or 512
+    lengths = np.array([min(len(t.split()) + 2, max_length) for t in texts], dtype=np.int64)
+
+    vectors = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    for positions in length_batches(lengths, tokens_per_batch, max_batch_size):
+        vectors[positions] = model.encode(
+            [texts[i] for i in positions],
+            batch_size=len(positions),
+            convert_to_numpy=True,
+            normalize_embeddings=normalize,
+            show_progress_bar=False,
+        )
+
+    return vectors
+
+
+def encode_cached(model, texts, cache, cache_name, encode_options):
+
+    """
+    Encodes a list of texts using the cache: the vectors found are not encoded again,
+    the rest are encoded (each different text once) and added to the cache.
+
+    Output: float16 array [texts x dim] in the same order as texts
+
+    """
+    keys = cache.keys(cache_name, texts)
+    found = cache.get_many(keys)
+
+    # Position of the first text of each key that is not in the cache
+    missing = {}
+    for i, key in enumerate(keys):
+        if key not in found and key not in missing:
+            missing[key] = i
+
+    if len(missing) > 0:
+        vectors = encode_texts(model, [texts[i] for i in missing.values()], **encode_options).astype(np.float16)
+        cache.put_many(list(missing), vectors)
+        found.update(zip(missing, vectors))
+
+    return np.stack([found[key] for key in keys])
+
+
+def shard_name(shard):
+
+    """
+    File names (vectors, index) of one shard.
+
+    """
+    return f"shard-{shard:05d}.npy", f"shard-{shard:05d}.index.parquet"
+
+
+def start_manifest(model_dir, settings):
+
+    """
+    Loads the manifest of the embeddings or creates a new one.
+    If the input files or the settings changed, the old shards are deleted.
+
+    """
+    path = model_dir / "_manifest.json"
+
+    if path.exists():
+        with open(path, "r") as f:
+            manifest = json.load(f)
+
+        if manifest.get("settings") == settings:
+            return manifest
+
+        print(f"Embeddings in {model_dir} are from a different input or settings. Starting from scratch...")
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    for old in model_dir.glob("shard-*"):
+        old.unlink()
+
+    manifest = {"settings": settings, "dim": None, "shards": []}
+    save_json(manifest, path)
+    return manifest
+
+
+def write_shard(model_dir, shard, table, index_cols, first_row, dim, encode_window, window_size):
+
+    """
+    Encodes the rows of one shard and saves the vectors and the index.
+    encode_window: function that returns the vectors [texts x dim] of a list of texts
+    Both files are written with temporary names and renamed, so a shard is complete or doesn't exist.
+
+    """
+    vectors_name, index_name = shard_name(shard)
+    temp_vectors = model_dir / (vectors_name + ".tmp")
+    temp_index = model_dir / (index_name + ".tmp")
+
+    # The vectors are written directly to the file (memory-mapped), window by window
+    vectors = np.lib.format.open_memmap(temp_vectors, mode="w+", dtype=np.float16, shape=(table.num_rows, dim))
+
+    texts = table[text_col]
+    for start in range(0, table.num_rows, window_size):
+        window = [t or "" for t in texts.slice(start, window_size).to_pylist()]
+        vectors[start:start + len(window)] = encode_window(window)
+
+    vectors.flush()
+    del vectors
+
+    # Index: row_id of every vector and the context columns
+    if "text_id" in index_cols:
+        index = table.select(index_cols)
+    else:
+        row_id = pa.array(np.arange(first_row, first_row + table.num_rows, dtype=np.int64))
+        index = table.select(index_cols).add_column(0, "row_id", row_id)
+    pq.write_table(index, temp_index, compression="snappy")
+
+    os.replace(temp_vectors, model_dir / vectors_name)
+    os.replace(temp_index, model_dir / index_name)
+
+    return {"file": vectors_name, "index": index_name, "start": first_row, "rows": table.num_rows}
+
+
+def embed(model_name=default_model, dedup=False, shard_size=100000, window_size=20000,
+          threads=None, tokens_per_batch=16384, max_batch_size=256, normalize=True,
+          use_cache=True, cache_max_gb=None):
+
+    """
+    Embedding stage: encodes clean_embedding_text and saves the vectors in shards.
+
+    model_name: sentence-transformers model
+    dedup: encode only the unique texts of the dedup stage
+    shard_size: rows per shard (each shard is one .npy file)
+    window_size: texts sorted by length together (bigger window, less padding, more memory)
+    threads: torch threads (None: all the cores)
+    tokens_per_batch, max_batch_size: size of each batch sent to the model
+    normalize: save unit-length vectors (cosine similarity = dot product)
+    use_cache: look up the texts in the embedding cache before encoding them
+    cache_max_gb: size limit of the cache (None: no limit)
+
+    """
+    files, index_cols = input_files(dedup)
+    files = [f for f in files if f.exists()]
+
+    if len(files) == 0:
+        print("No files to embed.")
+        return
+
+    model_dir = model_dir_for(model_name, dedup)
+
+    # Anything that changes the vectors or the row numbers is part of the settings
+    settings = {
+        "model": model_name,
+        "dedup": dedup,
+        "shard_size": shard_size,
+        "normalize": normalize,
+        "inputs": [input_info(f) for f in files],
+    }
+    manifest = start_manifest(model_dir, settings)
+
+    row_groups = row_groups_of(files)
+    total_rows = sum(rows for _, _, _, rows in row_groups)
+    n_shards = (total_rows + shard_size - 1) // shard_size
+    done = {part["start"] for part in manifest["shards"]}
+
+    print(f"{total_rows} rows in {n_shards} shards ({len(done)} already done).")
+    if len(done) == n_shards:
+        return
+
+    model = load_model(model_name, threads)
+    manifest["dim"] = model.get_sentence_embedding_dimension()
+
+    encode_options = {"tokens_per_batch": tokens_per_batch, "max_batch_size": max_batch_size, "normalize": normalize}
+
+    # Normalized and not normalized vectors are different, both are part of the cache key
+    cache = None
+    cache_name = f"{model_name}|normalize={normalize}"
+    if use_cache:
+        max_bytes = None if cache_max_gb is None else int(cache_max_gb * 1024 ** 3)
+        cache = EmbeddingCache(max_bytes=max_bytes)
+
+    def encode_window(window):
+        if cache is None:
+            return encode_texts(model, window, **encode_options)
+        return encode_cached(model, window, cache, cache_name, encode_options)
+
+    for shard in range(n_shards):
+        start = shard * shard_size
+        if start in done:
+            continue
+
+        end = min(start + shard_size, total_rows)
+        table = read_rows(row_groups, start, end, [text_col] + index_cols)
+
+        begin = time.time()
+        info = write_shard(model_dir, shard, table, index_cols, start, manifest["dim"], encode_window, window_size)
+        seconds = time.time() - begin
+
+        # The shard is recorded only after both files exist
+        manifest["shards"].append(info)
+        save_json(manifest, model_dir / "_manifest.json")
+
+        print(f"Shard {shard + 1}/{n_shards}: {info['rows']} rows ({info['rows'] / max(seconds, 1e-9):.0f} rows/s)")
+
+    if cache is not None:
+        stats = cache.stats()
+        cache.close()
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hit_rate']:.1f}% hit rate), "
+              f"{stats['entries']} vectors ({stats['size_mb']:.1f} MB)")
+
+    print(f"Embeddings saved in {model_dir}")
+
+
+def open_embeddings(model_name=default_model, dedup=False):
+
+    """
+    Opens the finished shards of a model without reading the vectors.
+    Output: list of (vectors, index path) in row order. vectors is a read-only
+    memory-mapped float16 array [rows x dim].
+
+    """
+    model_dir = model_dir_for(model_name, dedup)
+    with open(model_dir / "_manifest.json", "r") as f:
+        manifest = json.load(f)
+
+    shards = []
+    for info in sorted(manifest["shards"], key=lambda part: part["start"]):
+        vectors = np.load(model_dir / info["file"], mmap_mode="r")
+        shards.append((vectors, model_dir / info["index"]))
+
+    return shards
+
+
+def read_positions(shards, positions):
+
+    """
+    Reads only the vectors of the given positions (sorted, row order of all the shards)
+    from the memory-mapped shards (open_embeddings). Output: float32 array [positions x dim]
+
+    """
+    parts = []
+    first = 0
+    for vectors, _ in shards:
+        end = first + vectors.shape[0]
+        local = positions[(positions >= first) & (positions < end)] - first
+        if len(local) > 0:
+            parts.append(np.asarray(vectors[local], dtype=np.float32))
+        first = end
+    return np.concatenate(parts)
+
+
+def iter_embeddings(model_name=default_model, dedup=False, columns=None):
+
+    """
+    Yields (vectors, index table) shard by shard.
+    Only the shard being used is read from disk.
+
+    """
+    for vectors, index_path in open_embeddings(model_name, dedup):
+        yield vectors, pq.read_table(index_path, columns=columns)
@@ -0,0 +1,235 @@
+# Cache of the embeddings already computed
+
+"""
+
+Encoding is the slowest step of the pipeline, so every vector is saved in a local cache
+and a text that was already encoded (same model and same text) is never encoded again.
+
+    - One sqlite file (data/embeddings/cache.sqlite), no server needed
+    - Key: blake2b hash of the model name + normalized text (spaces collapsed)
+    - Vectors saved as float16 bytes (the same precision as the shards)
+    - get_many / put_many work with many keys at once (one query per block of keys)
+    - Hits and misses are counted (stats)
+    - The last use of the keys found is kept in memory and written with the next write of
+      the cache (put_many, evict, close) or every flush_every keys, not once per lookup
+    - Size limit: when the cache is bigger than max_bytes the least recently used
+      vectors are deleted
+
+"""
+
+import time
+import hashlib
+import sqlite3
+from pathlib import Path
+import numpy as np
+
+
+# Cache file
+cache_path = Path("data/embeddings/cache.sqlite")
+
+# sqlite limits the number of parameters of one query
+max_params = 900
+
+# Keys found by get_many whose last use is written at once
+flush_every = 50000
+
+
+def normalize_text(text):
+
+    """
+    Text used for the key: spaces at the start, end and repeated spaces don't change the key.
+
+    """
+    return " ".join((text or "").split())
+
+
+def text_key(model_name, text):
+
+    """
+    Key of one text for one model (16 bytes).
+
+    """
+    data = model_name.encode("utf-8") + b"\x00" + normalize_text(text).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class EmbeddingCache:
+
+    """
+    Embedding cache in a sqlite file.
+
+    path: sqlite file
+    max_bytes: size limit of the vectors saved (None: no limit)
+
+    """
+
+    def __init__(self, path=cache_path, max_bytes=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.conn = sqlite3.connect(self.path)
+        # WAL: faster writes and the cache can be read while it is written
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.commit()
+
+        # Counters of this session, added to the saved ones in close()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        # key: last use (ns) of the keys found and not written yet
+        self.used = {}
+
+        # Size of the saved vectors, kept up to date without reading the table again
+        self.entries, self.size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+
+    def keys(self, model_name, texts):
+        return [text_key(model_name, text) for text in texts]
+
+    def get_many(self, keys):
+
+        """
+        Looks up many keys. Output: dictionary {key: float16 vector} with the keys found.
+        The keys found are marked as used now (for the eviction), written later (flush_used).
+
+        """
+        unique = list(dict.fromkeys(keys))
+        found = {}
+
+        for i in range(0, len(unique), max_params):
+            block = unique[i:i + max_params]
+            query = f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(block))})"
+            for key, vector in self.conn.execute(query, block):
+                found[key] = np.frombuffer(vector, dtype=np.float16)
+
+        now = time.time_ns()
+        for key in found:
+            self.used[key] = now
+
+        if len(self.used) >= flush_every:
+            self.flush_used()
+            self.conn.commit()
+
+        # Hits and misses by text (a key repeated in keys counts every time)
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+
+        return found
+
+    def put_many(self, keys, vectors):
+
+        """
+        Saves the vectors of many keys (vectors: array [keys x dim]).
+        Keys already in the cache are not written again.
+
+        """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        now = time.time_ns()
+
+        rows = {}
+        for key, vector in zip(keys, vectors):
+            rows[key] = (key, vector.tobytes(), now)
+
+        # Written in the same transaction as the new vectors
+        self.flush_used()
+
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", list(rows.values())
+        )
+        self.conn.commit()
+
+        added = max(cursor.rowcount, 0)
+        self.entries += added
+        self.size += added * vectors.shape[1] * vectors.itemsize
+
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.evict()
+
+    def flush_used(self):
+
+        """
+        Writes the last use of the keys found since the last flush (one statement, the
+        caller commits). The keys deleted by an eviction are ignored by the UPDATE.
+
+        """
+        if len(self.used) == 0:
+            return
+        self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                              [(now, key) for key, now in self.used.items()])
+        self.used = {}
+
+    def evict(self):
+
+        """
+        Deletes the least recently used vectors until the cache is 90% of max_bytes
+        (a margin so it is not evicting after every put).
+
+        """
+        if self.entries == 0:
+            return
+
+        # The least recently used are chosen with the last uses of this session
+        self.flush_used()
+
+        target = int(0.9 * self.max_bytes)
+        row_bytes = self.size / self.entries
+        remove = int(np.ceil((self.size - target) / row_bytes))
+
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (remove,)
+        )
+        self.conn.commit()
+
+        self.entries, self.size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self.evicted += remove
+
+    def stats(self):
+
+        """
+        Hits, misses and hit rate (this session and all the sessions), entries and size.
+
+        """
+        saved = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+        total_hits = saved.get("hits", 0) + self.hits
+        total_misses = saved.get("misses", 0) + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "total_hits": total_hits,
+            "total_misses": total_misses,
+            "total_hit_rate": total_hits / max(total_hits + total_misses, 1),
+            "evicted": self.evicted,
+            "entries": self.entries,
+            "size_mb": self.size / 1024 ** 2,
+        }
+
+    def close(self):
+
+        """
+        Saves the last uses and the counters of the session and closes the file.
+
+        """
+        self.flush_used()
+        for name, value in [("hits", self.hits), ("misses", self.misses), ("evicted", self.evicted)]:
+            self.conn.execute(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value),
+            )
+        self.conn.commit()
+        self.conn.close()
@@ -12,16 +12,23 @@ This module is used for an adecuate data ingestion with the following parameters
 
 """
 
-import pandas as pd
+import time
 from pathlib import Path
+from collections import deque
 import pyarrow as pa
-import pyarrow.parquet as pq
-from multiprocessing import Pool, cpu_count
+import pyarrow.compute as pc
+from multiprocessing import cpu_count
 from src.load_data import multiple_files  
-from src.text.clean_text import clean, clean_group
-from src.text.lang_detection import is_english
+from src.raw_reader import read_raw_batches, raw_schema
+from src.text.clean_text import clean_column
+from src.text.lang_detection import is_english_batch
 from src.features.select_columns import split_columns
-from src.pipeline.merge_parquet import merge_par
+from src.pipeline.parallel import ordered_map
+from src.pipeline import metrics, profiling
+from src.pipeline.batch_budget import BatchSizer
+from src.pipeline.worker_init import make_pool
+from src.pipeline.checkpoint import start_checkpoint, commit, finish_checkpoint, part_name_for
+from src.pipeline.spacy_for_embedding import process_batch, context_columns, source_paths as spacy_paths
 
 
 
@@ -71,9 +78,9 @@ def processing_check():
     for f_path in raw_files:
         print(f"\nProcessing file {f_path.name}\n")
 
-        # First Step: Read file in chunks
+        # First Step: Read file in chunks (only the text and context columns are parsed)
         try:
-            read_chunk = pd.read_json(f_path, lines=True, chunksize=5000)  
+            read_chunk = read_raw_batches(f_path, batch_size=5000)  
         except Exception as e:
             print(f"ERROR: could not open file: {f_path.name}. Message: {e}")
             continue  # skip file if it cannot be read
@@ -81,25 +88,20 @@ def processing_check():
 
         for chunk in read_chunk:
             # Preview just the first chunk to check if it's working
-            print(f"{len(chunk)} rows loaded\n")
+            print(f"{chunk.num_rows} rows loaded\n")
 
             # Rows before processing
-            rows_before = len(chunk)
+            rows_before = chunk.num_rows
 
             # Second Step - apply cleaning function
-            chunk["clean_review"] = chunk["reviewText"].apply(clean)
-            chunk["clean_summary"] = chunk["summary"].apply(clean)
+            clean_review = clean_column(chunk["reviewText"])
 
             # Third step - Apply language detection function
             # Using the reviewText as reference to keep or discard based on language
-            chunk["is_english"] = chunk["clean_review"].apply(is_english) 
+            english = is_english_batch(clean_review)
 
             # Count how many reviews are in english
-            rows_after = 0 
-
-            for r in chunk["is_english"]:
-                if r == True:
-                    rows_after +=1
+            rows_after = sum(english)
 
             print(f"Original rows: {rows_before}")
             print(f"English reviews: {rows_after}")
@@ -110,9 +112,192 @@ def processing_check():
 
 
 
+# Process one chunk inside a worker process
+
+def process_chunk(task):
+
+    """
+    Worker function used by save_to_parquet. Receives a whole chunk and does all the
+    processing in the worker so the parent process only reads and writes:
+
+    - Clean reviewText and summary
+    - Detect language and keep only english reviews
+    - Select columns (select_columns.py)
+    - Convert to an arrow table ready for the writer
+
+    Input: tuple (chunk as Arrow record batch, source_name)
+    Output: pyarrow table or None if the chunk has no english reviews
+
+    """
+
+    chunk, source_name = task
+    metrics.add("rows_in", chunk.num_rows)
+
+    # First step - apply cleaning function (columnar, the whole column at once)
+    with metrics.phase("clean"):
+        clean_review = clean_column(chunk["reviewText"])
+        clean_summary = clean_column(chunk["summary"])
+
+    # Second step - Apply language detection function
+    # Using the reviewText as reference to keep or discard based on language
+    # All the reviews of the chunk are detected in one call and filtered with one mask
+    with metrics.phase("detect"):
+        is_english = pa.array(is_english_batch(clean_review), type=pa.bool_())
+
+    # Skip empty chunks to avoid writing empty data
+    if not pc.any(is_english).as_py():
+        return None
+
+    # Third step - Use the select_columns module to pick the context columns
+    cols_dict = split_columns(chunk.schema.names)
+    context = cols_dict["context"]
+
+    # Select columns of the process
+    columns = {"clean_review": clean_review, "clean_summary": clean_summary, "reviewText": chunk["reviewText"]}
+    for col in context:
+        columns[col] = chunk[col]
+
+    # Source column to keep track of the original category of the review
+    columns["source"] = pa.array([source_name] * chunk.num_rows, type=pa.string())
+
+    # Fourth step - Build the arrow table for the writer and filter only english
+    table = pa.table(columns).filter(is_english)
+    metrics.add("rows_out", table.num_rows)
+    return table
+
+
+# Process one chunk from raw text to embedding text (fused mode)
+
+def process_chunk_fused(task):
+
+    """
+    Worker function used by save_for_embedding. Does the ingestion (process_chunk) and the
+    spacy stage (spacy_for_embedding.process_batch) for the same chunk in one pass, so the
+    text doesn't need to be written and read again between the two stages.
+
+    Input: tuple (chunk as Arrow record batch, source_name, keep_intermediate)
+    Output: list [embedding table, ingestion table or None]
+
+    """
+    chunk, source_name, keep_intermediate = task
+
+    table = process_chunk((chunk, source_name))
+
+    # Chunk without english reviews
+    if table is None:
+        return [None, None]
+
+    # Join summary and review and process with spacy
+    embedding_table = process_batch(table)
+
+    # The ingestion table is only returned if the intermediate file is needed
+    if keep_intermediate:
+        return [embedding_table, table]
+    return [embedding_table, None]
+
+
+# Process one raw file with the workers
+
+def ingest_file(p, f_path, worker, make_task, outputs, settings, batch_size, max_in_flight, stage_metrics, sizer=None):
+
+    """
+    Reads one raw file in chunks, processes them in the pool and commits the results in order.
+    Used by save_to_parquet and save_for_embedding.
+
+    p: pool of worker processes
+    worker: function that processes one task in the workers (process_chunk, process_chunk_fused)
+    make_task: function that receives (chunk, source_name) and returns the task for the worker
+    outputs: list of (final_parquet, temp_parquet, parts_dir), one per table returned by the worker
+    settings: saved in the checkpoints (checkpoint.py)
+    stage_metrics: StageMetrics of the run (metrics.py), records every chunk
+    sizer: BatchSizer of the memory budget (batch_budget.py), None to use batch_size
+
+    """
+    source_name = f_path.stem 
+
+    # Load the checkpoint of each output of an interrupted run (or create new ones)
+    manifests = [start_checkpoint(parts_dir, f_path, settings) for _, _, parts_dir in outputs]
+
+    # If one output was committed before the other, continue from the one that is behind
+    # (the chunks of the output that is ahead are not committed again)
+    start = min(manifest["position"] for manifest in manifests) # byte offset of the first chunk not committed
+
+    if start > 0:
+        print(f"{source_name} was interrupted. Resuming from byte {start}...")
+
+    # First Step: Read file in chunks (only the text and context columns are parsed)
+    try:
+        # With a memory budget the size of every chunk comes from the sizer (bytes and rows)
+        limits = sizer.limits if sizer is not None else None
+        read_chunk = read_raw_batches(f_path, batch_size=batch_size, start_offset=start, offsets=True, limits=limits)  
+    except Exception as e:
+        print(f"ERROR: could not open file: {f_path.name}. Message: {e}")
+        return  # skip file if it cannot be read
+
+    # Input range (and read time) of each chunk sent to the workers, in the same order
+    ranges = deque()
+
+    def chunk_tasks():
+        chunk_start = start
+        begin = time.perf_counter()
+        for chunk, chunk_end in read_chunk:
+            ranges.append((chunk_start, chunk_end, time.perf_counter() - begin))
+            chunk_start = chunk_end
+            # Each task is a whole chunk, the chunks are read only when there is space in the window
+            # The worker runs with run_with_metrics, so the metrics of the chunk come back with the result
+            yield (worker, make_task(chunk, source_name))
+            begin = time.perf_counter()
+
+    # Results come back in the same order the chunks were read
+    for result, chunk_metrics in ordered_map(p, metrics.run_with_metrics, chunk_tasks(), max_in_flight):
+
+        chunk_start, chunk_end, read_seconds = ranges.popleft()
+
+        # The worker returns one table or a list with one table per output
+        if not isinstance(result, list):
+            result = [result]
+
+        # Append chunk and save the position of the next one
+        # A chunk without english reviews is committed anyway (the position moves)
+        begin = time.perf_counter()
+        bytes_written = 0
+        for table, manifest, (_, _, parts_dir) in zip(result, manifests, outputs):
+            if chunk_start >= manifest["position"]:
+                commit(manifest, parts_dir, [table], chunk_start, chunk_end)
+                part = Path(parts_dir) / part_name_for(chunk_start)
+                if part.exists():
+                    bytes_written += part.stat().st_size
+
+        stage_metrics.record(source_name, chunk_metrics, read=read_seconds, write=time.perf_counter() - begin,
+                             bytes_read=chunk_end - chunk_start, bytes_written=bytes_written)
+
+        # The RSS of the worker changes the size of the next chunks
+        if sizer is not None:
+            sizer.observe(chunk_metrics, chunk_end - chunk_start)
+
+    # Copy the parts to the final parquet (temporary name first and then renamed)
+    for manifest, (final_parquet, temp_parquet, parts_dir) in zip(manifests, outputs):
+        if finish_checkpoint(manifest, parts_dir, final_parquet, temp_parquet):
+            print(f"\nFile {final_parquet} generated successfully.")
+
+    if source_name in stage_metrics.sources:
+        stage_metrics.progress(source_name)
+
+
+    """
+        DISCLAIMER - MEMORY MANAGEMENT
+        Explicit memory release was not used:
+            - after each iteration the chunk is overwritten
+            - the number of chunks in memory is limited by max_in_flight
+            - the output is saved chunk by chunk in the parts, not kept in memory
+            - for bigger chunk management memory release options should be considered
+         
+    """
+
+
 #Save english cleaned rows in a file to use in embedding
 
-def save_to_parquet():
+def save_to_parquet(workers=None, max_in_flight=None, batch_size=50000, memory_budget_mb=None):
 
     """
 
@@ -123,6 +308,21 @@ def save_to_parquet():
     - Select columns (select_columns.py)
     - Save to a single Parquet file
 
+    The parent process only reads the chunks and writes the results. Cleaning, language
+    detection and column selection run in the worker processes (process_chunk) with 
+    whole chunks, and the results are written in the same order they were read.
+
+    workers: number of processes (default: all the cpu cores)
+    max_in_flight: maximum number of chunks in memory at the same time (default: 2 per worker)
+    batch_size: rows per chunk
+    memory_budget_mb: memory of the run (parent and workers) instead of batch_size, the size of
+                      every chunk is calculated from the bytes per row and the RSS of the workers
+                      (batch_budget.py)
+
+    If a file was interrupted, the next run continues from the last committed chunk and
+    the final parquet is the same as the one of an uninterrupted run (with memory_budget_mb the
+    rows are the same but the row groups can be different).
+
     """
 
     # List files
@@ -134,111 +334,135 @@ def save_to_parquet():
          print("No files to process in data/raw.")
          return None # Break function if raw is empty
 
+    if workers is None:
+        workers = cpu_count() # cpu_count returns cpu in system
+
+    # Keep a few chunks ready for each worker so they don't wait for the reader,
+    # but not more, so the memory doesn't grow if the writer is slower
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    # The settings are saved so a checkpoint is only used with the same chunk size and columns
+    # With a memory budget the chunks always start at the committed byte offset, any budget can resume
+    settings = {"batch_size": batch_size if memory_budget_mb is None else "budget", "columns": raw_schema().names}
+    sizer = BatchSizer(memory_budget_mb, workers) if memory_budget_mb is not None else None
+
     # Start processing 
     print("Processing started...")
 
-    #Initialize one pool per file
-    p = Pool(cpu_count()) # cpu_count returns cpu in system
-    for f_path in raw_files:
+    # Rows, bytes and time of every chunk (data/metrics, see metrics.py)
+    stage_metrics = metrics.StageMetrics("ingestion")
 
-        # Initialize writer as none before the for loop. Should be as none because the df is the chunk 
-        writer = None
+    # Profile of this process if PIPELINE_PROFILE is set (profiling.py), the workers profile their chunks
+    profiler = profiling.start_process("save_to_parquet")
 
-        print(f"\nProcessing file {f_path.name}\n")
+    # Initialize one pool for all the files, closed at the end with the context manager
+    # The workers start with the fasttext model loaded (worker_init.py)
+    with make_pool(workers, ["fasttext"]) as p:
+        for f_path in raw_files:
+
+            print(f"\nProcessing file {f_path.name}\n")
+
+            # Since processing everything in just one file takes to long the cleaned columns will be saved in different files
+            final_parquet, temp_parquet, parts_dir = ingestion_paths(f_path)
+
+            # Check if final file exists so we can skip that one and clean the next
+            if final_parquet.exists():
+                print(f"{f_path.stem} already processed. Moving to the next file.")
+                continue
+
+            ingest_file(p, f_path, process_chunk, lambda chunk, source_name: (chunk, source_name),
+                        [(final_parquet, temp_parquet, parts_dir)], settings, batch_size, max_in_flight,
+                        stage_metrics, sizer)
+
+    profiling.stop_process(profiler)
+    stage_metrics.finish()
+    if sizer is not None:
+        sizer.report("ingestion")
 
-        # Since processing everything in just one file takes to long the cleaned columns will be saved in different files
 
-        source_name = f_path.stem 
+# Save embedding text directly from the raw files (fused mode)
+
+def save_for_embedding(workers=None, max_in_flight=None, batch_size=50000, keep_intermediate=False, memory_budget_mb=None):
+
+    """
+
+    Fused pipeline, raw files to embedding text in one pass:
+    - Read chunks
+    - Clean and filter only english reviews
+    - Join summary and review and process with spacy
+    - Save to data/processed/spacy/<source>_spacy.parquet (same file as spacy_for_embedding)
+
+    The intermediate file of save_to_parquet (data/processed/<source>.parquet) is only
+    written if keep_intermediate is True.
+
+    Same parameters as save_to_parquet. Interrupted files continue from the last committed chunk.
+
+    """
+
+    # List files
+    raw_files = multiple_files()
     
-        # If the file processing is interrupted the info will be saved in a temporary file to avoid skipping parts of the dataset
-        # If the file is processed completly it will change names to final
-        final_parquet = output_dir / f"{source_name}.parquet"
-        temp_parquet = output_dir / f"{source_name}.temp.parquet"
-
-        # Check if final file exists so we can skip that one and clean the next
-        if final_parquet.exists():
-            print(f"{source_name} already processed. Moving to the next file.")
-            continue
-
-        # If there is a temporary file, it needs to be deleted and start from scratch
-        if temp_parquet.exists():
-            print(f"{temp_parquet} incomplete. Starting from scratch...")
-            temp_parquet.unlink()  # Delete temporary file
-
-        # First Step: Read file in chunks
-        try:
-            read_chunk = pd.read_json(f_path, lines=True, chunksize=50000)  
-        except Exception as e:
-            print(f"ERROR: could not open file: {f_path.name}. Message: {e}")
-            continue  # skip file if it cannot be read
+    # Verify raw_files is not empty 
 
-        
-        # Read chunks one by one
-        for chunk in read_chunk:
+    if len(raw_files) == 0: 
+         print("No files to process in data/raw.")
+         return None # Break function if raw is empty
 
-            # Print to check where is taking long
-            #print("Cleaning started")
+    if workers is None:
+        workers = cpu_count() # cpu_count returns cpu in system
 
-            # Second Step - apply cleaning function
-            chunk["clean_review"] = clean_group(chunk["reviewText"].tolist())
-            chunk["clean_summary"] = clean_group(chunk["summary"].tolist())
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
 
-            # Print to check where is takinkg long
-            #print("Language detecting started")
+    # The spacy output columns are saved too, so parts with an older output schema are not reused
+    settings = {"batch_size": batch_size if memory_budget_mb is None else "budget", "columns": raw_schema().names,
+                "fused": True, "output_columns": ["clean_embedding_text"] + context_columns}
+    sizer = BatchSizer(memory_budget_mb, workers) if memory_budget_mb is not None else None
 
-            # Third step - Apply language detection function
-            # Using the reviewText as reference to keep or discard based on language
-            chunk["is_english"] = p.map(is_english, chunk["clean_review"].tolist())
+    # Start processing 
+    print("Processing started (fused mode)...")
+
+    # Rows, bytes and time of every chunk (data/metrics, see metrics.py)
+    stage_metrics = metrics.StageMetrics("fused")
+
+    # Profile of this process if PIPELINE_PROFILE is set (profiling.py), the workers profile their chunks
+    profiler = profiling.start_process("save_for_embedding")
 
-            # Filter only english
-            chunk = chunk[chunk["is_english"]]
+    # The workers start with the fasttext model and the spacy pipeline loaded (worker_init.py)
+    with make_pool(workers, ["fasttext", "spacy"]) as p:
+        for f_path in raw_files:
 
-            # Skip empty chunks to avoid writing empty data
-            if len(chunk) == 0:
-                print("Chunk skipped (no english reviews)")
+            print(f"\nProcessing file {f_path.name}\n")
+
+            # Same output names as spacy_for_embedding (source name without extensions)
+            outputs = [spacy_paths(Path(f_path.stem).with_suffix(".parquet"))[1:]]
+            if keep_intermediate:
+                outputs.append(ingestion_paths(f_path))
+
+            # Check if the final files exist so we can skip that one and clean the next
+            if all(final_parquet.exists() for final_parquet, _, _ in outputs):
+                print(f"{f_path.stem} already processed. Moving to the next file.")
                 continue
 
-            # Source column to keep track of the original category of the review
-            chunk["source"] = f_path.stem
+            ingest_file(p, f_path, process_chunk_fused, lambda chunk, source_name: (chunk, source_name, keep_intermediate),
+                        outputs, settings, batch_size, max_in_flight, stage_metrics, sizer)
 
-            # Step 4 - Use the select_columns module to pick the context columns
-            cols_dict = split_columns(chunk.columns)
-            context = cols_dict["context"]
+    profiling.stop_process(profiler)
+    stage_metrics.finish()
+    if sizer is not None:
+        sizer.report("fused")
 
-            # Select columns of the process
-            selected_cols = ["clean_review", "clean_summary", "reviewText"] + context + ["source"]
-            chunk = chunk[selected_cols]
 
-            # Step 5 -  Convert dataframe to table that works with writer
-            table = pa.Table.from_pandas(chunk)
+def ingestion_paths(f_path):
 
-            # Step 6 - Check if the file is empty or not
-            if writer is None: # is None on the first chunk iteration
-                # Parquet writer: parquet.ParquetWriter(where, schema (table already created), 
-                # compression (default is snappy), write_statistics (not needed, default = True),
-                print(f"\nWriting in {temp_parquet} started.")
-                writer = pq.ParquetWriter(temp_parquet, table.schema, compression="snappy", write_statistics=False)
-        
-            # Step 7  Append chunk
-            writer.write_table(table)
-
-        # Close writer 
-        if writer: # First check if it changed from None to a writer object
-            writer.close()
-            # change the name to the final parquet
-            temp_parquet.rename(final_parquet)
-        else: # by the end the file is empty it needs to be deleted
-            if temp_parquet.exists(): 
-                temp_parquet.unlink()
-
-
-        """
-            DISCLAIMER - MEMORY MANAGEMENT
-            Explicit memory release was not used:
-                - after each iteration the chunk is overwritten
-                - small chunksize
-                - for bigger chunk management memory release options should be considered
-             
-        """
-    print(f"\nFile {final_parquet} generated successfully.")
+    """
+    Output paths of save_to_parquet for a raw file: final, temporary and parts directory.
+    Each processed chunk is committed to <source>.parts with a checkpoint (checkpoint.py)
 
+    """
+    source_name = f_path.stem 
+    final_parquet = output_dir / f"{source_name}.parquet"
+    temp_parquet = output_dir / f"{source_name}.temp.parquet"
+    parts_dir = output_dir / f"{source_name}.parts"
+    return final_parquet, temp_parquet, parts_dir
@@ -0,0 +1,398 @@
+# Module to label the clusters with their most representative terms
+
+"""
+
+Labels for every cluster with class-based TF-IDF (c-TF-IDF): all the texts of a
+cluster are treated as one document and the terms that are frequent in the cluster
+but not in the rest of the clusters get the highest score.
+
+    - One pass over clean_embedding_text (spacy output) and the cluster of each row
+      (clusters.parquet of clustering.py, or density_clusters.parquet of density_clustering.py
+      with density=True, its noise rows (-1) are not counted in any cluster)
+    - Each batch is counted with CountVectorizer (unigrams and bigrams), the counts are added
+      by cluster and saved in one sparse matrix [clusters x terms] with a global vocabulary
+    - Incremental: the counts and the cluster of every row are saved, when the clusters change
+      only the rows that moved to another cluster are counted again
+    - KeyBERT (optional): reranks only the top candidates of each cluster using the
+      centroid as the document embedding (no review is embedded again)
+
+Output: data/clusters/<embeddings directory>/labels/labels.parquet
+        (cluster, rows, label, terms, scores), density/labels/ for the density clusters
+
+"""
+
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
+
+from src.pipeline.dedup import spacy_files, iter_texts
+from src.pipeline.embedding import default_model
+from src.pipeline.clustering import output_dir_for, load_model as load_centroids
+from src.pipeline.checkpoint import input_info
+from src.pipeline.merge_parquet import save_json
+
+
+def labels_dir_for(model_name, dedup=False, density=False):
+
+    """
+    Directory of the labels of one clustering (k-means, or density clusters with density=True).
+
+    """
+    if density:
+        return output_dir_for(model_name, dedup) / "density" / "labels"
+    return output_dir_for(model_name, dedup) / "labels"
+
+
+def count_clusters(clusters_path, batch_size):
+
+    """
+    Number of clusters of a clusters file without a model (density clusters): largest id + 1.
+
+    """
+    largest = -1
+    for clusters in iter_cluster_ids(clusters_path, batch_size):
+        if len(clusters) > 0:
+            largest = max(largest, int(clusters.max()))
+    return largest + 1
+
+
+def iter_cluster_ids(clusters_path, batch_size):
+
+    """
+    Yields the cluster column of clusters.parquet (numpy arrays) in row order.
+
+    """
+    for batch in pq.ParquetFile(clusters_path).iter_batches(batch_size=batch_size, columns=["cluster"]):
+        yield batch["cluster"].to_numpy(zero_copy_only=False)
+
+
+def take_rows(chunks, buffer, n):
+
+    """
+    Takes exactly n values from the chunks iterator (the batches of the texts and of the
+    clusters don't have the same size). buffer keeps the values not used yet.
+
+    """
+    while sum(len(b) for b in buffer) < n:
+        buffer.append(next(chunks))
+
+    values = np.concatenate(buffer) if len(buffer) > 1 else buffer[0]
+    buffer.clear()
+    if len(values) > n:
+        buffer.append(values[n:])
+    return values[:n]
+
+
+def batch_counts(texts, clusters, vocab, n_clusters, ngram_range, sign=1):
+
+    """
+    Term counts of a batch added by cluster.
+    New terms are added to vocab (term: global id).
+
+    Output: sparse COO matrix [clusters x global ids] (None if the batch has no terms)
+
+    """
+    keep = clusters >= 0 # -1: no cluster (noise)
+    texts = [t or "" for t, k in zip(texts, keep) if k]
+    clusters = clusters[keep]
+    if len(texts) == 0:
+        return None
+
+    # sklearn is only imported here, so the query layer can import labels_dir_for fast
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    # The spacy output is already lowercase and lemmatized, words of one letter are kept (no, ok...)
+    vectorizer = CountVectorizer(ngram_range=ngram_range, token_pattern=r"(?u)\b\w+\b", lowercase=False)
+    try:
+        counts = vectorizer.fit_transform(texts)
+    except ValueError: # Only empty texts
+        return None
+
+    local_terms = vectorizer.get_feature_names_out()
+    global_ids = np.array([vocab.setdefault(term, len(vocab)) for term in local_terms], dtype=np.int64)
+
+    # Sum of the rows of each cluster: one-hot [clusters x rows] @ counts [rows x terms]
+    onehot = sparse.csr_matrix(
+        (np.full(len(clusters), sign, dtype=np.int64), (clusters, np.arange(len(clusters)))),
+        shape=(n_clusters, len(clusters)),
+    )
+    by_cluster = (onehot @ counts).tocoo()
+
+    return sparse.coo_matrix((by_cluster.data, (by_cluster.row, global_ids[by_cluster.col])))
+
+
+def add_counts(total, parts, n_clusters, n_terms):
+
+    """
+    Adds the batch counts to the total matrix (the vocabulary may have grown).
+
+    """
+    shape = (n_clusters, n_terms)
+    if len(parts) > 0:
+        rows = np.concatenate([p.row for p in parts])
+        cols = np.concatenate([p.col for p in parts])
+        data = np.concatenate([p.data for p in parts])
+        new = sparse.csr_matrix((data, (rows, cols)), shape=shape)
+    else:
+        new = sparse.csr_matrix(shape, dtype=np.int64)
+
+    parts.clear()
+    if total is None:
+        return new
+
+    total = total.tocsr()
+    total.resize(shape)
+    return total + new
+
+
+def ctfidf(counts, min_count=5):
+
+    """
+    Class-based TF-IDF: tf of the term in the cluster x log(1 + average words per cluster / frequency of the term in all the clusters)
+    Terms with less than min_count occurrences in all the corpus get score 0.
+
+    """
+    counts = counts.tocsr().astype(np.float64)
+
+    words_per_cluster = np.asarray(counts.sum(axis=1)).ravel()
+    term_totals = np.asarray(counts.sum(axis=0)).ravel()
+
+    average_words = words_per_cluster.mean() if len(words_per_cluster) > 0 else 0
+    idf = np.log(1 + average_words / np.maximum(term_totals, 1))
+    idf[term_totals < min_count] = 0
+
+    tf = sparse.diags(1 / np.maximum(words_per_cluster, 1)) @ counts
+    return (tf @ sparse.diags(idf)).tocsr()
+
+
+def top_terms(scores, terms, top_n):
+
+    """
+    Top top_n terms of each cluster (row of the scores matrix).
+    Output: list of (terms, scores) by cluster
+
+    """
+    output = []
+    for cluster in range(scores.shape[0]):
+        row = scores.getrow(cluster)
+        order = np.argsort(-row.data, kind="stable")[:top_n]
+        order = order[row.data[order] > 0]
+        output.append(([terms[i] for i in row.indices[order]], row.data[order].tolist()))
+    return output
+
+
+def keybert_rerank(model_name, centroids, candidates, top_k):
+
+    """
+    Reranks the candidate terms of each cluster with KeyBERT.
+    The centroid is the document embedding, so only the candidate terms are embedded.
+
+    """
+    from keybert import KeyBERT
+    from src.pipeline.embedding import load_model
+
+    kw_model = KeyBERT(model=load_model(model_name))
+
+    reranked = []
+    for cluster, terms in enumerate(candidates):
+        if len(terms) == 0:
+            reranked.append([])
+            continue
+        keywords = kw_model.extract_keywords(
+            " ".join(terms),
+            candidates=terms,
+            keyphrase_ngram_range=(1, 2),
+            top_n=top_k,
+            doc_embeddings=centroids[cluster:cluster + 1],
+        )
+        reranked.append([term for term, _ in keywords])
+
+    return reranked
+
+
+def load_state(labels_dir, settings):
+
+    """
+    Loads the saved counts, vocabulary and clusters of the last run if the settings match.
+    Output: (counts, vocab) or (None, {}) if there is nothing to reuse.
+
+    """
+    path = labels_dir / "_state.json"
+    if not path.exists():
+        return None, {}
+
+    with open(path, "r") as f:
+        state = json.load(f)
+
+    if state.get("settings") != settings or not (labels_dir / "clusters_used.npy").exists():
+        return None, {}
+
+    counts = sparse.load_npz(labels_dir / "counts.npz")
+    terms = pq.read_table(labels_dir / "vocab.parquet")["term"].to_pylist()
+    return counts, {term: i for i, term in enumerate(terms)}
+
+
+def save_state(labels_dir, counts, vocab, settings):
+
+    """
+    Saves the counts and the vocabulary (temporary names and rename), _state.json last.
+
+    """
+    temp = labels_dir / "counts.tmp.npz"
+    sparse.save_npz(temp, counts.tocsr())
+    os.replace(temp, labels_dir / "counts.npz")
+
+    temp = labels_dir / "vocab.parquet.tmp"
+    pq.write_table(pa.table({"term": pa.array(list(vocab), type=pa.string())}), temp)
+    os.replace(temp, labels_dir / "vocab.parquet")
+
+    save_json({"settings": settings, "terms": len(vocab)}, labels_dir / "_state.json")
+
+
+def label_clusters(model_name=default_model, dedup=False, batch_size=50000, ngram_range=(1, 2),
+                   top_n=10, label_terms=3, min_count=5, keybert_top=0, compact_every=20, density=False):
+
+    """
+    Labeling stage: c-TF-IDF top terms of every cluster.
+
+    ngram_range: (1, 2) unigrams and bigrams
+    top_n: terms saved by cluster (also the KeyBERT candidates)
+    label_terms: terms joined in the label column
+    min_count: terms with less occurrences in the corpus are not used
+    keybert_top: if > 0 the top_n candidates are reranked with KeyBERT and the label uses the first keybert_top
+    compact_every: batches added to the sparse total at once
+    density: label the density clusters (density_clustering.py, only without dedup) instead of k-means
+
+    """
+    if density and dedup:
+        print("The density clusters are only computed without dedup.")
+        return
+
+    if density:
+        clusters_path = output_dir_for(model_name) / "density" / "density_clusters.parquet"
+    else:
+        clusters_path = output_dir_for(model_name, dedup) / "clusters.parquet"
+    if not clusters_path.exists():
+        print(f"{clusters_path} not found, run the clustering first.")
+        return
+
+    # The k-means model has the number of clusters and the centroids (KeyBERT), the density
+    # clusters only have the cluster of every row
+    saved = None
+    if density:
+        n_clusters = count_clusters(clusters_path, batch_size)
+        if keybert_top > 0:
+            print("KeyBERT needs the centroids of k-means, the density clusters use the c-TF-IDF terms.")
+            keybert_top = 0
+    else:
+        saved = load_centroids(output_dir_for(model_name, dedup))
+        if saved is None:
+            print(f"No model (_model.json) in {output_dir_for(model_name, dedup)}, run the clustering first.")
+            return
+        n_clusters = saved[2]["n_clusters"]
+
+    files = spacy_files()
+    n_rows = sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+
+    labels_dir = labels_dir_for(model_name, dedup, density)
+    labels_dir.mkdir(parents=True, exist_ok=True)
+
+    # The saved counts can be reused only with the same texts (same rows) and settings
+    settings = {
+        "inputs": [input_info(f) for f in files],
+        "n_clusters": n_clusters,
+        "ngram_range": list(ngram_range),
+    }
+    counts, vocab = load_state(labels_dir, settings)
+    incremental = counts is not None
+
+    # _state.json is written again only when all the files are saved, if this run
+    # is interrupted the next one counts all the rows
+    (labels_dir / "_state.json").unlink(missing_ok=True)
+
+    # Cluster of every row used for the counts (written to a temporary file and renamed
+    # with the counts, so an interrupted run never leaves counts and clusters out of sync)
+    used_path = labels_dir / "clusters_used.npy"
+    used = np.lib.format.open_memmap(labels_dir / "clusters_used.tmp.npy", mode="w+", dtype=np.int32, shape=(max(n_rows, 1),))
+    if incremental:
+        old_used = np.load(used_path, mmap_mode="r")
+        print("Updating the saved counts (only the rows that changed cluster)...")
+    else:
+        print("Counting terms of all the rows...")
+
+    chunks = iter_cluster_ids(clusters_path, batch_size)
+    buffer = []
+    parts = []
+    changed_rows = 0
+
+    for i, (first, batch) in enumerate(iter_texts(files, batch_size)):
+        new = take_rows(chunks, buffer, batch.num_rows).astype(np.int32)
+        texts = batch["clean_embedding_text"].to_pylist()
+
+        if incremental:
+            old = np.asarray(old_used[first:first + batch.num_rows])
+            moved = np.flatnonzero(old != new)
+            if len(moved) > 0:
+                moved_texts = [texts[j] for j in moved]
+                # Remove the counts from the old cluster and add them to the new one
+                for part in [batch_counts(moved_texts, old[moved], vocab, n_clusters, ngram_range, sign=-1),
+                             batch_counts(moved_texts, new[moved], vocab, n_clusters, ngram_range)]:
+                    if part is not None:
+                        parts.append(part)
+            changed_rows += len(moved)
+        else:
+            part = batch_counts(texts, new, vocab, n_clusters, ngram_range)
+            if part is not None:
+                parts.append(part)
+            changed_rows += batch.num_rows
+
+        used[first:first + batch.num_rows] = new
+
+        if len(parts) >= compact_every:
+            counts = add_counts(counts, parts, n_clusters, len(vocab))
+
+    counts = add_counts(counts, parts, n_clusters, len(vocab))
+    counts.eliminate_zeros()
+
+    used.flush()
+    del used
+    if incremental:
+        del old_used
+    os.replace(labels_dir / "clusters_used.tmp.npy", used_path)
+    save_state(labels_dir, counts, vocab, settings)
+
+    print(f"{changed_rows} rows counted, {len(vocab)} terms.")
+
+    # c-TF-IDF and top terms of each cluster
+    terms = list(vocab)
+    top = top_terms(ctfidf(counts, min_count), terms, top_n)
+
+    # Rows of each cluster, without the rows that have no cluster (-1: noise)
+    rows_per_cluster = np.zeros(n_clusters, dtype=np.int64)
+    saved_used = np.load(used_path, mmap_mode="r")
+    for first in range(0, n_rows, 1_000_000):
+        chunk = np.asarray(saved_used[first:min(first + 1_000_000, n_rows)])
+        chunk = chunk[chunk >= 0]
+        rows_per_cluster += np.bincount(chunk, minlength=n_clusters)[:n_clusters]
+    del saved_used
+
+    label_words = [cluster_terms[:label_terms] for cluster_terms, _ in top]
+    columns = {
+        "cluster": pa.array(np.arange(n_clusters, dtype=np.int32)),
+        "rows": pa.array(rows_per_cluster[:n_clusters].astype(np.int64)),
+        "terms": pa.array([cluster_terms for cluster_terms, _ in top], type=pa.list_(pa.string())),
+        "scores": pa.array([scores for _, scores in top], type=pa.list_(pa.float64())),
+    }
+
+    if keybert_top > 0:
+        reranked = keybert_rerank(model_name, saved[0], columns["terms"].to_pylist(), keybert_top)
+        columns["keybert_terms"] = pa.array(reranked, type=pa.list_(pa.string()))
+        label_words = reranked
+
+    columns["label"] = pa.array([", ".join(words) for words in label_words], type=pa.string())
+
+    pq.write_table(pa.table(columns), labels_dir / "labels.parquet")
+    print(f"Labels of {n_clusters} clusters saved in {labels_dir / 'labels.parquet'}")
@@ -0,0 +1,241 @@
+# Lexical embeddings: hashing vectorizer + TF-IDF + SVD
+
+"""
+
+Fast CPU alternative to the sentence-transformers embeddings (embedding.py).
+The vectors are saved in the same shard format, so clustering.py, density_clustering.py
+and the rest of the stages can use any of the two backends (model_name = "hashing-svd-<dim>").
+
+    - Pass 1: HashingVectorizer (unigrams and bigrams, no vocabulary to keep in memory) over all
+      the rows, the document frequency of each hash is added batch by batch (IDF)
+    - Fit: randomized TruncatedSVD on a sample of TF-IDF rows (random row groups)
+    - Pass 2: TF-IDF -> SVD -> unit length for every row, saved in float16 shards with the
+      same index (row_id, asin, source, overall) and manifest as the transformer path
+
+The IDF and the SVD components are saved with the shards, a new run with the same
+input and settings continues from the first shard not saved. encode(model_dir, texts)
+uses them to embed new texts (assignment_index.assign_texts with a lexical index).
+
+"""
+
+import json
+import time
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+from src.pipeline.embedding import (model_dir_for, input_files, row_groups_of, read_rows, start_manifest,
+                                    write_shard, text_col, lexical_prefix)
+from src.pipeline.checkpoint import input_info
+from src.pipeline.merge_parquet import save_json
+
+
+def lexical_model_name(dim):
+
+    """
+    Name used for the directory of the lexical embeddings (and by the clustering stages).
+
+    """
+    return f"{lexical_prefix}{dim}"
+
+
+def make_vectorizer(n_features, ngram_range):
+
+    """
+    Hashing vectorizer for the spacy output (already lowercase and lemmatized).
+
+    """
+    return HashingVectorizer(
+        n_features=n_features,
+        ngram_range=ngram_range,
+        token_pattern=r"(?u)\b\w+\b",
+        lowercase=False,
+        alternate_sign=False,
+        norm=None,
+    )
+
+
+def document_frequency(row_groups, vectorizer, n_features, batch_rows):
+
+    """
+    Pass 1: document frequency of every hash (partial fit of the IDF, batch by batch).
+
+    """
+    df = np.zeros(n_features, dtype=np.int64)
+    n_docs = 0
+
+    total = sum(rows for _, _, _, rows in row_groups)
+    for start in range(0, total, batch_rows):
+        texts = read_rows(row_groups, start, min(start + batch_rows, total), [text_col])[text_col].to_pylist()
+        counts = vectorizer.transform([t or "" for t in texts])
+
+        # Each row of the CSR matrix has every hash once, so counting the indices gives the df
+        df += np.bincount(counts.indices, minlength=n_features)
+        n_docs += len(texts)
+
+    return df, n_docs
+
+
+def tfidf(texts, vectorizer, idf):
+
+    """
+    TF-IDF rows (sublinear tf, unit length) of a list of texts.
+
+    """
+    counts = vectorizer.transform([t or "" for t in texts]).tocsr().astype(np.float32)
+    counts.data = np.log1p(counts.data) * idf[counts.indices]
+    return normalize(counts)
+
+
+def project(texts, vectorizer, idf, components):
+
+    """
+    Lexical embedding of a list of texts: TF-IDF -> SVD -> unit length.
+    Output: float32 array [texts x dim]
+
+    """
+    vectors = tfidf(texts, vectorizer, idf) @ components.T
+    return normalize(np.asarray(vectors)).astype(np.float32)
+
+
+# Models of encode, loaded once per process (model directory: (vectorizer, idf, components))
+loaded = {}
+
+
+def load_encoder(model_dir):
+
+    """
+    Vectorizer, IDF and SVD components saved by embed_lexical in model_dir (loaded once).
+
+    """
+    key = str(model_dir)
+    if key not in loaded:
+        with open(model_dir / "_lexical.json", "r") as f:
+            info = json.load(f)
+        vectorizer = make_vectorizer(info["n_features"], tuple(info["ngram_range"]))
+        idf = np.load(model_dir / "_idf.npy")
+        components = np.load(model_dir / "_svd_components.npy")
+        loaded[key] = (vectorizer, idf, components)
+    return loaded[key]
+
+
+def encode(model_dir, texts):
+
+    """
+    Embeds new texts with the lexical model saved in model_dir (same vectors as the shards).
+    Output: float32 array [texts x dim]
+
+    """
+    vectorizer, idf, components = load_encoder(model_dir)
+    return project(texts, vectorizer, idf, components)
+
+
+def sample_texts(row_groups, sample_rows, seed):
+
+    """
+    Texts of random row groups until there are sample_rows rows (to fit the SVD).
+
+    """
+    order = np.random.default_rng(seed).permutation(len(row_groups))
+    texts = []
+
+    for i in order:
+        _, _, first, rows = row_groups[i]
+        texts.extend(read_rows(row_groups, first, first + rows, [text_col])[text_col].to_pylist())
+        if len(texts) >= sample_rows:
+            break
+
+    return texts[:sample_rows]
+
+
+def embed_lexical(dim=256, dedup=False, shard_size=100000, window_size=20000, n_features=2 ** 20,
+                  ngram_range=(1, 2), sample_rows=200000, seed=42):
+
+    """
+    Lexical embedding stage: same output format as embedding.embed.
+
+    dim: size of the vectors (SVD components)
+    n_features: size of the hashing space
+    sample_rows: rows used to fit the SVD
+
+    """
+    files, index_cols = input_files(dedup)
+    files = [f for f in files if f.exists()]
+
+    if len(files) == 0:
+        print("No files to embed.")
+        return
+
+    model_name = lexical_model_name(dim)
+    model_dir = model_dir_for(model_name, dedup)
+
+    settings = {
+        "model": model_name,
+        "dedup": dedup,
+        "shard_size": shard_size,
+        "n_features": n_features,
+        "ngram_range": list(ngram_range),
+        "sample_rows": sample_rows,
+        "seed": seed,
+        "inputs": [input_info(f) for f in files],
+    }
+    manifest = start_manifest(model_dir, settings)
+
+    row_groups = row_groups_of(files)
+    total_rows = sum(rows for _, _, _, rows in row_groups)
+    n_shards = (total_rows + shard_size - 1) // shard_size
+    done = {part["start"] for part in manifest["shards"]}
+
+    print(f"{total_rows} rows in {n_shards} shards ({len(done)} already done).")
+    if len(done) == n_shards:
+        return
+
+    vectorizer = make_vectorizer(n_features, ngram_range)
+
+    # IDF and SVD are fitted once, a resumed run loads them (only valid with the same manifest)
+    if (model_dir / "_lexical.json").exists() and len(done) > 0:
+        idf = np.load(model_dir / "_idf.npy")
+        components = np.load(model_dir / "_svd_components.npy")
+        print("Loaded IDF and SVD of the interrupted run.")
+    else:
+        begin = time.time()
+        df, n_docs = document_frequency(row_groups, vectorizer, n_features, window_size)
+        idf = (np.log((1 + n_docs) / (1 + df)) + 1).astype(np.float32)
+        print(f"IDF of {n_docs} rows in {time.time() - begin:.0f} s")
+
+        begin = time.time()
+        sample = tfidf(sample_texts(row_groups, sample_rows, seed), vectorizer, idf)
+        svd = TruncatedSVD(n_components=dim, algorithm="randomized", random_state=seed)
+        svd.fit(sample)
+        components = svd.components_.astype(np.float32)
+        print(f"SVD fitted on {sample.shape[0]} rows in {time.time() - begin:.0f} s "
+              f"({100 * svd.explained_variance_ratio_.sum():.1f}% of the variance)")
+
+        np.save(model_dir / "_idf.npy", idf)
+        np.save(model_dir / "_svd_components.npy", components)
+        save_json({"dim": dim, "n_features": n_features, "ngram_range": list(ngram_range)}, model_dir / "_lexical.json")
+
+    manifest["dim"] = int(components.shape[0])
+
+    def encode_window(window):
+        return project(window, vectorizer, idf, components)
+
+    for shard in range(n_shards):
+        start = shard * shard_size
+        if start in done:
+            continue
+
+        end = min(start + shard_size, total_rows)
+        table = read_rows(row_groups, start, end, [text_col] + index_cols)
+
+        begin = time.time()
+        info = write_shard(model_dir, shard, table, index_cols, start, manifest["dim"], encode_window, window_size)
+        seconds = time.time() - begin
+
+        manifest["shards"].append(info)
+        save_json(manifest, model_dir / "_manifest.json")
+
+        print(f"Shard {shard + 1}/{n_shards}: {info['rows']} rows ({info['rows'] / max(seconds, 1e-9):.0f} rows/s)")
+
+    print(f"Lexical embeddings saved in {model_dir} (model_name='{model_name}' for the clustering)")
@@ -0,0 +1,83 @@
+# Helpers to measure the memory used by the process
+
+"""
+
+Functions used by the pipeline stages to report how much memory they use.
+
+    - peak_rss_mb: maximum resident memory of the process since it started
+    - current_rss_mb: resident memory right now
+    - peak_children_rss_mb: peak of the largest finished child process (pool workers)
+
+The resource module is used when it exists (Linux and macOS), psutil otherwise (Windows).
+psutil is optional: without it (and without /proc) the functions return 0.
+
+"""
+
+import sys
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def peak_rss_mb():
+
+    """
+    Peak resident memory (MB) of the current process.
+
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        if sys.platform == "darwin":
+            return peak / 1024 ** 2
+        return peak / 1024
+
+    # psutil is optional (not in requirements.txt), without it the peak can't be measured
+    try:
+        import psutil
+    except ImportError:
+        return 0.0
+
+    info = psutil.Process().memory_info()
+    # peak_wset is the peak on Windows
+    return getattr(info, "peak_wset", info.rss) / 1024 ** 2
+
+
+def peak_children_rss_mb():
+
+    """
+    Peak resident memory (MB) of the largest child process that already finished
+    (for example the workers of a closed pool). 0 if it can't be measured.
+
+    """
+    if resource is None:
+        return 0.0
+
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def current_rss_mb():
+
+    """
+    Resident memory (MB) of the current process right now.
+
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        pass
+
+    # Without psutil: /proc on Linux
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        import os
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb()
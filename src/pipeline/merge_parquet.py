@@ -1,125 +1,201 @@
-# Module to merge all the parquet files in one to use for embedding
+# Module to merge all the parquet files in one dataset to use for embedding
 
+"""
+
+The merged output is a dataset directory instead of one big parquet file:
+
+    - One parquet file per source (the <source>_spacy.parquet files, linked or copied as they are)
+    - _metadata: parquet metadata of all the files (schema, row groups and statistics),
+      so the whole dataset can be opened with one call (open_merged)
+    - _manifest.json: sources, row counts, schema and row group statistics
+
+Merging a new source only adds its file and updates _metadata and _manifest.json,
+the data already in the dataset is never read or written again.
+
+"""
+
+import os
+import json
+import shutil
 from pathlib import Path
-import pyarrow as pa
 import pyarrow.parquet as pq
-import gc # Library to help release memory so it doesn't crash
 
 
-def merge_par(): 
+# Directory to look for
+directory = Path("data/processed/spacy")
+
+# Merged dataset (directory)
+dataset_dir = directory / "dataset_embedding_spacy"
+
+
+def row_group_info(metadata, i):
 
     """
+    Returns rows, size and the statistics (min, max, nulls) saved for one row group.
 
-    Module to merge all the .parquet files to use them in embedding
-    Output: One .parquet file with all the processed data.
+    """
+    rg = metadata.row_group(i)
+    stats = {}
+
+    for c in range(rg.num_columns):
+        column = rg.column(c)
+        if column.is_stats_set and column.statistics.has_min_max:
+            stats[column.path_in_schema] = {
+                "min": column.statistics.min,
+                "max": column.statistics.max,
+                "null_count": column.statistics.null_count,
+            }
 
-    If the file already exists, appends new entrys. 
+    return {"rows": rg.num_rows, "bytes": rg.total_byte_size, "stats": stats}
+
+
+def load_manifest():
 
     """
+    Loads _manifest.json or returns an empty manifest if the dataset doesn't exist yet.
+
+    """
+    path = dataset_dir / "_manifest.json"
+
+    if path.exists():
+        with open(path, "r") as f:
+            return json.load(f)
 
-    # Directory to look for
-    directory = Path("data/processed/spacy")
+    return {"version": 0, "schema": None, "total_rows": 0, "sources": {}}
 
-    # Final file name
-    final_file = directory / "dataset_embedding_spacy.parquet"
 
-    # File with the name of the processed datasets that are already in the parquet
-    processed_txt = directory / "processed_spacy_sources.txt"
+def save_json(data, path):
 
+    """
+    Writes a json file to a temporary name and renames it so the file is never half-written.
 
-    # Error parquet size 0, delete it
-    if final_file.exists() and final_file.stat().st_size == 0:
-        print("Detected empty parquet file, deleting to recreate properly...")
-        final_file.unlink()  # Deletes the file
+    """
+    temp = path.with_name(path.name + ".tmp")
+    with open(temp, "w") as f:
+        json.dump(data, f, indent=2, default=str)
+    os.replace(temp, path)
 
-    # If the txt file exists, load it
-    processed_sources = []
-    if processed_txt.exists():
-        with open(processed_txt, "r") as f:
-            lines = f.readlines()
-            for l in lines: 
-                processed_sources.append(l.strip())
-        print(f"Loaded {len(processed_sources)} processed entries from TXT file.")
 
+def add_file(f_path, target):
+
+    """
+    Adds the file to the dataset without rewriting it: hard link if possible
+    (same disk, no copy), otherwise the bytes are copied as they are (no re-encoding).
+
+    """
+    if target.exists():
+        target.unlink()
+    try:
+        os.link(f_path, target)
+    except OSError:
+        shutil.copyfile(f_path, target)
+
+
+def merge_par():
+
+    """
+
+    Module to merge all the .parquet files to use them in embedding
+    Output: dataset directory with one file per source plus _metadata and _manifest.json
+
+    If the dataset already exists, only the new sources are added.
+
+    """
+
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+
+    # The old single-file output can't be appended safely, it is not used anymore
+    old_file = directory / "dataset_embedding_spacy.parquet"
+    if old_file.exists():
+        print(f"{old_file.name} (old merged file) is not used anymore, the merged dataset is {dataset_dir}")
+
+    manifest = load_manifest()
+    print(f"Loaded {len(manifest['sources'])} processed sources from the manifest.")
 
     # Find parquets not including the dataset_embedding
-    files = list(directory.glob("*_spacy.parquet")) 
+    files = sorted(directory.glob("*_spacy.parquet"))
 
     # Filter files NOT included
     new_files = []
 
     for f in files:
-        source_name = f.stem 
-        if source_name not in processed_sources and source_name != "dataset_embedding_spacy":
+        source_name = f.stem
+        if source_name not in manifest["sources"] and source_name != "dataset_embedding_spacy":
             new_files.append(f)
 
-    # CASE 1: If the final file doesn't exists - Create it
-    if not final_file.exists():
-        print(f"Creating file: {final_file.name}")
-
-         # Initialize writer as none since no files are loaded yet 
-        writer = None
-
-        for par in new_files:
-            # Read in batches
-            pf = pq.ParquetFile(par)
-            if writer is None:
-                # Take schema first
-                schema = pf.schema.to_arrow_schema()
-                writer = pq.ParquetWriter(final_file, schema, compression="snappy", write_statistics=False)
+    # If not new files were found
+    if len(new_files) == 0:
+        print("\nNo files to add.")
+        return # End function
+
+    print(f"Found {len(new_files)} new files to process")
+
+    # _metadata is built again from the footers of the files already in the dataset
+    # (only metadata is read, not the data), so an interrupted merge never duplicates row groups
+    metadata_path = dataset_dir / "_metadata"
+    combined = None
+    for source in manifest["sources"].values():
+        metadata = pq.read_metadata(dataset_dir / source["file"])
+        metadata.set_file_path(source["file"])
+        if combined is None:
+            combined = metadata
+        else:
+            combined.append_row_groups(metadata)
+
+    added = 0
+    for f_new in new_files:
+        metadata = pq.read_metadata(f_new)
+        schema = metadata.schema.to_arrow_schema()
+
+        # All the files of the dataset need the same schema
+        if manifest["schema"] is not None and schema.to_string() != manifest["schema"]:
+            print(f"ERROR: {f_new.name} has a different schema, not added.\n{schema}")
+            continue
+
+        print(f"Appending: {f_new.name}")
+
+        # Add the file as it is (no rows are read or written)
+        add_file(f_new, dataset_dir / f_new.name)
+
+        # The row groups of the new file are added to _metadata with the file path
+        metadata.set_file_path(f_new.name)
+        if combined is None:
+            combined = metadata
+        else:
+            combined.append_row_groups(metadata)
+
+        # Add this file to the manifest
+        manifest["schema"] = schema.to_string()
+        manifest["sources"][f_new.stem] = {
+            "file": f_new.name,
+            "rows": metadata.num_rows,
+            "size": f_new.stat().st_size,
+            "row_groups": [row_group_info(metadata, i) for i in range(metadata.num_row_groups)],
+        }
+        manifest["total_rows"] += metadata.num_rows
+        added += 1
+
+    if added == 0:
+        return
 
-            for batch in pf.iter_batches(batch_size=50000):
-                # Use the method from_batches because traditional writing won't work
-                writer.write_table(pa.Table.from_batches([batch]))
+    # Write _metadata first and then the manifest (temporary names and rename)
+    temp = dataset_dir / "_metadata.tmp"
+    combined.write_metadata_file(str(temp))
+    os.replace(temp, metadata_path)
 
-            # Save file name to TXT
-            with open(processed_txt, "a") as source_name:
-                source_name.write(par.stem + "\n")
+    manifest["version"] += 1
+    save_json(manifest, dataset_dir / "_manifest.json")
 
-            gc.collect()
+    print(f"Successfully added {added} new files ({manifest['total_rows']} rows in the dataset)")
 
-        # Close writer 
-        if writer: # First check if it changed from None to a writer object
-            writer.close()
 
-        print("Saving to parquet succesful")
+def open_merged():
 
-        return
-    
-    # CASE 2: The final file already exists, just append new entrys
-    else:
-        print(f"{final_file.name} already exists, checking if there is new files to append...")
-        
-        # If not new files were found
-        if len(new_files) == 0:
-            print("\nNo files to add.")
-            return # End function
-        
-        print(f"Found {len(new_files)} new files to process")
-
-        # Take just the schema 
-        schema = pq.ParquetFile(final_file).schema.to_arrow_schema()
-
-        # Since pyarrow doesn't allow append=True directly, to prevent overwritting
-        # binary append mode is being used (parquet files are binary)
-        with open(final_file, "ab") as f: 
-            writer = pq.ParquetWriter(f, schema, compression="snappy", write_statistics=False)
-
-            for f_new in new_files:
-                print(f"Appending: {f_new.name}")
-                # Read in batches
-                pf_new = pq.ParquetFile(f_new)
-                for batch in pf_new.iter_batches(batch_size=50000):
-                    writer.write_table(pa.Table.from_batches([batch]))
-
-                 # Add this file to txt 
-                with open(processed_txt, "a") as source_name:
-                    source_name.write(f_new.stem + "\n")
-
-                gc.collect()
-
-            writer.close()
-
-        print(f"Successfully added {len(new_files)} new files")
-        return
+    """
+    Opens the merged dataset (all the sources) with one call using _metadata.
+    Returns a pyarrow dataset: .to_table(columns=..., filter=...) or .to_batches() to read it.
 
+    """
+    # pyarrow.dataset imports pandas, only imported here (save_json is used by most of the stages)
+    import pyarrow.dataset as ds
+    return ds.parquet_dataset(dataset_dir / "_metadata")
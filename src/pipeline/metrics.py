@@ -0,0 +1,301 @@
+# Metrics of every chunk processed by the stages
+
+"""
+
+Instead of prints in the code, the stages record what happened with every chunk (or row group):
+
+    - rows in and rows out (and the rows dropped by the english filter)
+    - bytes read and bytes written
+    - seconds in each phase: read, clean, detect, join, lemmatize, vocab, write
+    - the worker process (pid) that processed it and its memory (RSS at the start and end, and peak)
+
+The workers measure their phases with `phase` and `add` (no cost when no chunk is being measured).
+`run_with_metrics` wraps the worker function, so the metrics come back with the result of the chunk.
+The parent process adds the read and write times and saves everything with StageMetrics:
+
+    - data/metrics/<stage>-<run>.jsonl: one line per chunk
+    - data/metrics/<stage>-<run>.summary.json: totals by source and by worker
+    - data/metrics/<stage>.prom: Prometheus textfile (node_exporter textfile collector), updated
+      during the run, so a production run can be followed without changing the code
+    - A progress summary by source printed every progress_every seconds
+
+"""
+
+import os
+import json
+import time
+import itertools
+from pathlib import Path
+from contextlib import contextmanager
+
+from src.pipeline import profiling
+from src.pipeline.memory import current_rss_mb, peak_rss_mb
+
+
+# Output of the metrics
+metrics_dir = Path("data/metrics")
+
+# Number of the StageMetrics of this process (part of the run id)
+run_counter = itertools.count()
+
+# Seconds between the progress summaries (and updates of the Prometheus file)
+progress_every = 30
+
+# Phases in the order they are shown
+phases = ["read", "clean", "detect", "join", "lemmatize", "vocab", "write"]
+
+# Metrics of the chunk being processed in this process (None when no chunk is measured)
+current = None
+
+
+def new_chunk():
+
+    """
+    Empty metrics of one chunk.
+
+    """
+    return {"rows_in": 0, "rows_out": 0, "bytes_read": 0, "bytes_written": 0, "seconds": {}}
+
+
+@contextmanager
+def phase(name):
+
+    """
+    Adds the time of the block to the phase of the current chunk:
+
+        with phase("clean"):
+            clean_review = clean_column(...)
+
+    """
+    if current is None:
+        yield
+        return
+
+    chunk = current
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        chunk["seconds"][name] = chunk["seconds"].get(name, 0.0) + time.perf_counter() - begin
+
+
+def add(name, value):
+
+    """
+    Adds a value (rows_in, rows_out, bytes_read, bytes_written) to the current chunk.
+
+    """
+    if current is not None:
+        current[name] = current.get(name, 0) + value
+
+
+def run_with_metrics(task):
+
+    """
+    Runs one worker function and returns (result, metrics of the chunk).
+    Used in the pool instead of the worker function: task is (function, argument).
+
+    """
+    global current
+    func, argument = task
+
+    current = new_chunk()
+    rss_start = current_rss_mb()
+    begin = time.perf_counter()
+    try:
+        # Every Nth chunk is profiled if PIPELINE_PROFILE is set (profiling.py)
+        with profiling.profile_chunk(func.__name__):
+            result = func(argument)
+    finally:
+        chunk = current
+        current = None
+
+    chunk["seconds"]["worker"] = time.perf_counter() - begin
+    chunk["pid"] = os.getpid()
+
+    # Memory of the worker, used by the memory budget (batch_budget.py)
+    chunk["rss_start_mb"] = rss_start
+    chunk["rss_mb"] = current_rss_mb()
+    chunk["peak_rss_mb"] = peak_rss_mb()
+    return result, chunk
+
+
+def add_totals(totals, chunk):
+
+    """
+    Adds the metrics of one chunk to a dictionary of totals.
+
+    """
+    totals["chunks"] = totals.get("chunks", 0) + 1
+    for name in ["rows_in", "rows_out", "bytes_read", "bytes_written"]:
+        totals[name] = totals.get(name, 0) + chunk.get(name, 0)
+
+    seconds = totals.setdefault("seconds", {})
+    for name, value in chunk["seconds"].items():
+        seconds[name] = seconds.get(name, 0.0) + value
+
+
+def drop_rate(totals):
+
+    """
+    Share of the rows dropped (not english or empty).
+
+    """
+    if totals.get("rows_in", 0) == 0:
+        return 0.0
+    return 1 - totals["rows_out"] / totals["rows_in"]
+
+
+def label_value(value):
+
+    """
+    Label value escaped for the Prometheus text format.
+
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class StageMetrics:
+
+    """
+    Collects the metrics of the chunks of one stage run (in the parent process).
+
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.time()
+        # Unique run id: two runs started in the same second (same or other process) never share a file
+        self.run = (f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(self.start))}"
+                    f"_{int(self.start * 1000) % 1000:03d}_{os.getpid()}_{next(run_counter)}")
+        self.last_progress = self.start
+
+        self.sources = {} # source: totals
+        self.workers = {} # pid: totals
+
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        self.jsonl_path = metrics_dir / f"{stage}-{self.run}.jsonl"
+        self.jsonl = open(self.jsonl_path, "x")
+
+    def record(self, source, chunk, **extra):
+
+        """
+        Saves the metrics of one chunk.
+        extra: values measured by the parent, seconds for the phases (read, write) and
+               counters (bytes_read, bytes_written) are added to the chunk.
+
+        """
+        for name, value in extra.items():
+            if name in phases:
+                chunk["seconds"][name] = chunk["seconds"].get(name, 0.0) + value
+            else:
+                chunk[name] = chunk.get(name, 0) + value
+
+        line = dict(chunk)
+        line["stage"] = self.stage
+        line["source"] = source
+        line["time"] = time.time()
+        self.jsonl.write(json.dumps(line) + "\n")
+
+        add_totals(self.sources.setdefault(source, {}), chunk)
+        add_totals(self.workers.setdefault(chunk.get("pid", os.getpid()), {}), chunk)
+
+        if time.time() - self.last_progress >= progress_every:
+            self.progress()
+
+    def progress(self, source=None):
+
+        """
+        Prints the summary of every source (or only one) and updates the Prometheus file.
+
+        """
+        self.last_progress = time.time()
+        self.jsonl.flush()
+
+        elapsed = max(time.time() - self.start, 1e-9)
+        names = [source] if source is not None else sorted(self.sources)
+
+        for name in names:
+            totals = self.sources[name]
+            seconds = totals["seconds"]
+            busy = sum(seconds.get(p, 0.0) for p in phases)
+            shares = ", ".join(f"{p} {100 * seconds[p] / max(busy, 1e-9):.0f}%" for p in phases if p in seconds)
+            print(f"[{self.stage}] {name}: {totals['chunks']} chunks, {totals['rows_in']} rows in, "
+                  f"{totals['rows_out']} out ({100 * drop_rate(totals):.1f}% dropped), "
+                  f"{totals['rows_in'] / elapsed:.0f} rows/s | {shares}")
+
+        self.write_prometheus()
+
+    def summary(self):
+
+        """
+        Totals by source and by worker.
+
+        """
+        return {
+            "stage": self.stage,
+            "run": self.run,
+            "seconds": time.time() - self.start,
+            "sources": self.sources,
+            "workers": {str(pid): totals for pid, totals in self.workers.items()},
+        }
+
+    def write_prometheus(self):
+
+        """
+        Writes the totals in the Prometheus text format (temporary name and rename,
+        the textfile collector never reads a half-written file).
+
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{label_value(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        by_source = [({"stage": self.stage, "source": s}, totals) for s, totals in sorted(self.sources.items())]
+
+        metric("pipeline_chunks_total", "counter", "Chunks processed",
+               [(labels, t["chunks"]) for labels, t in by_source])
+        metric("pipeline_rows_in_total", "counter", "Rows received by the stage",
+               [(labels, t["rows_in"]) for labels, t in by_source])
+        metric("pipeline_rows_out_total", "counter", "Rows written by the stage",
+               [(labels, t["rows_out"]) for labels, t in by_source])
+        metric("pipeline_drop_ratio", "gauge", "Share of the rows dropped (language filter, empty texts)",
+               [(labels, round(drop_rate(t), 6)) for labels, t in by_source])
+        metric("pipeline_bytes_read_total", "counter", "Bytes read",
+               [(labels, t["bytes_read"]) for labels, t in by_source])
+        metric("pipeline_bytes_written_total", "counter", "Bytes written",
+               [(labels, t["bytes_written"]) for labels, t in by_source])
+        metric("pipeline_phase_seconds_total", "counter", "Seconds spent in each phase",
+               [(dict(labels, phase=p), round(t["seconds"][p], 6))
+                for labels, t in by_source for p in phases if p in t["seconds"]])
+        metric("pipeline_worker_seconds_total", "counter", "Busy seconds of each worker process",
+               [({"stage": self.stage, "worker": str(pid)}, round(t["seconds"].get("worker", 0.0), 6))
+                for pid, t in sorted(self.workers.items())])
+        metric("pipeline_last_update_seconds", "gauge", "Unix time of the last update",
+               [({"stage": self.stage}, round(time.time(), 3))])
+
+        path = metrics_dir / f"{self.stage}.prom"
+        temp = path.with_name(path.name + ".tmp")
+        with open(temp, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp, path)
+
+    def finish(self):
+
+        """
+        Last progress summary, summary json and Prometheus file.
+
+        """
+        if len(self.sources) > 0:
+            self.progress()
+
+        self.jsonl.close()
+        with open(metrics_dir / f"{self.stage}-{self.run}.summary.json", "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+        print(f"[{self.stage}] metrics saved in {self.jsonl_path}")
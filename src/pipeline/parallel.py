@@ -0,0 +1,43 @@
+# Helpers to run chunk processing in worker processes
+
+"""
+
+This module sends whole chunks to a pool of worker processes and gives the
+results back in the same order the chunks were read.
+
+    - Only a limited number of chunks are sent at the same time (in-flight window),
+      so the memory stays flat even if the reading is faster than the processing
+    - The results are returned in input order so just one writer can append them
+
+"""
+
+from collections import deque
+
+
+def ordered_map(pool, func, items, max_in_flight):
+
+    """
+    Applies func to every item using the pool and yields the results in input order.
+
+    pool: multiprocessing Pool (already created)
+    func: function at module level (so it can be sent to the workers)
+    items: iterable of arguments, it is consumed only when there is space in the window
+    max_in_flight: maximum number of chunks being processed or waiting to be written
+
+    """
+
+    # Pending results in the same order they were sent
+    pending = deque()
+
+    for item in items:
+
+        # If the window is full wait for the oldest chunk before reading a new one
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+
+        # apply_async returns right away, so reading the next chunk overlaps with the processing
+        pending.append(pool.apply_async(func, (item,)))
+
+    # Empty the window when there are no more chunks to read
+    while pending:
+        yield pending.popleft().get()
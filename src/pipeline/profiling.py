@@ -0,0 +1,356 @@
+# Opt-in profiling of the pipeline hot paths
+
+"""
+
+Profiles the chunks of the stages when a run is slow, without changing the code.
+It is off by default and enabled with environment variables (or configure() before the
+stage starts, the workers inherit the environment):
+
+    PIPELINE_PROFILE=cprofile   cProfile of every Nth chunk (exact, more overhead)
+    PIPELINE_PROFILE=sample     sampling profiler: the stack of the process every few ms (low overhead)
+    PIPELINE_PROFILE_EVERY=10   profile 1 of every N chunks of each process (default 10)
+    PIPELINE_PROFILE_INTERVAL_MS=5   time between samples of the sampling profiler
+    PIPELINE_TRACEMALLOC=1      memory of the to_pylist / from_arrays conversions and gc.collect calls
+    PIPELINE_TRACEMALLOC=snapshot   also a tracemalloc snapshot after those blocks in the profiled chunks
+                                (slow, only to find which lines allocate the memory)
+    PIPELINE_PROFILE_DIR=data/profiles
+
+Every chunk runs through metrics.run_with_metrics, which calls profile_chunk, so the worker
+functions of save_to_parquet, save_for_embedding, embedding_parquet and process_file are all covered.
+The parent process of the pool stages is profiled with start_process / stop_process.
+
+Output (one file per process and chunk, so the workers never write the same file):
+    - <function>-pid<pid>-chunk<n>.prof: cProfile stats (pstats)
+    - <function>-pid<pid>-chunk<n>.folded: sampled stacks, "frame;frame;frame count" (flamegraph format)
+    - memory-pid<pid>.jsonl: memory change and peak of every traced block (python objects with
+      tracemalloc, and the Arrow memory pool that tracemalloc can't see)
+    - <label>-pid<pid>-chunk<n>.snapshot: tracemalloc snapshot after the block (profiled chunks only)
+
+merge_profiles joins the files of the directory (python -m src.pipeline.profiling). By default only the
+chunks of the workers are joined, the parent processes (-main files) mostly wait for the workers.
+
+"""
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import argparse
+import threading
+import tracemalloc
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+
+
+# Settings read from the environment (configure changes them)
+config = {}
+
+# Chunks seen by this process and if the current one is profiled
+chunk_count = 0
+chunk_profiled = False
+
+
+def load_config():
+
+    """
+    Reads the settings from the environment variables.
+
+    """
+    mode = os.environ.get("PIPELINE_PROFILE", "").strip().lower()
+    if mode not in ("", "cprofile", "sample"):
+        print(f"WARNING: PIPELINE_PROFILE={mode} is not valid (cprofile or sample), profiling is off.")
+        mode = ""
+
+    memory = os.environ.get("PIPELINE_TRACEMALLOC", "").strip().lower()
+
+    config.update({
+        "mode": mode,
+        "every": max(1, int(os.environ.get("PIPELINE_PROFILE_EVERY", "10"))),
+        "interval": int(os.environ.get("PIPELINE_PROFILE_INTERVAL_MS", "5")) / 1000,
+        "memory": memory not in ("", "0"),
+        "snapshots": memory == "snapshot",
+        "directory": Path(os.environ.get("PIPELINE_PROFILE_DIR", "data/profiles")),
+    })
+
+
+def configure(mode="", every=10, memory=False, interval_ms=5, directory="data/profiles"):
+
+    """
+    Sets the environment variables and the settings of this process.
+    Call it before the stage creates its pool, so the workers use the same settings.
+
+    mode: "" (off), "cprofile" or "sample"
+    memory: False, True or "snapshot"
+
+    """
+    os.environ["PIPELINE_PROFILE"] = mode
+    os.environ["PIPELINE_PROFILE_EVERY"] = str(every)
+    os.environ["PIPELINE_PROFILE_INTERVAL_MS"] = str(interval_ms)
+    os.environ["PIPELINE_TRACEMALLOC"] = "snapshot" if memory == "snapshot" else ("1" if memory else "")
+    os.environ["PIPELINE_PROFILE_DIR"] = str(directory)
+    load_config()
+
+
+load_config()
+
+
+class Sampler:
+
+    """
+    Sampling profiler: a thread reads the stack of the profiled thread every interval
+    and counts each stack. The cost doesn't depend on the number of function calls.
+
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self.running = False
+        self.thread = None
+
+    def sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if len(stack) > 0:
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def save(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def start_profiler():
+
+    """
+    Starts the profiler of the configured mode (None if profiling is off).
+
+    """
+    if config["mode"] == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if config["mode"] == "sample":
+        profiler = Sampler(config["interval"])
+        profiler.start()
+        return profiler
+    return None
+
+
+def stop_profiler(profiler, name):
+
+    """
+    Stops the profiler and saves it in the profiles directory as <name>.prof or <name>.folded.
+
+    """
+    if profiler is None:
+        return
+
+    config["directory"].mkdir(parents=True, exist_ok=True)
+    if isinstance(profiler, Sampler):
+        profiler.stop()
+        profiler.save(config["directory"] / f"{name}.folded")
+    else:
+        profiler.disable()
+        profiler.dump_stats(config["directory"] / f"{name}.prof")
+
+
+@contextmanager
+def profile_chunk(label):
+
+    """
+    Profiles the block if it is the Nth chunk of this process (PIPELINE_PROFILE_EVERY).
+
+    """
+    global chunk_count, chunk_profiled
+    chunk_count += 1
+
+    if config["mode"] == "" and not config["memory"]:
+        yield
+        return
+
+    chunk_profiled = (chunk_count - 1) % config["every"] == 0
+    profiler = start_profiler() if chunk_profiled else None
+    try:
+        yield
+    finally:
+        stop_profiler(profiler, f"{label}-pid{os.getpid()}-chunk{chunk_count:06d}")
+        chunk_profiled = False
+
+
+def start_process(label):
+
+    """
+    Profiles the whole parent process of a stage (reading, writing, waiting for the workers).
+    Returns the profiler for stop_process (None if profiling is off).
+
+    """
+    profiler = start_profiler()
+    if profiler is not None:
+        profiler.label = f"{label}-pid{os.getpid()}-main"
+    return profiler
+
+
+def stop_process(profiler):
+
+    """
+    Stops the profiler of start_process and saves it.
+
+    """
+    if profiler is not None:
+        stop_profiler(profiler, profiler.label)
+
+
+@contextmanager
+def traced(label, rows=None):
+
+    """
+    Memory of one block (PIPELINE_TRACEMALLOC=1):
+    change of the python memory (tracemalloc) and peak over the memory before the block,
+    and change of the memory of the Arrow pool (the Arrow buffers are not seen by tracemalloc).
+    With PIPELINE_TRACEMALLOC=snapshot, a snapshot is also saved after the block in the profiled chunks.
+
+    """
+    if not config["memory"]:
+        yield
+        return
+
+    import pyarrow as pa
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    before = tracemalloc.get_traced_memory()[0]
+    arrow_before = pa.total_allocated_bytes()
+    tracemalloc.reset_peak()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        record = {
+            "label": label,
+            "pid": os.getpid(),
+            "chunk": chunk_count,
+            "rows": rows,
+            "seconds": time.perf_counter() - begin,
+            "delta_mb": (current - before) / 1024 ** 2,
+            "peak_mb": (peak - before) / 1024 ** 2,
+            "arrow_delta_mb": (pa.total_allocated_bytes() - arrow_before) / 1024 ** 2,
+        }
+
+        config["directory"].mkdir(parents=True, exist_ok=True)
+        with open(config["directory"] / f"memory-pid{os.getpid()}.jsonl", "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        if chunk_profiled and config["snapshots"]:
+            name = label.replace(":", "_")
+            tracemalloc.take_snapshot().dump(str(config["directory"] / f"{name}-pid{os.getpid()}-chunk{chunk_count:06d}.snapshot"))
+
+
+def merge_profiles(directory=None, top=25, pattern="*-chunk*"):
+
+    """
+    Joins the profiles of all the processes of the directory:
+
+    pattern: files joined (default: the chunks of the workers, "*-main*" for the parent processes, "*" for all)
+
+    - merged.prof: all the cProfile files (pstats), the top functions by cumulative time are printed
+    - merged.folded: all the sampled stacks (for flamegraph.pl or speedscope)
+    - memory_summary.json: by label, number of blocks, mean and max of the change and of the peak
+
+    """
+    directory = Path(directory) if directory is not None else config["directory"]
+    summary = {}
+
+    prof_files = sorted(p for p in directory.glob(f"{pattern}.prof") if p.name != "merged.prof")
+    if len(prof_files) > 0:
+        stats = pstats.Stats(str(prof_files[0]))
+        for p in prof_files[1:]:
+            stats.add(str(p))
+        stats.dump_stats(directory / "merged.prof")
+        summary["prof_files"] = len(prof_files)
+        print(f"{len(prof_files)} cProfile files merged in {directory / 'merged.prof'}")
+        stats.sort_stats("cumulative").print_stats(top)
+
+    folded_files = sorted(p for p in directory.glob(f"{pattern}.folded") if p.name != "merged.folded")
+    if len(folded_files) > 0:
+        stacks = Counter()
+        for p in folded_files:
+            with open(p, "r") as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    stacks[stack] += int(count)
+        with open(directory / "merged.folded", "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        # Own samples of each function (last frame of the stack)
+        functions = Counter()
+        for stack, count in stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+        total = max(sum(stacks.values()), 1)
+        summary["folded_files"] = len(folded_files)
+        print(f"{len(folded_files)} sampled profiles merged in {directory / 'merged.folded'} ({total} samples)")
+        for function, count in functions.most_common(top):
+            print(f"{100 * count / total:6.1f}%  {function}")
+
+    memory_files = sorted(directory.glob("memory-pid*.jsonl"))
+    if len(memory_files) > 0:
+        labels = {}
+        for p in memory_files:
+            with open(p, "r") as f:
+                for line in f:
+                    record = json.loads(line)
+                    labels.setdefault(record["label"], []).append(record)
+
+        memory = {}
+        for label, records in sorted(labels.items()):
+            memory[label] = {
+                "blocks": len(records),
+                "mean_delta_mb": sum(r["delta_mb"] for r in records) / len(records),
+                "max_delta_mb": max(r["delta_mb"] for r in records),
+                "mean_peak_mb": sum(r["peak_mb"] for r in records) / len(records),
+                "max_peak_mb": max(r["peak_mb"] for r in records),
+                "mean_arrow_delta_mb": sum(r.get("arrow_delta_mb", 0.0) for r in records) / len(records),
+                "max_arrow_delta_mb": max(r.get("arrow_delta_mb", 0.0) for r in records),
+                "seconds": sum(r["seconds"] for r in records),
+            }
+            print(f"{label:20} {memory[label]['blocks']:6} blocks, python peak {memory[label]['max_peak_mb']:8.1f} MB, "
+                  f"mean change {memory[label]['mean_delta_mb']:8.2f} MB, arrow max {memory[label]['max_arrow_delta_mb']:8.1f} MB")
+
+        with open(directory / "memory_summary.json", "w") as f:
+            json.dump(memory, f, indent=2)
+        summary["memory"] = memory
+
+    if len(summary) == 0:
+        print(f"No profiles found in {directory}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merges the profiles of all the processes")
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--top", type=int, default=25)
+    parser.add_argument("--pattern", default="*-chunk*", help='files to join, "*-main*" for the parent processes')
+    args = parser.parse_args()
+    merge_profiles(args.directory, args.top, args.pattern)
@@ -4,11 +4,15 @@ import pyarrow.parquet as pq
 from pathlib import Path
 import pyarrow as pa
 import gc # Library to help release memory so it doesn't crash
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 
 # Import functions
-from src.text.combine_columns import join_summary_review
+from src.text.combine_columns import join_summary_review_column
 from src.text.spacy_process import spacy_processing
+from src.pipeline.checkpoint import start_checkpoint, commit_part, finish_checkpoint, write_part, part_name_for
+from src.pipeline import metrics, profiling, batch_budget
+from src.pipeline.worker_init import make_pool
+from src.pipeline.vocabulary import count_terms, counts_table, write_vocab, part_vocab_name, finish_source_vocab, merge_vocabulary
 
 # Output for processed files
 output_dir = Path("data/processed/spacy")
@@ -16,90 +20,224 @@ output_dir = Path("data/processed/spacy")
 # Input path
 input_path = Path("data/processed")
 
+# Columns copied as they are from the input to the output
+context_columns = ["asin", "source", "overall", "unixReviewTime"]
 
-# Function to process JUST ONE parquet file
-def process_file(f_path):
+
+# Function to process one batch
+
+def process_batch(batch):
 
     """
-    Reads parquet file in chunks, applies join_summary_review and spacy_processing, 
-    and prepares the data for the next steps.
+    Applies join_summary_review and spacy_processing to one batch of the parquet file
+    (or a table from the ingestion, used by the fused mode in ingestion.py).
+    Returns a table with the columns ready for embedding.
 
     """
 
-    print(f"\nProcessing file {f_path.name}\n")
+    # Context columns are kept as Arrow arrays (no conversion to lists)
+    # combine_chunks is used when the input is a table instead of a record batch
+    # unixReviewTime is kept for the breakdowns over time (query layer), null if the input doesn't have it
+    context = []
+    for col in context_columns:
+        if col not in batch.schema.names:
+            context.append(pa.nulls(batch.num_rows, type=pa.int64()))
+            continue
+        column = batch[col]
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        context.append(column)
+
+    # Step 1  - Join columns (columnar, only the joined text is converted to a list)
+    with metrics.phase("join"):
+        combined = join_summary_review_column(batch["clean_summary"], batch["clean_review"])
+        with profiling.traced("to_pylist:join", len(combined)):
+            combined_texts = combined.to_pylist()
+
+    # Step 2 - Process columns with spacy
+    with metrics.phase("lemmatize"):
+        embedding_clean = spacy_processing(combined_texts) 
+
+
+    #print("Converting to table\n")
+    # Convert columns to table to add the schema to writer
+    with profiling.traced("from_arrays", len(embedding_clean)):
+        table = pa.Table.from_arrays([pa.array(embedding_clean, type=pa.string())] + context, 
+                                    names = ["clean_embedding_text"] + context_columns)
+
+    return table
+
+
+# Function to process one row group (task of the work queue)
+
+def process_row_group(task):
+
+    """
+    Processes all the batches of one row group of a parquet file and writes the result
+    as a part in the parts directory of the source. Used by the workers, so the
+    big files are split in many small tasks.
+
+    Input: tuple (f_path, row group, batch_size, parts_dir, vocab)
+           batch_size: rows per batch, None to use the memory budget (bytes per row of the row group)
+           vocab: also count the lemmas of the row group (vocabulary.py)
+    Output: tuple (f_path, row group, part name or None, rows)
+
+    """
+    f_path, rg, batch_size, parts_dir, vocab = task
+
+    parquet_file = pq.ParquetFile(f_path)
+    row_group = parquet_file.metadata.row_group(rg)
+    metrics.add("rows_in", row_group.num_rows)
+    metrics.add("bytes_read", sum(row_group.column(i).total_compressed_size for i in range(row_group.num_columns)))
+
+    # Memory budget: rows of the target bytes of the parent with the size of the rows of this row group
+    if batch_size is None:
+        bytes_per_row = row_group.total_byte_size / max(row_group.num_rows, 1)
+        batch_size = batch_budget.worker_rows(bytes_per_row, 5000)
+        metrics.add("batch_bytes", int(min(batch_size, row_group.num_rows) * bytes_per_row))
+
+    # Iterate over batches (the time of iter_batches is the read time)
+    tables = []
+    batches = parquet_file.iter_batches(batch_size=batch_size, row_groups=[rg])
+    while True:
+        with metrics.phase("read"):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        tables.append(process_batch(batch))
+
+    tables = [t for t in tables if t.num_rows > 0]
+    if len(tables) == 0:
+        return f_path, rg, None, 0
+
+    part_name = part_name_for(rg)
+
+    # The vocabulary of the part is written before the part, so a committed part always has it
+    if vocab:
+        with metrics.phase("vocab"):
+            with profiling.traced("to_pylist:vocab"):
+                texts = [text for t in tables for text in t["clean_embedding_text"].to_pylist()]
+            df, counts, n_docs = count_terms(texts)
+            write_vocab(Path(parts_dir) / part_vocab_name(part_name), counts_table(df, counts), n_docs)
+
+    with metrics.phase("write"):
+        rows = write_part(Path(parts_dir) / part_name, tables)
+    metrics.add("rows_out", rows)
+    metrics.add("bytes_written", (Path(parts_dir) / part_name).stat().st_size)
+
+    del tables
+    # The memory released by gc.collect is measured with PIPELINE_TRACEMALLOC=1 (profiling.py)
+    with profiling.traced("gc.collect"):
+        gc.collect() # Avoid memory overload
+
+    return f_path, rg, part_name, rows
 
+
+# Prepare the output of one source
+
+def source_paths(f_path):
+
+    """
+    Returns the name of the source and the output paths (final, temporary and parts)
+
+    """
     source_name = Path(f_path.stem) # Since it keeps the .json.parquet extension, stem is used twice
     source_name = source_name.stem
 
-    # If the file processing is interrupted the info will be saved in a temporary file to avoid skipping parts of the dataset
-    # If the file is processed completly it will change names to final
+    # Each processed row group is committed to <source>.parts with a checkpoint (checkpoint.py)
+    # If the file processing is interrupted it continues from the first row group not committed
+    # If the file is processed completly the parts are copied to the final parquet
     final_parquet = output_dir / f"{source_name}_spacy.parquet"
     temp_parquet = output_dir / f"{source_name}.temp_spacy.parquet"
+    parts_dir = output_dir / f"{source_name}.parts"
+
+    return source_name, final_parquet, temp_parquet, parts_dir
+
+
+# Function to process JUST ONE parquet file
+def process_file(f_path, batch_size=5000, vocab=False, memory_budget_mb=None):
+
+    """
+    Reads parquet file in chunks, applies join_summary_review and spacy_processing, 
+    and prepares the data for the next steps.
+
+    vocab: also save the vocabulary of the source (<source>_vocab.parquet, see vocabulary.py)
+    memory_budget_mb: memory of the process instead of batch_size, the rows of each batch come
+                      from the bytes per row of the row group (batch_budget.py)
+
+    If the file was interrupted, the next run continues from the last committed row group
+    and the final parquet is the same as the one of an uninterrupted run (with memory_budget_mb
+    the rows are the same but the row groups can be different).
+
+    """
+
+    print(f"\nProcessing file {f_path.name}\n")
+
+    source_name, final_parquet, temp_parquet, parts_dir = source_paths(f_path)
 
     # Check if final file exists so we can skip that one and clean the next
     if final_parquet.exists():
         print(f"{source_name} already processed. Moving to the next file.")
         return
 
-    # If there is a temporary file, it needs to be deleted and start from scratch
-    if temp_parquet.exists():
-        print(f"{temp_parquet} incomplete. Starting from scratch...")
-        temp_parquet.unlink()  # Delete temporary file
+    # With a memory budget the batches of this process are sized by the sizer (no workers)
+    sizer = None
+    if memory_budget_mb is not None:
+        sizer = batch_budget.BatchSizer(memory_budget_mb, 0)
+        batch_budget.init_worker(sizer.shared)
+        batch_size = None
+
+    # Load the checkpoint of an interrupted run (or create a new one)
+    manifest = start_checkpoint(parts_dir, f_path, checkpoint_settings(batch_size, vocab))
 
+    # embedding_parquet commits the row groups in any order and uses the same parts directory,
+    # so every committed row group is skipped (not only the ones before the position)
+    done = set(start for start, end in manifest["done"])
     parquet_file = pq.ParquetFile(f_path)
-    # Initialize writer as None
-    writer = None
-
-    # Iterate over batches
-    for batch in parquet_file.iter_batches(batch_size=5000):
-
-        # Take columns to save as lists so they can be processed
-        print("Saving columns as lists\n")
-        clean_summ = batch["clean_summary"].to_pylist()
-        clean_rev = batch["clean_review"].to_pylist()
-        asin = batch["asin"].to_pylist()
-        source = batch["source"].to_pylist()
-        overall = batch["overall"].to_pylist()
-
-        #print("Joining columns\n")
-        # Step 1  - Join columns 
-        combined_texts = join_summary_review(clean_summ, clean_rev)
-
-        #print("Cleaning columns\n")
-        # Step 2 - Process columns with spacy
-        embedding_clean = spacy_processing(combined_texts) 
+    pending = [rg for rg in range(parquet_file.num_row_groups) if rg not in done]
 
+    if len(done) > 0:
+        print(f"{source_name} was interrupted. {len(pending)} of {parquet_file.num_row_groups} row groups left...")
 
-        #print("Converting to table\n")
-        # Convert columns to table to add the schema to writer
-        table = pa.Table.from_arrays([pa.array(embedding_clean), pa.array(asin), pa.array(source), pa.array(overall)], 
-                                    names = ["clean_embedding_text", "asin", "source", "overall"])
+    # Rows, bytes and time of every row group (data/metrics, see metrics.py)
+    stage_metrics = metrics.StageMetrics("spacy")
 
-        if writer is None: # is None on the first chunk iteration
-            print(f"\nWriting in {temp_parquet} started.")
-            writer = pq.ParquetWriter(temp_parquet, table.schema, compression="snappy", write_statistics=False)
+    # Iterate over row groups, each one is committed when all its batches are processed
+    for rg in pending:
+        (_, _, part_name, rows), chunk_metrics = metrics.run_with_metrics(
+            (process_row_group, (f_path, rg, batch_size, parts_dir, vocab)))
+        commit_part(manifest, parts_dir, part_name, rows, rg, rg + 1)
+        stage_metrics.record(source_name, chunk_metrics)
+        if sizer is not None:
+            sizer.observe(chunk_metrics, chunk_metrics.get("batch_bytes", 0))
 
+    finish_source(manifest, source_name, final_parquet, temp_parquet, parts_dir, vocab)
+    stage_metrics.finish()
+    if sizer is not None:
+        sizer.report("spacy")
+        batch_budget.init_worker(None)
 
-        print("Writing columns\n")
-        writer.write_table(table)
 
-        del clean_summ, clean_rev, asin, source, overall, combined_texts, embedding_clean
-        gc.collect() # Avoid memory overload
 
-    # Close writer 
-    if writer: # First check if it changed from None to a writer object
-        writer.close()
-        # change the name to the final parquet
-        temp_parquet.rename(final_parquet)
-        print(f"\nFinished processing {source_name} and saved to {final_parquet}\n")
-    else: # by the end the file is empty it needs to be deleted
-        if temp_parquet.exists(): 
-            temp_parquet.unlink()
+# Function to process with pool 
+def embedding_parquet(workers=None, batch_size=5000, vocab=False, memory_budget_mb=None):
 
+    """
+    Processes all the parquet files in data/processed with a shared work queue:
 
+    - Every file is split in row groups and all the row groups of all the files are tasks
+    - The workers take the next task from any file, so the big files don't run alone
+      at the end while the other cores are idle
+    - Each task writes a part, when all the parts of a file are ready they are copied
+      in order to <source>_spacy.parquet (same output as process_file)
 
-# Function to process with pool 
-def embedding_parquet():
+    workers: number of processes (default: 75% of the cpu cores)
+    vocab: also save the vocabulary of every source and merge them (vocabulary.py)
+    memory_budget_mb: memory of the run (parent and workers) instead of batch_size. The workers
+                      size the batches of every row group from its bytes per row and the target
+                      of the parent, which changes with the RSS of the workers (batch_budget.py)
+
+    """
 
     print("Looking for parquet files to process...")
 
@@ -122,7 +260,123 @@ def embedding_parquet():
 
     print(f"{len(new_files)} files found.")
 
+    # With a memory budget the tasks have no batch size, the workers calculate it
+    if memory_budget_mb is not None:
+        batch_size = None
+
+    # Create the tasks of all the files (row groups already committed are skipped)
+    tasks = []
+    sources = {} # f_path: (manifest, remaining tasks, paths)
+
+    for f_path in sorted(new_files):
+        source_name, final_parquet, temp_parquet, parts_dir = source_paths(f_path)
+
+        # Check if final file exists so we can skip that one and clean the next
+        if final_parquet.exists():
+            print(f"{source_name} already processed. Moving to the next file.")
+            continue
+
+        manifest = start_checkpoint(parts_dir, f_path, checkpoint_settings(batch_size, vocab))
+        done = set(start for start, end in manifest["done"])
+
+        num_row_groups = pq.ParquetFile(f_path).num_row_groups
+        pending = [rg for rg in range(num_row_groups) if rg not in done]
+
+        if len(done) > 0:
+            print(f"{source_name} was interrupted. {len(pending)} of {num_row_groups} row groups left...")
+
+        sources[f_path] = (manifest, len(pending), source_name, final_parquet, temp_parquet, parts_dir)
+        for rg in pending:
+            tasks.append((f_path, rg, batch_size, parts_dir, vocab))
+
+    print(f"{len(tasks)} row groups to process.")
+
+    # Sources that are already complete (or empty) are saved now
+    for f_path in list(sources):
+        manifest, remaining, source_name, final_parquet, temp_parquet, parts_dir = sources[f_path]
+        if remaining == 0:
+            finish_source(manifest, source_name, final_parquet, temp_parquet, parts_dir, vocab)
+            del sources[f_path]
+
+    if len(tasks) == 0:
+        if vocab:
+            merge_vocabulary()
+        return
+
+    if workers is None:
+        workers = max(1, int(cpu_count() * 0.75))
+
+    # Target bytes of the batches, shared with the workers by the pool initializer
+    sizer = batch_budget.BatchSizer(memory_budget_mb, workers) if memory_budget_mb is not None else None
+
+    # Rows, bytes and time of every row group (data/metrics, see metrics.py)
+    stage_metrics = metrics.StageMetrics("spacy")
+
+    # Profile of this process if PIPELINE_PROFILE is set (profiling.py), the workers profile their row groups
+    profiler = profiling.start_process("embedding_parquet")
+
     # Create process pool and execute
-    with Pool(int(cpu_count() * 0.75)) as p:
-        p.map(process_file, new_files)
+    # chunksize=1: each worker takes one row group at a time from the shared queue
+    # The workers run with run_with_metrics, so the metrics of the row group come back with the result
+    # The workers start with the spacy pipeline loaded (worker_init.py)
+    with make_pool(workers, ["spacy"], sizer.shared if sizer is not None else None) as p:
+        tasks = [(process_row_group, task) for task in tasks]
+        for (f_path, rg, part_name, rows), chunk_metrics in p.imap_unordered(metrics.run_with_metrics, tasks, chunksize=1):
+            manifest, remaining, source_name, final_parquet, temp_parquet, parts_dir = sources[f_path]
+
+            # The manifest is only written by this process
+            commit_part(manifest, parts_dir, part_name, rows, rg, rg + 1)
+            stage_metrics.record(source_name, chunk_metrics)
+
+            # The RSS of the worker changes the target of the next row groups
+            if sizer is not None:
+                sizer.observe(chunk_metrics, chunk_metrics.get("batch_bytes", 0))
+
+            remaining -= 1
+            sources[f_path] = (manifest, remaining, source_name, final_parquet, temp_parquet, parts_dir)
+
+            # When all the row groups of a source are ready, build its final file
+            if remaining == 0:
+                finish_source(manifest, source_name, final_parquet, temp_parquet, parts_dir, vocab)
+                stage_metrics.progress(source_name)
 
+    profiling.stop_process(profiler)
+    stage_metrics.finish()
+    if sizer is not None:
+        sizer.report("spacy")
+
+    # Vocabulary of all the sources
+    if vocab:
+        merge_vocabulary()
+
+
+def checkpoint_settings(batch_size, vocab):
+
+    """
+    Settings saved in the checkpoint. vocab is only added when it is used, so the
+    checkpoints of runs without vocabulary are still valid.
+    The output columns are saved too: parts written before a column was added are not reused.
+    batch_size None (memory budget) is saved as "budget": the parts of any budget can be reused.
+
+    """
+    settings = {"batch_size": batch_size if batch_size is not None else "budget",
+                "columns": ["clean_embedding_text"] + context_columns}
+    if vocab:
+        settings["vocab"] = True
+    return settings
+
+
+def finish_source(manifest, source_name, final_parquet, temp_parquet, parts_dir, vocab=False):
+
+    """
+    Copies the parts of a source to the final parquet
+    (and merges the vocabulary of the parts if vocab is True).
+
+    """
+    # The vocabulary is merged first, finish_checkpoint deletes the parts directory
+    if vocab:
+        finish_source_vocab(manifest, parts_dir, source_name)
+
+    # Copy the parts to the final parquet (temporary name first and then renamed)
+    if finish_checkpoint(manifest, parts_dir, final_parquet, temp_parquet):
+        print(f"\nFinished processing {source_name} and saved to {final_parquet}\n")
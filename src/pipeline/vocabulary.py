@@ -0,0 +1,183 @@
+# Vocabulary index of the spacy output
+
+"""
+
+While the spacy stage runs (spacy_for_embedding.py with vocab=True) the lemmas of every
+row are counted, so keyword extraction, TF-IDF baselines or stopword tuning can use
+the counts without reading the whole corpus again.
+
+    - Each row group (part) saves its counts next to the part: lemma, df (rows with the lemma)
+      and count (total occurrences). The number of rows is saved in the file metadata (n_docs)
+    - When a source is finished its parts are merged in <source>_vocab.parquet
+    - merge_vocabulary joins all the sources in vocabulary.parquet (id, lemma, df, count) and
+      vocabulary_by_source.parquet (id, source, df, count)
+
+The lemmas are the tokens of clean_embedding_text (lemmatized, without stopwords).
+
+"""
+
+import os
+import json
+from collections import Counter
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Same directory as the spacy output
+vocab_dir = Path("data/processed/spacy")
+
+vocab_schema = pa.schema([("lemma", pa.string()), ("df", pa.int64()), ("count", pa.int64())])
+
+
+def count_terms(texts):
+
+    """
+    Counts the lemmas of a list of texts.
+    Output: (Counter of document frequency, Counter of occurrences, number of texts)
+
+    """
+    df = Counter()
+    counts = Counter()
+
+    for text in texts:
+        tokens = (text or "").split()
+        counts.update(tokens)
+        df.update(set(tokens))
+
+    return df, counts, len(texts)
+
+
+def counts_table(df, counts):
+
+    """
+    Table (lemma, df, count) sorted by lemma.
+
+    """
+    lemmas = sorted(counts)
+    return pa.table(
+        [pa.array(lemmas, type=pa.string()),
+         pa.array([df[lemma] for lemma in lemmas], type=pa.int64()),
+         pa.array([counts[lemma] for lemma in lemmas], type=pa.int64())],
+        schema=vocab_schema,
+    )
+
+
+def write_vocab(path, table, n_docs):
+
+    """
+    Writes a vocabulary table with the number of documents in the metadata.
+    Temporary name and rename, so the file is complete or doesn't exist.
+
+    """
+    path = Path(path)
+    temp = path.with_name(path.name + ".tmp")
+    table = table.replace_schema_metadata({"n_docs": str(n_docs)})
+    pq.write_table(table, temp, compression="snappy")
+    os.replace(temp, path)
+
+
+def read_n_docs(path):
+
+    """
+    Number of documents saved in the metadata of a vocabulary file.
+
+    """
+    metadata = pq.read_schema(path).metadata or {}
+    return int(metadata.get(b"n_docs", 0))
+
+
+def part_vocab_name(part_name):
+
+    """
+    Name of the vocabulary file of one part (part-000000000000003.parquet -> part-000000000000003.vocab.parquet).
+
+    """
+    return part_name.replace(".parquet", ".vocab.parquet")
+
+
+def merge_tables(tables):
+
+    """
+    Adds df and count of the same lemma in many tables.
+
+    """
+    tables = [t for t in tables if t.num_rows > 0]
+    if len(tables) == 0:
+        return vocab_schema.empty_table()
+
+    merged = pa.concat_tables(tables).group_by("lemma").aggregate([("df", "sum"), ("count", "sum")])
+    merged = merged.select(["lemma", "df_sum", "count_sum"]).rename_columns(["lemma", "df", "count"])
+    return merged.sort_by("lemma")
+
+
+def source_vocab_path(source_name):
+
+    """
+    Vocabulary file of one source.
+
+    """
+    return vocab_dir / f"{source_name}_vocab.parquet"
+
+
+def finish_source_vocab(manifest, parts_dir, source_name):
+
+    """
+    Merges the vocabulary of all the parts of a source (before the parts directory is deleted).
+
+    """
+    tables = []
+    n_docs = 0
+    for part in manifest["parts"]:
+        path = Path(parts_dir) / part_vocab_name(part["file"])
+        if not path.exists():
+            print(f"WARNING: {path.name} not found, the vocabulary of {source_name} is incomplete.")
+            continue
+        tables.append(pq.read_table(path))
+        n_docs += read_n_docs(path)
+
+    write_vocab(source_vocab_path(source_name), merge_tables(tables), n_docs)
+    print(f"Vocabulary of {source_name} saved ({n_docs} rows).")
+
+
+def merge_vocabulary():
+
+    """
+    Joins the vocabulary of all the sources.
+
+    Output:
+    - vocabulary.parquet: id, lemma, df, count (all the sources, id by count from the most frequent)
+    - vocabulary_by_source.parquet: id, source, df, count
+    - _vocabulary.json: number of rows by source (to compute idf)
+
+    """
+    files = sorted(vocab_dir.glob("*_vocab.parquet"))
+    if len(files) == 0:
+        print("No vocabulary files found.")
+        return
+
+    by_source = []
+    n_docs = {}
+    for f in files:
+        source_name = f.name[:-len("_vocab.parquet")]
+        table = pq.read_table(f)
+        by_source.append(table.append_column("source", pa.array([source_name] * table.num_rows, type=pa.string())))
+        n_docs[source_name] = read_n_docs(f)
+
+    totals = merge_tables([t.select(["lemma", "df", "count"]) for t in by_source])
+
+    # id: position by count (most frequent first), lemma to break ties
+    totals = totals.sort_by([("count", "descending"), ("lemma", "ascending")])
+    totals = totals.add_column(0, "id", pa.array(range(totals.num_rows), type=pa.int64()))
+    write_vocab(vocab_dir / "vocabulary.parquet", totals, sum(n_docs.values()))
+
+    # Same ids for the counts of each source
+    ids = totals.select(["id", "lemma"])
+    sources = pa.concat_tables(by_source).join(ids, "lemma")
+    sources = sources.select(["id", "source", "df", "count"]).sort_by([("id", "ascending"), ("source", "ascending")])
+    write_vocab(vocab_dir / "vocabulary_by_source.parquet", sources, sum(n_docs.values()))
+
+    with open(vocab_dir / "_vocabulary.json", "w") as f:
+        json.dump({"n_docs": n_docs, "lemmas": totals.num_rows}, f, indent=2)
+
+    print(f"Vocabulary of {len(files)} sources: {totals.num_rows} lemmas, {sum(n_docs.values())} rows.")
@@ -0,0 +1,82 @@
+# Start of the worker processes of the pool stages
+
+"""
+
+The models (fasttext for the language, spacy for the lemmas) are loaded the first time
+they are used, not when the modules are imported. The pool stages load them before
+the first chunk so no chunk pays the cost:
+
+    - fork (Linux): the models are loaded once in the parent before the pool is created,
+      the workers get them already loaded (copy-on-write), nothing is loaded again
+    - spawn (Windows, macOS): every worker starts a new python, the pool initializer
+      loads the models once per worker when it starts
+
+make_pool does both: preload in the parent if the workers are forked and init_worker as
+the initializer of the pool (it doesn't load anything if the models are already there).
+
+"""
+
+import time
+import multiprocessing
+from multiprocessing import Pool
+
+from src.pipeline import batch_budget
+from src.text import lang_detection, spacy_process
+
+
+# Function that loads each model (once per process)
+loaders = {
+    "fasttext": lang_detection.load_model,
+    "spacy": spacy_process.load_nlp,
+}
+
+
+def uses_fork():
+
+    """
+    True if the pool workers are created with fork (they get a copy of the parent).
+
+    """
+    return multiprocessing.get_start_method() == "fork"
+
+
+def load_models(models):
+
+    """
+    Loads the models (names of loaders) in this process.
+    Returns the seconds it took (0 if they were already loaded).
+
+    """
+    begin = time.perf_counter()
+    for name in models:
+        loaders[name]()
+    return time.perf_counter() - begin
+
+
+def init_worker(models, budget_target=None):
+
+    """
+    Pool initializer: loads the models of the stage in the worker and
+    receives the shared target of the memory budget (batch_budget.py).
+
+    """
+    batch_budget.init_worker(budget_target)
+    load_models(models)
+
+
+def make_pool(workers, models, budget_target=None):
+
+    """
+    Creates the pool of a stage with the models already loaded in the workers.
+    With fork they are loaded in the parent first, so the workers start with them.
+
+    models: list of names in loaders, for example ["fasttext", "spacy"]
+    budget_target: shared target bytes of the memory budget (BatchSizer.shared) or None
+
+    """
+    if uses_fork():
+        seconds = load_models(models)
+        if seconds > 0.05:
+            print(f"Models loaded in {seconds:.1f}s before starting the workers: {', '.join(models)}")
+
+    return Pool(workers, initializer=init_worker, initargs=(models, budget_target))
@@ -0,0 +1,271 @@
+# Query layer for the Streamlit app
+
+"""
+
+Functions used by the app to get the breakdowns of the reviews by cluster, source,
+overall and time, with the same filters everywhere:
+
+    clusters, sources, overall: lists of values (None: all)
+    start, end: dates "YYYY-MM-DD" (None: no limit)
+
+    - breakdown: number of reviews grouped by any of cluster, source, overall
+    - over_time: number of reviews by month, quarter or year (optionally also by cluster, source, overall)
+    - cluster_summary: one row per cluster (label, reviews, dates, average overall and distance)
+    - sample_reviews: detail rows (the only query that reads the reviews, with pushdown)
+
+The breakdowns are answered from the rollups (rollups.py) when they are built for the current
+dataset version, otherwise from the parquet files (slower). The rollups have one row per month,
+so a date filter that doesn't cover whole months (start not the first day of a month or end
+not the last day) is answered from the parquet files too: same numbers with and without rollups.
+Every result is cached by query and dataset version (query_cache.py).
+
+Use:
+    q = open_queries(model_name)
+    df = breakdown(q, by=["cluster"], sources=["Books"], start="2015-01-01")
+
+"""
+
+import time
+import calendar
+import datetime
+
+from src.pipeline.embedding import default_model
+from src.query.views import connect, dataset_version, sql_path
+from src.query.rollups import rollups_dir_for, rollups_version
+from src.query.query_cache import QueryCache, query_key
+
+
+# Columns that can be used to group the results
+group_columns = ["cluster", "source", "overall"]
+
+# Periods of over_time
+periods = ["month", "quarter", "year"]
+
+# Columns that sample_reviews can return
+review_columns = ["row_id", "asin", "source", "overall", "cluster", "distance", "review_date", "clean_embedding_text"]
+
+
+def open_queries(model_name=default_model, dedup=False, threads=None, memory_limit=None, use_cache=True):
+
+    """
+    Opens the views and the cache of one clustering.
+    Returns a dictionary used by the other functions (None if there is no data).
+
+    """
+    con = connect(model_name, dedup, threads, memory_limit)
+    if con is None:
+        return None
+
+    version = dataset_version(model_name, dedup)
+
+    # The rollups are only used if they were built with the current data
+    rollups = rollups_version(model_name, dedup) == version
+    if rollups:
+        con.execute("CREATE VIEW cluster_month AS SELECT * FROM read_parquet("
+                    f"{sql_path(rollups_dir_for(model_name, dedup) / 'cluster_month.parquet')})")
+        con.execute("CREATE VIEW cluster_summary AS SELECT * FROM read_parquet("
+                    f"{sql_path(rollups_dir_for(model_name, dedup) / 'clusters.parquet')})")
+    else:
+        print("Rollups not built for the current data (rollups.build_rollups), the queries read the parquet files.")
+
+    return {
+        "con": con,
+        "version": version,
+        "rollups": rollups,
+        "cache": QueryCache(version, disk=use_cache),
+        "last_ms": None,
+    }
+
+
+def run_query(q, sql, params=None):
+
+    """
+    Runs a query (or takes it from the cache) and returns a pandas data frame.
+    The time of the last call is saved in q["last_ms"].
+
+    """
+    params = params or []
+    begin = time.time()
+
+    key = query_key(sql, params)
+    table = q["cache"].get(key)
+    if table is None:
+        table = q["con"].execute(sql, params).fetch_arrow_table()
+        q["cache"].put(key, table)
+
+    q["last_ms"] = 1000 * (time.time() - begin)
+    return table.to_pandas()
+
+
+def where_clause(clusters=None, sources=None, overall=None, start=None, end=None, date_column="month", prefix=""):
+
+    """
+    WHERE of the filters with ? parameters (values are never written in the SQL).
+
+    date_column: month for the rollups, review_date for the parquet files
+    prefix: alias of the table ("c." when the query has a join)
+    Returns (sql, params).
+
+    """
+    conditions = []
+    params = []
+
+    for column, values in [("cluster", clusters), ("source", sources), ("overall", overall)]:
+        if values is None:
+            continue
+        values = list(values)
+        if len(values) == 0:
+            conditions.append("FALSE")
+            continue
+        conditions.append(f"{prefix}{column} IN ({', '.join(['?'] * len(values))})")
+        params.extend(values)
+
+    # The rollups have the first day of the month, so the start is moved to its month
+    if start is not None:
+        if date_column == "month":
+            conditions.append(f"{prefix}month >= CAST(date_trunc('month', CAST(? AS DATE)) AS DATE)")
+        else:
+            conditions.append(f"{prefix}{date_column} >= CAST(? AS DATE)")
+        params.append(str(start))
+    if end is not None:
+        conditions.append(f"{prefix}{date_column} <= CAST(? AS DATE)")
+        params.append(str(end))
+
+    if len(conditions) == 0:
+        return "", params
+    return "WHERE " + " AND ".join(conditions), params
+
+
+def check_columns(columns, allowed):
+
+    """
+    Only known column names are written in the SQL.
+
+    """
+    columns = list(columns)
+    for column in columns:
+        if column not in allowed:
+            raise ValueError(f"Unknown column '{column}', use one of {allowed}")
+    return columns
+
+
+def whole_months(start, end):
+
+    """
+    True if the dates cover whole months: start on the first day of a month and end on the
+    last day (None: no limit). Values that are not dates are left to the parquet files.
+
+    """
+    try:
+        if start is not None and datetime.date.fromisoformat(str(start)).day != 1:
+            return False
+        if end is not None:
+            end = datetime.date.fromisoformat(str(end))
+            if end.day != calendar.monthrange(end.year, end.month)[1]:
+                return False
+    except ValueError:
+        return False
+    return True
+
+
+def source_table(q, start=None, end=None):
+
+    """
+    Table and date column used by the breakdowns: the rollups (only for whole months)
+    or the joined parquet files.
+
+    """
+    if q["rollups"] and whole_months(start, end):
+        return "cluster_month", "reviews", "month"
+    return "review_clusters", "1", "review_date"
+
+
+def breakdown(q, by=("cluster",), clusters=None, sources=None, overall=None, start=None, end=None):
+
+    """
+    Number of reviews grouped by the columns in by (cluster, source, overall), largest first.
+
+    """
+    by = check_columns(by, group_columns)
+    table, count, date_column = source_table(q, start, end)
+    where, params = where_clause(clusters, sources, overall, start, end, date_column)
+
+    group = ", ".join(by)
+    select = f"{group}, " if len(by) > 0 else ""
+    group_by = f"GROUP BY {group} ORDER BY reviews DESC, {group}" if len(by) > 0 else ""
+
+    sql = f"SELECT {select}CAST(coalesce(sum({count}), 0) AS BIGINT) AS reviews FROM {table} {where} {group_by}"
+    return run_query(q, sql, params)
+
+
+def over_time(q, period="month", by=(), clusters=None, sources=None, overall=None, start=None, end=None):
+
+    """
+    Number of reviews by period (month, quarter or year), optionally also by cluster, source or overall.
+
+    """
+    if period not in periods:
+        raise ValueError(f"Unknown period '{period}', use one of {periods}")
+
+    by = check_columns(by, group_columns)
+    table, count, date_column = source_table(q, start, end)
+    where, params = where_clause(clusters, sources, overall, start, end, date_column)
+
+    group = ", ".join(["period"] + by)
+    sql = (f"SELECT CAST(date_trunc('{period}', {date_column}) AS DATE) AS period, "
+           f"{''.join(c + ', ' for c in by)}CAST(sum({count}) AS BIGINT) AS reviews "
+           f"FROM {table} {where} GROUP BY {group} ORDER BY {group}")
+    return run_query(q, sql, params)
+
+
+def cluster_summary(q):
+
+    """
+    One row per cluster: label, reviews, sources, first and last month, average overall and distance.
+    Same columns with and without rollups (label is null if labeling.py was not run).
+
+    """
+    if q["rollups"]:
+        return run_query(q, "SELECT * FROM cluster_summary ORDER BY cluster")
+
+    # Labels are added if labeling.py was run (same as the rollups)
+    has_labels = len(q["con"].execute("SELECT * FROM duckdb_views() WHERE view_name = 'labels'").fetchall()) > 0
+    label = "l.label" if has_labels else "CAST(NULL AS VARCHAR) AS label"
+    join = "LEFT JOIN labels l USING (cluster)" if has_labels else ""
+
+    sql = f"""
+        SELECT t.cluster, {label}, t.reviews, t.sources, t.first_month, t.last_month, t.avg_overall, t.avg_distance
+        FROM (
+            SELECT cluster, count(*) AS reviews, count(DISTINCT source) AS sources,
+                   CAST(date_trunc('month', min(review_date)) AS DATE) AS first_month,
+                   CAST(date_trunc('month', max(review_date)) AS DATE) AS last_month,
+                   avg(overall) AS avg_overall, avg(distance) AS avg_distance
+            FROM review_clusters GROUP BY cluster
+        ) t {join}
+        ORDER BY t.cluster
+    """
+    return run_query(q, sql)
+
+
+def sample_reviews(q, clusters=None, sources=None, overall=None, start=None, end=None,
+                   columns=("row_id", "source", "overall", "cluster", "review_date", "clean_embedding_text"),
+                   limit=100, closest=True):
+
+    """
+    Reviews that match the filters (detail rows).
+
+    closest: the reviews closest to the centroid of their cluster first (the most typical ones),
+             otherwise in row order
+    Only the columns asked are read, and the filters on source, overall and date skip row groups.
+
+    """
+    columns = check_columns(columns, review_columns)
+    where, params = where_clause(clusters, sources, overall, start, end, "review_date", prefix="c.")
+
+    # clean_embedding_text is only in the reviews, the rest is in review_clusters
+    select = ", ".join(f"r.{c}" if c == "clean_embedding_text" else f"c.{c}" for c in columns)
+    order = "c.distance, c.row_id" if closest else "c.row_id"
+
+    join = "JOIN reviews r USING (row_id)" if "clean_embedding_text" in columns else ""
+    sql = f"SELECT {select} FROM review_clusters c {join} {where} ORDER BY {order} LIMIT ?"
+    return run_query(q, sql, params + [int(limit)])
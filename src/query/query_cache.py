@@ -0,0 +1,153 @@
+# Cache of query results by query and dataset version
+
+"""
+
+Results of the query layer (queries.py) saved so the same filter is answered without
+running DuckDB again:
+
+    - Memory: the last max_entries results (LRU), for the reruns of the same app session
+    - Disk: one parquet file per result in data/query_cache/<dataset version>/<key>.parquet,
+      shared by all the sessions and kept after a restart
+
+The key is a hash of the SQL and its parameters. The dataset version (views.dataset_version)
+is part of the path, so new data never returns old results.
+
+Opening a cache never deletes anything (other models and apps can be using other versions).
+The directories of the versions not used for a while are deleted with an explicit step:
+
+    python -m src.query.query_cache --max-age-days 30 --keep 8
+
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+import pyarrow.parquet as pq
+
+
+# Directory of the cache
+cache_dir = Path("data/query_cache")
+
+
+def query_key(sql, params):
+
+    """
+    Key of one query: hash of the SQL (spaces normalized) and its parameters.
+
+    """
+    text = " ".join(sql.split()) + "|" + json.dumps(params, default=str)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class QueryCache:
+
+    """
+    Memory (LRU) + disk cache of Arrow tables for one dataset version.
+
+    """
+
+    def __init__(self, version, max_entries=256, disk=True):
+        self.version = version
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.directory = cache_dir / version if disk else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+            # Last use of the version (modification time of its directory), used by clean_cache
+            os.utime(self.directory)
+
+    def get(self, key):
+
+        """
+        Table of the key or None.
+
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.directory is not None and (self.directory / f"{key}.parquet").exists():
+            table = pq.read_table(self.directory / f"{key}.parquet")
+            self.remember(key, table)
+            self.hits += 1
+            return table
+
+        self.misses += 1
+        return None
+
+    def put(self, key, table):
+
+        """
+        Saves a result (memory and disk).
+
+        """
+        self.remember(key, table)
+
+        if self.directory is not None:
+            path = self.directory / f"{key}.parquet"
+            temp = path.with_name(path.name + ".tmp")
+            pq.write_table(table, temp)
+            os.replace(temp, path)
+
+    def remember(self, key, table):
+
+        """
+        Adds a table to the memory cache and drops the least recently used ones.
+
+        """
+        self.memory[key] = table
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+
+        """
+        Hits, misses and entries in memory.
+
+        """
+        return {"version": self.version, "hits": self.hits, "misses": self.misses, "entries": len(self.memory)}
+
+
+def clean_cache(max_age_days=30, keep=8):
+
+    """
+    Deletes the directories of the dataset versions not used for max_age_days,
+    and of the least recently used ones when there are more than keep versions.
+    Returns the names of the versions deleted.
+
+    """
+    if not cache_dir.exists():
+        return []
+
+    # Most recently used first
+    versions = sorted([d for d in cache_dir.iterdir() if d.is_dir()], key=lambda d: d.stat().st_mtime, reverse=True)
+    oldest = time.time() - max_age_days * 24 * 3600
+
+    deleted = []
+    for i, directory in enumerate(versions):
+        if i >= keep or directory.stat().st_mtime < oldest:
+            shutil.rmtree(directory, ignore_errors=True)
+            deleted.append(directory.name)
+
+    print(f"Query cache: {len(deleted)} versions deleted, {len(versions) - len(deleted)} kept.")
+    return deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Delete the query cache of the dataset versions not used for a while")
+    parser.add_argument("--max-age-days", type=float, default=30)
+    parser.add_argument("--keep", type=int, default=8, help="most recently used versions kept")
+    args = parser.parse_args()
+
+    clean_cache(args.max_age_days, args.keep)
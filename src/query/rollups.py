@@ -0,0 +1,135 @@
+# Rollup tables for the app (built at the end of the pipeline)
+
+"""
+
+Precomputed aggregates of one clustering, small enough to answer the filters of the app
+in milliseconds (the detail rows are only read when the app asks for reviews):
+
+    - cluster_month.parquet: cluster, source, overall, month -> reviews, distance_sum
+      (every breakdown by cluster, source, overall or time is a sum over this table)
+    - clusters.parquet: cluster, label, reviews, sources, first_month, last_month, avg_overall, avg_distance
+
+Built with DuckDB directly from the parquet files (views.py), nothing is loaded in pandas.
+_rollups.json saves the dataset version used, so the rollups are only built again
+when the data changed (new source, new clustering or new labels).
+
+Output: data/clusters/<embeddings directory>/rollups/
+
+Run at the end of the pipeline (after clustering.py and labeling.py):
+    build_rollups(model_name)
+
+"""
+
+import os
+import json
+import time
+
+from src.pipeline.embedding import default_model
+from src.pipeline.clustering import output_dir_for
+from src.pipeline.merge_parquet import save_json
+from src.pipeline.memory import peak_rss_mb
+from src.query.views import connect, dataset_version, sql_path
+
+
+def rollups_dir_for(model_name, dedup=False):
+
+    """
+    Directory of the rollups of one clustering.
+
+    """
+    return output_dir_for(model_name, dedup) / "rollups"
+
+
+def rollups_version(model_name, dedup=False):
+
+    """
+    Dataset version of the saved rollups (None if they were never built).
+
+    """
+    path = rollups_dir_for(model_name, dedup) / "_rollups.json"
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)["version"]
+
+
+def copy_to_parquet(con, select, path):
+
+    """
+    Writes the result of a query to parquet (temporary name and rename).
+
+    """
+    temp = path.with_name(path.name + ".tmp")
+    con.execute(f"COPY ({select}) TO {sql_path(temp)} (FORMAT PARQUET, COMPRESSION ZSTD)")
+    os.replace(temp, path)
+
+
+def build_rollups(model_name=default_model, dedup=False, force=False, threads=None, memory_limit=None):
+
+    """
+    Builds the rollup tables of one clustering.
+
+    force: build them even if the dataset version didn't change
+
+    """
+    if not (output_dir_for(model_name, dedup) / "clusters.parquet").exists():
+        print("No clusters.parquet found, run clustering.py first.")
+        return
+
+    version = dataset_version(model_name, dedup)
+    if not force and rollups_version(model_name, dedup) == version:
+        print(f"Rollups already built for {version}.")
+        return
+
+    out_dir = rollups_dir_for(model_name, dedup)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # The version is deleted first, so an interrupted build is never used as complete
+    (out_dir / "_rollups.json").unlink(missing_ok=True)
+
+    con = connect(model_name, dedup, threads, memory_limit)
+    begin = time.time()
+
+    # One pass over the clusters joined with the dates, everything else is computed from this table
+    copy_to_parquet(con, """
+        SELECT cluster, source, overall,
+               CAST(date_trunc('month', review_date) AS DATE) AS month,
+               count(*) AS reviews,
+               sum(distance) AS distance_sum
+        FROM review_clusters
+        GROUP BY ALL
+        ORDER BY cluster, month, source, overall
+    """, out_dir / "cluster_month.parquet")
+
+    con.execute(f"CREATE VIEW cluster_month AS SELECT * FROM read_parquet({sql_path(out_dir / 'cluster_month.parquet')})")
+
+    # Labels are added if labeling.py was run
+    has_labels = len(con.execute("SELECT * FROM duckdb_views() WHERE view_name = 'labels'").fetchall()) > 0
+    label = "l.label" if has_labels else "CAST(NULL AS VARCHAR) AS label"
+    join = "LEFT JOIN labels l USING (cluster)" if has_labels else ""
+
+    copy_to_parquet(con, f"""
+        SELECT t.cluster, {label}, t.reviews, t.sources, t.first_month, t.last_month, t.avg_overall, t.avg_distance
+        FROM (
+            SELECT cluster,
+                   CAST(sum(reviews) AS BIGINT) AS reviews,
+                   count(DISTINCT source) AS sources,
+                   min(month) AS first_month,
+                   max(month) AS last_month,
+                   sum(overall * reviews) / sum(reviews) AS avg_overall,
+                   sum(distance_sum) / sum(reviews) AS avg_distance
+            FROM cluster_month
+            GROUP BY cluster
+        ) t {join}
+        ORDER BY t.cluster
+    """, out_dir / "clusters.parquet")
+
+    rows = con.execute("SELECT count(*), sum(reviews) FROM cluster_month").fetchone()
+    con.close()
+
+    save_json({"version": version, "model": model_name, "dedup": dedup,
+               "rollup_rows": rows[0], "reviews": rows[1], "built": time.strftime("%Y-%m-%d %H:%M:%S")},
+              out_dir / "_rollups.json")
+
+    print(f"Rollups of {rows[1]} reviews ({rows[0]} rows) saved in {out_dir} "
+          f"in {time.time() - begin:.1f} s (peak memory {peak_rss_mb():.0f} MB)")
@@ -0,0 +1,144 @@
+# DuckDB views over the processed parquet outputs
+
+"""
+
+Opens a DuckDB connection with views over the parquet files of the pipeline, so the
+queries run directly on the files (nothing is loaded in pandas first):
+
+    - reviews: spacy output (data/processed/spacy/<source>_spacy.parquet) with row_id,
+      asin, source, overall, unixReviewTime, review_date, clean_embedding_text
+    - clusters: clusters.parquet of one clustering (row_id, asin, source, overall, cluster, distance)
+    - labels: labels.parquet of the clustering (if labeling.py was run)
+    - review_clusters: clusters joined with the date of the review (by row_id)
+
+DuckDB only reads the columns used by a query (projection pushdown) and skips the row groups
+whose statistics don't match the filters (predicate pushdown), so the filters on source,
+overall or unixReviewTime don't read the whole dataset.
+
+The row_id of the reviews is the position of the row in the spacy files (sorted by name),
+the same numbering used by dedup.py, embedding.py and clustering.py.
+
+"""
+
+import json
+import hashlib
+import duckdb
+import pyarrow.parquet as pq
+
+from src.pipeline import dedup as dedup_stage
+from src.pipeline import merge_parquet
+from src.pipeline.checkpoint import input_info
+from src.pipeline.clustering import output_dir_for
+
+
+def sql_path(path):
+
+    """
+    Path as a SQL string literal.
+
+    """
+    return "'" + str(path).replace("'", "''") + "'"
+
+
+def reviews_sql(files):
+
+    """
+    SELECT of the spacy files with the row_id (offset of the file + position in the file).
+    One SELECT per file joined with UNION ALL, the filters are pushed down to every file.
+
+    """
+    parts = []
+    offset = 0
+    for f in files:
+        columns = pq.read_schema(f).names
+
+        # Outputs written before unixReviewTime was kept don't have it
+        review_time = "unixReviewTime" if "unixReviewTime" in columns else "CAST(NULL AS BIGINT) AS unixReviewTime"
+
+        parts.append(
+            f"SELECT file_row_number + {offset} AS row_id, asin, source, overall, {review_time}, clean_embedding_text "
+            f"FROM read_parquet({sql_path(f)}, file_row_number = true)"
+        )
+        offset += pq.read_metadata(f).num_rows
+
+    select = "\nUNION ALL\n".join(parts)
+    return f"SELECT *, CAST(to_timestamp(unixReviewTime) AS DATE) AS review_date FROM (\n{select}\n)"
+
+
+def short_hash(text):
+
+    """
+    Short stable hash of a text (hex).
+
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def labels_path_for(model_name, dedup=False):
+
+    """
+    Labels file of one clustering. labeling.py is only imported here (it imports scipy),
+    so importing the query layer stays fast.
+
+    """
+    from src.pipeline.labeling import labels_dir_for
+    return labels_dir_for(model_name, dedup) / "labels.parquet"
+
+
+def dataset_version(model_name, dedup=False):
+
+    """
+    Version of the data used by the queries: version of the merged dataset (merge_parquet.py)
+    + size and modification time of the spacy files and of the clustering outputs.
+    Any new source, new clustering or new labels gives a new version (and new cache keys).
+
+    """
+    manifest = merge_parquet.load_manifest()
+    out_dir = output_dir_for(model_name, dedup)
+
+    files = dedup_stage.spacy_files()
+    files += [p for p in [out_dir / "clusters.parquet", labels_path_for(model_name, dedup)] if p.exists()]
+
+    fingerprint = json.dumps([manifest["version"]] + [input_info(f) for f in files], sort_keys=True)
+    return f"v{manifest['version']}-{short_hash(fingerprint)}"
+
+
+def connect(model_name, dedup=False, threads=None, memory_limit=None):
+
+    """
+    DuckDB connection (in memory) with the views of the pipeline outputs.
+
+    threads: threads used by DuckDB (default: all the cores)
+    memory_limit: for example "2GB" (default: DuckDB default, 80% of the RAM)
+
+    Returns None if there are no spacy files.
+
+    """
+    files = dedup_stage.spacy_files()
+    if len(files) == 0:
+        print("No spacy files found.")
+        return None
+
+    con = duckdb.connect()
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = {sql_path(memory_limit)}")
+
+    con.execute(f"CREATE VIEW reviews AS {reviews_sql(files)}")
+
+    out_dir = output_dir_for(model_name, dedup)
+    clusters_path = out_dir / "clusters.parquet"
+    if clusters_path.exists():
+        con.execute(f"CREATE VIEW clusters AS SELECT * FROM read_parquet({sql_path(clusters_path)})")
+        con.execute(
+            "CREATE VIEW review_clusters AS "
+            "SELECT c.row_id, c.asin, c.source, c.overall, c.cluster, c.distance, r.unixReviewTime, r.review_date "
+            "FROM clusters c JOIN reviews r USING (row_id)"
+        )
+
+    labels_path = labels_path_for(model_name, dedup)
+    if labels_path.exists():
+        con.execute(f"CREATE VIEW labels AS SELECT * FROM read_parquet({sql_path(labels_path)})")
+
+    return con
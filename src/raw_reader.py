@@ -0,0 +1,241 @@
+# Read raw Amazon files (.json or .json.gz) directly to Arrow
+
+"""
+
+    This module reads the raw review files in batches using the Arrow JSON parser.
+
+    - Only the columns in select_columns.py (text and context) are parsed, the rest
+      of the fields (style, image, reviewerName, vote...) are ignored by the parser
+    - Explicit schema, so every batch has the same columns and types
+    - Batch size in rows (configurable), or in rows and bytes for the memory budget
+    - .json.gz files are decompressed in a separate thread while the batches are parsed
+
+"""
+
+import io
+import gzip
+import queue
+import threading
+from itertools import islice
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.json as pa_json
+
+from src.features.select_columns import text_cols, context_cols
+
+
+# Type of each column that is read from the raw files
+column_types = {
+    "reviewText": pa.string(),
+    "summary": pa.string(),
+    "asin": pa.string(),
+    "overall": pa.float64(),
+    "unixReviewTime": pa.int64(),
+}
+
+
+def raw_schema(columns=None):
+
+    """
+    Returns the Arrow schema used to read the raw files.
+    By default: text columns + context columns (select_columns.py)
+
+    """
+    if columns is None:
+        columns = text_cols + context_cols
+
+    return pa.schema([(col, column_types.get(col, pa.string())) for col in columns])
+
+
+class ThreadedGzipReader(io.RawIOBase):
+
+    """
+    File object that decompresses a .gz file in a background thread.
+    The decompressed blocks are saved in a queue with a limited size, so the
+    decompression runs at the same time as the parsing without using too much memory.
+
+    """
+
+    def __init__(self, f_path, block_size=4 * 1024 * 1024, max_blocks=8, start_offset=0):
+        super().__init__()
+        self.f_path = f_path
+        self.start_offset = start_offset
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=max_blocks)
+        self.buffer = memoryview(b"")
+        self.finished = False
+        self.stop = threading.Event()
+
+        # Open the file here so errors (file not found, permissions) are raised right away
+        self.gz_file = gzip.open(f_path, "rb")
+
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _decompress(self):
+        try:
+            # To resume from an offset the data before it is decompressed but not parsed
+            if self.start_offset > 0:
+                self.gz_file.seek(self.start_offset)
+
+            while not self.stop.is_set():
+                block = self.gz_file.read(self.block_size)
+                self._put(block)
+                if not block: # Empty block means end of file
+                    break
+        except Exception as e:
+            # The error is sent to the reader so it is raised in the main thread
+            self._put(e)
+
+    def _put(self, item):
+        # Wait for space in the queue, checking from time to time if the reader was closed
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self.buffer) == 0:
+            if self.finished:
+                return 0
+            item = self.blocks.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                self.finished = True
+                return 0
+            self.buffer = memoryview(item)
+
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+            self.gz_file.close()
+        super().close()
+
+
+def open_raw(f_path, start_offset=0):
+
+    """
+    Opens a raw file (.json or .json.gz) as a binary file object that can be read line by line.
+    start_offset: position (in uncompressed bytes) where the reading starts
+
+    """
+    f_path = Path(f_path)
+
+    if f_path.suffix == ".gz":
+        return io.BufferedReader(ThreadedGzipReader(f_path, start_offset=start_offset), buffer_size=1024 * 1024)
+
+    f = open(f_path, "rb", buffering=1024 * 1024)
+    f.seek(start_offset)
+    return f
+
+
+def parse_lines(lines, schema):
+
+    """
+    Parses a list of JSON lines (bytes) with the Arrow parser.
+    Returns a record batch with the columns of the schema (missing fields are null).
+
+    """
+    block = b"".join(lines)
+
+    # Arrow parses the JSON in blocks, each block should be bigger than the longest line
+    block_size = max(4 * 1024 * 1024, max(len(line) for line in lines) + 1)
+
+    table = pa_json.read_json(
+        pa.BufferReader(block),
+        read_options=pa_json.ReadOptions(block_size=block_size),
+        # Fields not included in the schema are not parsed
+        parse_options=pa_json.ParseOptions(explicit_schema=schema, unexpected_field_behavior="ignore"),
+    )
+
+    # One record batch per chunk (the parser returns one chunk per block)
+    table = table.combine_chunks()
+    if table.num_rows == 0:
+        return pa.RecordBatch.from_pylist([], schema=schema)
+    return table.to_batches()[0]
+
+
+def read_lines(f, max_rows, max_bytes):
+
+    """
+    Reads lines until there are max_rows lines or max_bytes bytes (the line that passes
+    max_bytes is included, so a batch always has at least one line).
+
+    """
+    lines = []
+    size = 0
+    for line in f:
+        lines.append(line)
+        size += len(line)
+        if len(lines) >= max_rows or size >= max_bytes:
+            break
+    return lines
+
+
+def read_raw_batches(f_path, batch_size=50000, columns=None, start_offset=0, offsets=False, limits=None):
+
+    """
+    Reads a raw file (.json or .json.gz) in batches of batch_size rows.
+    Only the columns given (default: text + context columns) are parsed.
+
+    The file is opened when the function is called (errors are raised here),
+    the batches are read when the result is iterated.
+
+    start_offset: byte offset (uncompressed) of the first line to read, used to resume
+    offsets: if True yields (batch, end_offset) where end_offset is the byte offset after the
+             last line of the batch. In this mode batches with only blank lines are also yielded
+             (with 0 rows) so the offset always moves forward.
+limits: function called before every batch that returns (max rows, max bytes) of the batch,
+        used instead of batch_size (memory budget, see pipeline/batch_budget.py)
+
+    Output: iterator of Arrow record batches
+
+    """
+    schema = raw_schema(columns)
+    f = open_raw(f_path, start_offset=start_offset)
+
+    def batches():
+        position = start_offset
+        with f:
+            while True:
+                # Each line is one review
+                if limits is None:
+                    lines = list(islice(f, batch_size))
+                else:
+                    lines = read_lines(f, *limits())
+                if len(lines) == 0:
+                    break
+
+                position += sum(len(line) for line in lines)
+                batch = parse_lines(lines, schema)
+
+                if offsets:
+                    yield batch, position
+                # Skip batches with only blank lines
+                elif batch.num_rows > 0:
+                    yield batch
+
+    return batches()
+
+
+def read_raw_table(f_path, columns=None):
+
+    """
+    Reads a whole raw file (only the selected columns) in an Arrow table.
+
+    """
+    schema = raw_schema(columns)
+    return pa.Table.from_batches(list(read_raw_batches(f_path, columns=columns)), schema=schema)
@@ -0,0 +1,384 @@
+# Local HTTP service to assign new reviews to clusters
+
+"""
+
+Small asyncio HTTP server (only the standard library) around the assignment index
+(src/pipeline/assignment_index.py).
+
+    - POST /assign with {"reviewText": "...", "summary": "..."} (summary is optional)
+      returns {"cluster": 12, "distance": 0.31, "novel": false, "english": true}
+    - GET /health and GET /stats (requests, batches, average batch size, rejected)
+
+Requests that arrive at the same time are grouped in micro-batches (max_batch reviews or
+max_wait_ms, the first that happens) so the embedding model encodes them together.
+The batches run in a pool of worker processes (each one loads the index once), so the
+event loop never waits for the CPU work.
+
+Backpressure: when max_queue reviews are waiting, new requests get 503 right away
+(the client can retry) instead of making the queue and the latency grow.
+
+The function that assigns a batch can be replaced (serve(assign=...)), so the server runs
+with a stub and threads in the tests (tests/test_assign_server.py) without any model.
+An index built from the lexical embeddings (--model hashing-svd-<dim>) also runs without
+downloading a model.
+
+Run: python -m src.serving.assign_server --port 8080
+
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.pipeline.embedding import default_model
+
+
+# Index loaded in each worker (initializer)
+worker_index = {}
+
+# Largest request body accepted (bytes), bigger requests get 413 before the body is read
+max_body = 64 * 1024
+
+
+class BadRequest(Exception):
+
+    """
+    Request that can't be read (request line, headers or body size). The connection gets
+    the status and is closed, the rest of the stream can't be trusted.
+
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def init_worker(model_name, dedup):
+
+    """
+    Pool initializer: loads the index (and later the embedding model) once per worker.
+    The language and spacy models are loaded here too, so the first request doesn't wait for them.
+
+    """
+    from src.pipeline.assignment_index import load_index
+    from src.pipeline.worker_init import load_models
+    worker_index["index"] = load_index(model_name, dedup)
+    load_models(["fasttext", "spacy"])
+
+
+def assign_batch(reviews, summaries):
+
+    """
+    Assigns one micro-batch in a worker. Returns one dictionary per review.
+
+    """
+    from src.pipeline.assignment_index import assign_texts
+
+    result = assign_texts(worker_index["index"], reviews, summaries)
+
+    output = []
+    for i in range(len(reviews)):
+        english = bool(result["english"][i])
+        output.append({
+            "cluster": int(result["cluster"][i]),
+            "distance": float(result["distance"][i]) if english else None,
+            "novel": bool(result["novel"][i]),
+            "english": english,
+        })
+    return output
+
+
+class MicroBatcher:
+
+    """
+    Queue of reviews waiting to be assigned and the tasks that send them in batches to the pool.
+
+    """
+
+    def __init__(self, executor, max_batch=32, max_wait_ms=5, max_queue=1024, concurrency=1, assign=assign_batch):
+        self.executor = executor
+        self.assign = assign
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.concurrency = concurrency
+        self.tasks = []
+        self.stats = {"requests": 0, "batches": 0, "batched_reviews": 0, "rejected": 0, "errors": 0}
+
+    def start(self):
+        # One batching task per worker, so all the workers can have a batch at the same time
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def submit(self, review, summary):
+
+        """
+        Adds one review to the queue. Returns a future with the result,
+        or None if the queue is full (backpressure).
+
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((review, summary, future))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return None
+
+        self.stats["requests"] += 1
+        return future
+
+    async def next_batch(self):
+        # Wait for the first review, then take more until the batch is full or max_wait passes
+        items = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(items) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return items
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            items = await self.next_batch()
+
+            # Futures already done are not processed (cancelled with their handler, for example
+            # when the server stops)
+            items = [item for item in items if not item[2].done()]
+            if len(items) == 0:
+                continue
+
+            reviews = [item[0] for item in items]
+            summaries = [item[1] for item in items]
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.assign, reviews, summaries)
+            except Exception as e:
+                self.stats["errors"] += 1
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats["batches"] += 1
+            self.stats["batched_reviews"] += len(items)
+            for (_, _, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+async def read_request(reader):
+
+    """
+    Reads one HTTP request. Returns (method, path, headers, body) or None if the connection closed.
+    Raises BadRequest if the request is malformed or the body is bigger than max_body.
+
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise BadRequest(400, "malformed request line")
+    method, path, _ = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise BadRequest(400, "invalid Content-Length")
+    if length < 0:
+        raise BadRequest(400, "invalid Content-Length")
+    if length > max_body:
+        raise BadRequest(413, f"body bigger than {max_body} bytes")
+
+    body = b""
+    if length > 0:
+        body = await reader.readexactly(length)
+
+    return method, path, headers, body
+
+
+def write_response(writer, status, data, keep_alive=True):
+
+    """
+    Writes a JSON response.
+
+    """
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable"}
+    body = json.dumps(data).encode("utf-8")
+
+    headers = [
+        f"HTTP/1.1 {status} {reasons.get(status, '')}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    if status == 503:
+        headers.append("Retry-After: 1")
+
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+
+
+async def handle_assign(batcher, body):
+
+    """
+    POST /assign: returns (status, response data).
+
+    """
+    try:
+        data = json.loads(body or b"{}")
+    except json.JSONDecodeError:
+        return 400, {"error": "body must be JSON"}
+
+    # Only a JSON object is valid (a list or a number has no fields)
+    if not isinstance(data, dict):
+        return 400, {"error": "body must be a JSON object"}
+
+    review = data.get("reviewText")
+    if not isinstance(review, str):
+        return 400, {"error": "reviewText (string) is required"}
+
+    # A summary that is not a string would fail the whole micro-batch in the worker
+    summary = data.get("summary")
+    if summary is not None and not isinstance(summary, str):
+        return 400, {"error": "summary must be a string"}
+
+    future = batcher.submit(review, summary)
+    if future is None:
+        return 503, {"error": "too many requests waiting, retry later"}
+
+    try:
+        return 200, await future
+    except Exception as e:
+        return 500, {"error": str(e)}
+
+
+def make_handler(batcher):
+
+    """
+    Connection handler for asyncio.start_server (keep-alive: many requests per connection).
+
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+
+                if method == "POST" and path == "/assign":
+                    status, data = await handle_assign(batcher, body)
+                elif method == "GET" and path == "/health":
+                    status, data = 200, {"status": "ok"}
+                elif method == "GET" and path == "/stats":
+                    stats = dict(batcher.stats)
+                    stats["queue"] = batcher.queue.qsize()
+                    stats["average_batch"] = stats["batched_reviews"] / max(stats["batches"], 1)
+                    status, data = 200, stats
+                else:
+                    status, data = 404, {"error": "not found"}
+
+                write_response(writer, status, data, keep_alive)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (BadRequest, ValueError) as e:
+            # ValueError: a line longer than the limit of the stream reader
+            status = e.status if isinstance(e, BadRequest) else 400
+            write_response(writer, status, {"error": str(e)}, keep_alive=False)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host="127.0.0.1", port=8080, model_name=default_model, dedup=False, workers=1,
+                max_batch=32, max_wait_ms=5, max_queue=1024, use_threads=False, ready=None, assign=None):
+
+    """
+    Starts the server and runs until it is cancelled.
+
+    workers: processes that run the batches (each one loads the index and the model)
+    max_batch, max_wait_ms: size and waiting time of the micro-batches
+    max_queue: reviews waiting before new requests get 503
+    use_threads: threads instead of processes (for tests, everything in one process)
+    ready: optional asyncio.Event set when the server is listening
+    assign: function (reviews, summaries) -> list of results used instead of assign_batch
+            (no index is loaded). With processes it must be importable by the workers.
+
+    """
+    pool = ThreadPoolExecutor if use_threads else ProcessPoolExecutor
+    if assign is None:
+        assign = assign_batch
+        executor = pool(workers, initializer=init_worker, initargs=(model_name, dedup))
+    else:
+        executor = pool(workers)
+
+    # Load the index and the model in every worker before accepting requests
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[loop.run_in_executor(executor, assign, ["warm up the model"], [None])
+                           for _ in range(workers)])
+
+    batcher = MicroBatcher(executor, max_batch, max_wait_ms, max_queue, concurrency=workers, assign=assign)
+    batcher.start()
+
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    print(f"Assign server on http://{host}:{port} ({workers} workers, batches of {max_batch}, {max_wait_ms} ms)")
+    if ready is not None:
+        ready.set()
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assign new reviews to clusters (HTTP)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--model", default=default_model)
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    parser.add_argument("--max-queue", type=int, default=1024)
+    args = parser.parse_args()
+
+    asyncio.run(serve(args.host, args.port, args.model, args.dedup, args.workers,
+                      args.max_batch, args.max_wait_ms, args.max_queue))
@@ -0,0 +1,153 @@
+# Load generator for the assign server
+
+"""
+
+Sends many POST /assign requests to the local assign server (assign_server.py) and reports
+throughput, latency percentiles and rejected requests (503). Only the standard library.
+
+    - concurrency: clients sending requests at the same time (one connection each, keep-alive)
+    - burst mode: the requests are sent in bursts of burst_size every burst_interval seconds,
+      to check the backpressure and the micro-batching under bursty load
+
+Run: python -m src.serving.load_generator --requests 2000 --concurrency 32
+
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import numpy as np
+
+
+# Example reviews used when no file is given
+example_reviews = [
+    ("Great product, works as expected and arrived on time", "Great"),
+    ("The battery died after two weeks, very disappointed with the quality", "Bad battery"),
+    ("Nice color but the size is smaller than the picture", "Smaller than expected"),
+    ("I bought this for my son and he loves it, would buy again", "Five stars"),
+    ("Cheap plastic, it broke the first day I used it", "Broke"),
+    ("Excellent sound quality for the price, the bass is really good", None),
+]
+
+
+async def post_json(reader, writer, host, path, data):
+
+    """
+    Sends one POST request with a JSON body on an open connection.
+    Returns (status, response data).
+
+    """
+    body = json.dumps(data).encode("utf-8")
+    request = (
+        f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode("latin-1") + body
+    writer.write(request)
+    await writer.drain()
+
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value.strip())
+
+    response = await reader.readexactly(length) if length > 0 else b"{}"
+    return status, json.loads(response)
+
+
+async def client(host, port, requests, reviews, latencies, statuses):
+
+    """
+    One client: opens a connection and takes requests from the shared queue until it is empty.
+
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            try:
+                scheduled = requests.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+
+            # In burst mode the request waits for its burst
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            review, summary = random.choice(reviews)
+            begin = time.monotonic()
+            status, _ = await post_json(reader, writer, host, "/assign", {"reviewText": review, "summary": summary})
+            latencies.append(1000 * (time.monotonic() - begin))
+            statuses.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(host="127.0.0.1", port=8080, n_requests=1000, concurrency=16,
+                   burst_size=None, burst_interval=1.0, reviews=None, seed=42):
+
+    """
+    Sends n_requests requests and returns a dictionary with the results.
+
+    burst_size: requests per burst (None: send as fast as possible)
+    burst_interval: seconds between bursts
+
+    """
+    random.seed(seed)
+    if reviews is None:
+        reviews = example_reviews
+
+    # Each request has the time it can be sent (bursts) or now
+    requests = asyncio.Queue()
+    start = time.monotonic()
+    for i in range(n_requests):
+        if burst_size is None:
+            requests.put_nowait(start)
+        else:
+            requests.put_nowait(start + (i // burst_size) * burst_interval)
+
+    latencies = []
+    statuses = []
+
+    begin = time.monotonic()
+    await asyncio.gather(*[client(host, port, requests, reviews, latencies, statuses) for _ in range(concurrency)])
+    seconds = time.monotonic() - begin
+
+    ok = [lat for lat, status in zip(latencies, statuses) if status == 200]
+    result = {
+        "requests": len(statuses),
+        "ok": len(ok),
+        "rejected_503": sum(1 for status in statuses if status == 503),
+        "errors": sum(1 for status in statuses if status not in (200, 503)),
+        "seconds": seconds,
+        "throughput_rps": len(ok) / max(seconds, 1e-9),
+    }
+    if len(ok) > 0:
+        result["p50_ms"] = float(np.percentile(ok, 50))
+        result["p99_ms"] = float(np.percentile(ok, 99))
+        result["max_ms"] = float(np.max(ok))
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the assign server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--burst-size", type=int, default=None)
+    parser.add_argument("--burst-interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(args.host, args.port, args.requests, args.concurrency,
+                                  args.burst_size, args.burst_interval))
+    print(json.dumps(result, indent=2))
@@ -6,6 +6,36 @@ This module is used to clean of the text to prepare it for the embedding model.
 
 """
 import re  # for regex
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Patterns are compiled once when the module is imported, not on every call
+
+# "\S matches any character that is not a whitespace" and 
+# + "match 1 or more repetitions of the preceding RE" (re documentation)
+url_pattern = r"http\S+ | www\.\S+"
+url_regex = re.compile(url_pattern)
+
+punct_pattern = r"[!?.,;:]+"
+punct_regex = re.compile(punct_pattern)
+
+# Emoji ranges, also used by the columnar version (clean_column)
+emoji_ranges = [
+    (0x1F650, 0x1F67F),  # Ornamental Dingbats 
+    (0x1F600, 0x1F64F),  # Emoticons
+    (0x1F300, 0x1F5FF),  # Miscellaneous Symbols and Pictographs
+    (0x1F900, 0x1F9FF),  # Supplemental Symbols and Pictographs
+    (0x1FA70, 0x1FAFF),  # Symbols and Pictographs Extended-A
+    (0x1F680, 0x1F6FF),  # Transport and Map Symbols
+    (0x1F1E0, 0x1F1FF),  # Flags 
+    (0x2700, 0x27BF),    # Other symbols
+]
+
+# compile: turn the codes to regular expression objects
+emoji_regex = re.compile(
+    "[" + "".join(f"{chr(start)}-{chr(end)}" for start, end in emoji_ranges) + "]+",
+    flags=re.UNICODE
+)
 
 # Remove URLS
 
@@ -15,12 +45,8 @@ def remove_urls(text):
     Removes URLs like http://..., https://..., www....
 
     """
-    # "\S matches any character that is not a whitespace" and 
-    # + "match 1 or more repetitions of the preceding RE" (re documentation)
-    url_pattern = r"http\S+ | www\.\S+"
-
     # Re.sub (pattern, replacement, string)
-    return re.sub(url_pattern, "", text)  # replace URLs with empty string
+    return url_regex.sub("", text)  # replace URLs with empty string
 
 
 # Remove punctuation
@@ -31,14 +57,11 @@ def remove_punctuation(text):
     Removes common punctuation like ! ? , . ; : but keeps normal words intact
 
     """
-    punct = r"[!?.,;:]+"
-    text = re.sub(punct, " ", text)  # Replace punctuation with a space to avoid word merging
+    text = punct_regex.sub(" ", text)  # Replace punctuation with a space to avoid word merging
     return text
 
 # Remove emojis
 
-import re
-
 def remove_emojis(text):
 
     """
@@ -46,22 +69,7 @@ def remove_emojis(text):
     Removes emojis from a text string
 
     """
-    # compile: turn the codes to regular expression objects
-    
-    emojis = re.compile(
-        "["                       
-        u"\U0001F650-\U0001F67F"  # Ornamental Dingbats 
-        u"\U0001F600-\U0001F64F"  # Emoticons
-        u"\U0001F300-\U0001F5FF"  # Miscellaneous Symbols and Pictographs
-        u"\U0001F900-\U0001F9FF"  # Supplemental Symbols and Pictographs
-        u"\U0001FA70-\U0001FAFF"  # Symbols and Pictographs Extended-A
-        u"\U0001F680-\U0001F6FF"  # Transport and Map Symbols
-        u"\U0001F1E0-\U0001F1FF"  # Flags 
-        u"\u2700-\u27BF"          # Other symbols
-        "]+",
-        flags=re.UNICODE
-    )
-    return emojis.sub("", text)
+    return emoji_regex.sub("", text)
 
 
 def clean(text):
@@ -103,9 +111,117 @@ def clean_group(text_group): #Use this to clean in batches so when called in the
     Output: cleaned list.
 
     """
-    cleaned_texts = []  # store the results
+    # Values that are not text are changed to null so clean_column returns "" (same as clean)
+    try:
+        texts = pa.array([text if isinstance(text, str) else None for text in text_group], type=pa.string())
+    except (UnicodeEncodeError, pa.ArrowException):
+        # Broken text (for example half of an emoji) can't be converted to Arrow, clean row by row
+        return [clean(text) for text in text_group]
+
+    return clean_column(texts).to_pylist()
+
+
+# Columnar cleaning - same steps as clean() but with Arrow string kernels for the whole column
+
+# Python's \s (and str.split()) uses the unicode whitespace, Arrow's regex engine (RE2) \s is just ASCII,
+# so the characters are written explicitly to get the same result as clean()
+whitespace_chars = (
+    "\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0\u1680"
+    "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+whitespace_class = "".join(f"\\x{{{ord(c):x}}}" for c in whitespace_chars)
+
+# Same patterns as remove_urls, remove_punctuation and remove_emojis written for RE2
+url_pattern_arrow = f"http[^{whitespace_class}]+ | www\\.[^{whitespace_class}]+"
+emoji_pattern_arrow = "[" + "".join(f"\\x{{{start:x}}}-\\x{{{end:x}}}" for start, end in emoji_ranges) + "]+"
+whitespace_pattern_arrow = f"[{whitespace_class}]+"
+
+# Characters where Arrow's lowercase is different from python's lower() (computed on first use)
+lower_fallback_pattern = None
+
+
+def get_lower_fallback_pattern():
+
+    """
+    Arrow lowercases character by character and python's lower() has a few special cases
+    (for example "İ" returns two characters and a final "Σ" returns "ς"). The unicode version
+    can also be different. This function finds those characters once, so the rows that have
+    them are cleaned with clean() and the output is exactly the same.
+
+    """
+    global lower_fallback_pattern
+
+    if lower_fallback_pattern is None:
+
+        # All the characters that can have lower case (CJK, Hangul and private use have no case)
+        codes = [c for c in range(0x41, 0x1F000) if not (0x3400 <= c < 0xA000 or 0xAC00 <= c < 0xF900)]
+
+        # One string separated by \x00 so Arrow and python lowercase everything in one call
+        text = "\x00".join(map(chr, codes))
+        arrow_lower = pc.utf8_lower(pa.array([text]))[0].as_py().split("\x00")
+        python_lower = text.lower().split("\x00")
+
+        different = [c for c, a, p in zip(codes, arrow_lower, python_lower) if a != p]
+
+        # Sigma depends on the position in the word (final sigma) so it is always checked with python
+        different.append(0x03A3)
+
+        lower_fallback_pattern = "[" + "".join(f"\\x{{{c:x}}}" for c in sorted(set(different))) + "]"
+
+    return lower_fallback_pattern
+
+
+def clean_column(column):
+
+    """
+    Columnar version of clean() for a whole column. 
+    Input: Arrow array / chunked array or Polars series of strings.
+    Output: cleaned column (Arrow array, or Polars series if the input is Polars).
 
-    for text in text_group:
-        cleaned_texts.append(clean(text)) 
+    The output is the same as applying clean() to each row:
+    - remove URLs
+    - remove punctuation
+    - remove emojis
+    - convert to lowercase
+    - remove extra spaces
+    - null values return ""
+
+    """
+    # Polars series are converted to Arrow without copying and converted back at the end
+    is_polars = type(column).__module__.startswith("polars")
+    if is_polars:
+        name = column.name
+        column = column.to_arrow()
+
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+
+    # Arrow kernels work with string and large_string, other types (string_view, null) are cast
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        column = column.cast(pa.large_string() if pa.types.is_string_view(column.type) else pa.string())
+
+    # Null returns empty string to avoid problems with the model (same as clean)
+    original = column.fill_null("")
+
+    # Same order as clean(): URLs, punctuation, emojis, lower case and spaces
+    text = pc.replace_substring_regex(original, pattern=url_pattern_arrow, replacement="")
+    text = pc.replace_substring_regex(text, pattern=punct_pattern, replacement=" ")
+    text = pc.replace_substring_regex(text, pattern=emoji_pattern_arrow, replacement="")
+    text = pc.utf8_lower(text)
+
+    # Leave just a normal space between words (like split and join)
+    text = pc.replace_substring_regex(text, pattern=whitespace_pattern_arrow, replacement=" ")
+    text = pc.utf8_trim(text, characters=" ")
+
+    # Rows with special lowercase characters (very few) are cleaned with python 
+    fallback = pc.match_substring_regex(original, pattern=get_lower_fallback_pattern())
+    if pc.any(fallback).as_py():
+        rows = pc.filter(original, fallback).to_pylist()
+        text = pc.replace_with_mask(text, fallback, pa.array([clean(r) for r in rows], type=text.type))
+
+    if is_polars:
+        import polars as pl
+        return pl.Series(name, text)
 
-    return cleaned_texts
+    return text
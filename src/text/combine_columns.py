@@ -1,5 +1,9 @@
 # Function to join summary and review
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
 
 def join_summary_review(summary, reviewText):
 
@@ -33,4 +37,49 @@ def join_summary_review(summary, reviewText):
         else: # If only review has text 
             combined.append(r)
 
-    return combined
\ No newline at end of file
+    return combined
+
+
+def join_summary_review_column(summary, reviewText):
+
+    """
+
+    Columnar version of join_summary_review for Arrow arrays or Polars series.
+    Same rules: "summary review" when both have text, only the one with text
+    otherwise and "" when both are empty (null is treated as empty).
+
+    Output: Arrow array (or Polars series if the inputs are Polars)
+
+    """
+    # Polars series are converted to Arrow and back at the end
+    is_polars = type(summary).__module__.startswith("polars")
+    if is_polars:
+        summary = summary.to_arrow()
+        reviewText = reviewText.to_arrow()
+
+    columns = []
+    for col in (summary, reviewText):
+        if isinstance(col, pa.ChunkedArray):
+            col = col.combine_chunks()
+        # string_view and null columns are cast so both columns have a type the kernels accept
+        if not (pa.types.is_string(col.type) or pa.types.is_large_string(col.type)):
+            col = col.cast(pa.large_string() if pa.types.is_string_view(col.type) else pa.string())
+        columns.append(col.fill_null(""))
+
+    s, r = columns
+    if s.type != r.type:
+        s = s.cast(pa.large_string())
+        r = r.cast(pa.large_string())
+
+    has_summary = pc.not_equal(s, "")
+    has_review = pc.not_equal(r, "")
+
+    # If both have text join them with a space, otherwise keep the one with text (or "")
+    both = pc.binary_join_element_wise(s, r, pa.scalar(" ", type=s.type))
+    combined = pc.if_else(pc.and_(has_summary, has_review), both, pc.if_else(has_summary, s, r))
+
+    if is_polars:
+        import polars as pl
+        return pl.Series("combined", combined)
+
+    return combined
@@ -4,14 +4,34 @@
 
 This module is designed to detect language anf filter only english reviews 
 
+The fasttext model is loaded the first time it is used (load_model), not when the module
+is imported, so importing the pipeline modules is fast. The pool stages load it before the
+workers start (see pipeline/worker_init.py).
+
 """
 
+from pathlib import Path
+
 # from langdetect import detect, LangDetectException Not used - too slow
 # Library changed to fasttext to optimize time
-import fasttext
 
-# Load fasttext model
-ft_model = fasttext.load_model("models/lid.176.ftz")
+# fasttext model (None until load_model is called)
+model_path = Path("models/lid.176.ftz")
+ft_model = None
+
+
+def load_model():
+
+    """
+    Loads the fasttext model once per process and returns it.
+
+    """
+    global ft_model
+    if ft_model is None:
+        import fasttext
+        ft_model = fasttext.load_model(str(model_path))
+    return ft_model
+
 
 def detect_lan(text):
 
@@ -34,7 +54,7 @@ def detect_lan(text):
 
     # Detect language
     try:
-        prediction = ft_model.predict(text) #output ((__label__en),array[value])
+        prediction = load_model().predict(text) #output ((__label__en),array[value])
         lan = prediction[0][0].replace("__label__", "")
         confidence = prediction[1][0] 
 
@@ -55,4 +75,82 @@ def is_english(text):
 
     """
     # Returns true if the language is english
-    return detect_lan(text) == "en"
\ No newline at end of file
+    return detect_lan(text) == "en"
+
+
+# Batch version - one call to fasttext for the whole list instead of one per review
+
+def detect_lan_batch(texts, max_chars=None):
+
+    """
+
+    Same rules as detect_lan but for a list (or Arrow string array) of texts:
+    - empty, null or less than 2 words returns unknown
+    - confidence under 0.8 returns unknown
+
+    All the valid texts are sent to ft_model.predict in just one call.
+    max_chars: optional, only the first max_chars characters of each text are scored
+
+    Output: list with the language of each text
+
+    """
+
+    # Arrow arrays are converted to a python list just once
+    if hasattr(texts, "to_pylist"):
+        texts = texts.to_pylist()
+
+    # Everything starts as unknown and only the texts sent to the model can change
+    languages = ["unknown"] * len(texts)
+
+    # Texts that will be sent to the model and their position in the original list
+    to_predict = []
+    positions = []
+
+    for i, text in enumerate(texts):
+
+        # Empty or null texts (or not strings) stay unknown
+        if not text or not isinstance(text, str):
+            continue
+
+        text = text.strip()
+
+        # To identify the actual language 2 words (at least) are needed
+        # split with maxsplit=1 is enough to know if there are 2 words without splitting all the text
+        if len(text.split(None, 1)) < 2:
+            continue
+
+        # fasttext predicts one line at a time, detect_lan returns unknown for these texts
+        if "\n" in text:
+            continue
+
+        # Only score the beginning of the text if a limit is given
+        if max_chars is not None:
+            text = text[:max_chars]
+
+        to_predict.append(text)
+        positions.append(i)
+
+    if len(to_predict) == 0:
+        return languages
+
+    # Detect language for all the texts at once - output ([[__label__en], ...], [array[value], ...])
+    labels, confidences = load_model().predict(to_predict)
+
+    for i, label, confidence in zip(positions, labels, confidences):
+
+        # Only use english reviews over 0.8 precission to make sure the filter works properly
+        if len(label) > 0 and confidence[0] >= 0.8:
+            languages[i] = label[0].replace("__label__", "")
+
+    return languages
+
+
+def is_english_batch(texts, max_chars=None):
+
+    """
+
+    Filter english reviews for a list (or Arrow string array) of texts.
+    Returns a list of booleans (mask) that can be used to filter the chunk in one step.
+
+    """
+    return [lan == "en" for lan in detect_lan_batch(texts, max_chars=max_chars)]
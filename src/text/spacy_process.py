@@ -1,6 +1,5 @@
 # Spacy text processing module
 
-import spacy
 import re
 
 # ner = named entity recognition, parser = dependency labels, textcat = document labels, tok2vec = assign token to vectors
@@ -8,11 +7,109 @@ import re
 # Loading the model is taking a lot of time 
 #nlp = spacy.load("en_core_web_sm", disable=["ner", "parser", "textcat", "tok2vec", "morphologizer"]) 
 
-# Spacy blank creates a pipeline without any model loaded, so it is faster
-nlp = spacy.blank("en")  
-# just add lemmatizer
-nlp.add_pipe("lemmatizer", config={"mode": "rule"})
-nlp.initialize()
+# The pipeline is built the first time it is used (load_nlp), not when the module is imported:
+# importing spacy and initializing the lemmatizer takes about a second. The pool stages
+# build it before the workers start (see pipeline/worker_init.py).
+nlp = None
+lemmatizer = None
+
+
+def load_nlp():
+
+    """
+    Builds the spacy pipeline once per process and returns it.
+
+    """
+    global nlp, lemmatizer
+    if nlp is None:
+        import spacy
+
+        # Spacy blank creates a pipeline without any model loaded, so it is faster
+        pipeline = spacy.blank("en")
+        # just add lemmatizer
+        pipeline.add_pipe("lemmatizer", config={"mode": "rule"})
+        pipeline.initialize()
+
+        lemmatizer = pipeline.get_pipe("lemmatizer")
+        nlp = pipeline
+    return nlp
+
+
+# Lemma cache 
+# Review vocabulary repeats a lot, so the decision for each token text is saved the first time
+# and reused: (lemma, is_stop, drop). With the blank pipeline there is no POS tagger, so the
+# lemma depends only on the token text and the cache gives the same result as the lemmatizer.
+# The texts are already in lowercase (clean_text.py), so the key is the token text.
+
+lemma_cache = {} # token text: (lemma, is_stop, drop)
+lemma_cache_max = 500000 # Maximum number of entries, when full new tokens are not saved
+cache_stats = {"hits": 0, "misses": 0}
+
+# Stopwords to keep
+stopwords_keep = ["no", "not", "never"]
+
+
+def token_decision(token):
+
+    """
+    Returns (lemma, is_stop, drop) for a token, from the cache if the text was already seen.
+
+    - Tokens with n't return "not" (the negation is kept)
+    - Stopwords are dropped except no, not, never
+
+    """
+    text = token.text
+    decision = lemma_cache.get(text)
+
+    if decision is not None:
+        cache_stats["hits"] += 1
+        return decision
+
+    cache_stats["misses"] += 1
+
+     # When processing texts like don't, the negation is not recognized so there is a validation needed
+    if "n't" in text: #token.text returns the original word  
+        decision = ("not", token.is_stop, False)
+    else:
+        # If not a n't or a symbol, lematize (same as the lemmatizer component does)
+        if token.lemma != 0:
+            lemma = token.lemma_
+        else:
+            lemma = lemmatizer.lemmatize(token)[0]
+
+        # Verify stopwords, check if it is in the list of stopwords to keep
+        drop = token.is_stop and lemma not in stopwords_keep
+        decision = (lemma, token.is_stop, drop)
+
+    # The cache has a limit so the memory doesn't grow with rare tokens
+    if len(lemma_cache) < lemma_cache_max:
+        lemma_cache[text] = decision
+
+    return decision
+
+
+def lemma_cache_info():
+
+    """
+    Returns the cache statistics: hits, misses, hit rate and size.
+
+    """
+    total = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = cache_stats["hits"] / total if total > 0 else 0.0
+    return {"hits": cache_stats["hits"], "misses": cache_stats["misses"], "hit_rate": hit_rate,
+            "size": len(lemma_cache), "max_size": lemma_cache_max}
+
+
+def clear_lemma_cache():
+
+    """
+    Empties the cache and the statistics.
+
+    """
+    lemma_cache.clear()
+    cache_stats["hits"] = 0
+    cache_stats["misses"] = 0
+
 
 def spacy_processing(text_list):
 
@@ -24,6 +121,9 @@ def spacy_processing(text_list):
     - keeping negations: no, not, never
     - removal of symbols -, ().
 
+    Only the tokenizer runs for every text, the lemma and stopword decision
+    of each token comes from the cache (token_decision).
+
     Returns: a list where each element is a cleaned string ready for embeddings.
     
     """
@@ -31,35 +131,24 @@ def spacy_processing(text_list):
     # List to save results - each element will be one row of summary + review processed
     outputs = []
 
-    # Stopwords to keep
-    stopwords_keep = ["no", "not", "never"]
-
     # Save the cleaning regex
     clean_regex = re.compile(r"[^\w\s]+")
 
  
 
-    # Process rows
-    for doc in nlp.pipe(text_list, batch_size=5000):
+    # Process rows (just the tokenizer, the lemmatizer is used only for tokens not in the cache)
+    for doc in load_nlp().tokenizer.pipe(text_list, batch_size=5000):
 
         # List to save tokens of this row
         row_tokens = []  
 
         for token in doc: #Doc is the result of processing a text
 
-             # When processing texts like don't, the negation is not recognized so there is a validation needed
-            if "n't" in token.text: #token.text returns the original word  
-                row_tokens.append("not")  # add the negation 
-                continue  # ignore the rest of processing for this token because the negation is already added
-
-            # If not a n't or a symbol, lematize
-            lemma = token.lemma_  # lemma_ returns string
+            lemma, is_stop, drop = token_decision(token)
 
-            # Verify stopwords
-            if token.is_stop == True:  
-                # Check if it is in the list of stopwords to keep
-                if lemma not in stopwords_keep:
-                    continue  # skip token so it does not get added to the list
+            # skip token so it does not get added to the list
+            if drop:
+                continue
 
             # Add lemma to the row list
             row_tokens.append(lemma)
@@ -0,0 +1,112 @@
+# Tests of the assign server
+
+"""
+
+The server runs with threads and a stub instead of the assignment index (no model is loaded),
+and the load generator sends the requests: the reviews are grouped in micro-batches and
+the requests over max_queue get 503. Malformed requests get 400 (413 if the body is too big).
+
+Run: python -m pytest -q tests
+
+"""
+
+import time
+import socket
+import asyncio
+import threading
+
+from src.serving.assign_server import serve
+from src.serving.load_generator import run_load
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_stub(seconds):
+
+    """
+    Assign function that waits like a model and saves the size of every batch.
+
+    """
+    sizes = []
+    lock = threading.Lock()
+
+    def assign(reviews, summaries):
+        time.sleep(seconds)
+        with lock:
+            sizes.append(len(reviews))
+        return [{"cluster": 0, "distance": 0.0, "novel": False, "english": True} for _ in reviews]
+
+    return assign, sizes
+
+
+async def load_test(assign, n_requests, concurrency, **settings):
+    port = free_port()
+    ready = asyncio.Event()
+    server = asyncio.create_task(serve(port=port, use_threads=True, ready=ready, assign=assign, **settings))
+    await asyncio.wait_for(ready.wait(), 10)
+
+    try:
+        return await run_load(port=port, n_requests=n_requests, concurrency=concurrency)
+    finally:
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+
+def test_micro_batches():
+    assign, sizes = make_stub(0.01)
+    result = asyncio.run(load_test(assign, 640, 64, max_batch=32, max_wait_ms=20, max_queue=1024))
+
+    assert result["ok"] == 640
+    assert result["errors"] == 0 and result["rejected_503"] == 0
+
+    # Without the warm up call, the 64 clients fill batches of many reviews, never more than max_batch
+    batches = sizes[1:]
+    assert max(batches) <= 32
+    assert sum(batches) / len(batches) >= 8
+
+
+def test_backpressure_503():
+    assign, sizes = make_stub(0.05)
+    result = asyncio.run(load_test(assign, 200, 50, max_batch=4, max_wait_ms=1, max_queue=8))
+
+    assert result["rejected_503"] > 0
+    assert result["errors"] == 0
+    assert result["ok"] + result["rejected_503"] == 200
+
+
+async def raw_request(data, **settings):
+
+    """
+    Sends raw bytes to a server with the stub and returns the status of the answer (None if empty).
+
+    """
+    assign, _ = make_stub(0)
+    port = free_port()
+    ready = asyncio.Event()
+    server = asyncio.create_task(serve(port=port, use_threads=True, ready=ready, assign=assign, **settings))
+    await asyncio.wait_for(ready.wait(), 10)
+
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), 10)
+        writer.close()
+        return int(status_line.split()[1]) if status_line else None
+    finally:
+        server.cancel()
+        await asyncio.gather(server, return_exceptions=True)
+
+
+def test_malformed_requests_get_400():
+    assert asyncio.run(raw_request(b"GARBAGE\r\n\r\n")) == 400
+    assert asyncio.run(raw_request(b"POST /assign HTTP/1.1\r\nContent-Length: abc\r\n\r\n")) == 400
+    assert asyncio.run(raw_request(b"POST /assign HTTP/1.1\r\nContent-Length: 10000000\r\n\r\n")) == 413
+
+    body = b'{"reviewText": "good"}'
+    request = b"POST /assign HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    assert asyncio.run(raw_request(request)) == 200
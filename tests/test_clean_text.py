@@ -0,0 +1,39 @@
+# Tests of the text cleaning
+
+"""
+
+clean_column (vectorized, used by the pipeline) must give the same text as clean (one review)
+for every input. The expected outputs are saved in data/clean_text_golden.json: None, empty,
+emojis, urls, contractions, accents and special lowercase characters.
+
+Run: python -m pytest -q tests
+
+"""
+
+import json
+from pathlib import Path
+
+import pyarrow as pa
+
+from src.text.clean_text import clean, clean_column
+
+
+golden_file = Path(__file__).resolve().parent / "data" / "clean_text_golden.json"
+
+
+def load_golden():
+    with open(golden_file, encoding="utf-8") as f:
+        golden = json.load(f)
+    return [g["input"] for g in golden], [g["expected"] for g in golden]
+
+
+def test_clean_matches_golden():
+    inputs, expected = load_golden()
+    assert [clean(t) for t in inputs] == expected
+
+
+def test_clean_column_matches_clean():
+    inputs, expected = load_golden()
+    column = clean_column(pa.array(inputs, type=pa.string())).to_pylist()
+    assert column == [clean(t) for t in inputs]
+    assert column == expected
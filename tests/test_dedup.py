@@ -0,0 +1,80 @@
+# Tests of the duplicate detection
+
+"""
+
+Identical and near-identical texts must share a text_id, and texts that only share a few
+common phrases ("works great", "not worth money") must never be merged.
+
+Run: python -m pytest -q tests
+
+"""
+
+import random
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.pipeline import dedup
+
+
+phrases = ["works great", "not worth money", "arrived time", "stars", "case", "better", "looking headphones",
+           "battery life short", "love color", "sound quality good", "broke after week", "easy install",
+           "would buy again", "fits perfectly", "cheap plastic", "fast shipping", "returned it", "great price"]
+
+long_text = ("bought this blender for my kitchen and it crushes ice in seconds the motor is strong and quiet "
+             "the jar is easy to clean and the lid closes tight so nothing leaks when it runs at full speed "
+             "after three months of daily smoothies it still works like the first day")
+
+
+def run_dedup(tmp_path, monkeypatch, texts):
+    monkeypatch.setattr(dedup, "input_dir", tmp_path / "spacy")
+    monkeypatch.setattr(dedup, "output_dir", tmp_path / "dedup")
+    dedup.input_dir.mkdir()
+
+    pq.write_table(pa.table({
+        "asin": [f"A{i}" for i in range(len(texts))],
+        "source": ["Test"] * len(texts),
+        "overall": [5.0] * len(texts),
+        "clean_embedding_text": texts,
+    }), dedup.input_dir / "Test_spacy.parquet")
+
+    dedup.dedup(n_buckets=4, batch_size=1000)
+    return pq.read_table(dedup.output_dir / "row_map.parquet")["text_id"].to_pylist()
+
+
+def bigrams(text):
+    words = text.split()
+    return set(zip(words, words[1:]))
+
+
+def jaccard(a, b):
+    a, b = bigrams(a), bigrams(b)
+    return len(a & b) / max(len(a | b), 1)
+
+
+def test_near_duplicates_share_text_id(tmp_path, monkeypatch):
+    rng = random.Random(0)
+    short_reviews = [" ".join(rng.sample(phrases, rng.randint(3, 6))) for _ in range(2000)]
+
+    near = long_text.replace("first day", "first week")
+    texts = [long_text, long_text, near] + short_reviews
+    text_ids = run_dedup(tmp_path, monkeypatch, texts)
+
+    # Identical and near-identical texts share the text_id of the first one
+    assert text_ids[0] == 0
+    assert text_ids[1] == 0
+    assert text_ids[2] == 0
+
+    # Rows merged with another text are always similar to it (never chained through other rows)
+    for row, text_id in enumerate(text_ids):
+        if text_id != row and texts[row] != texts[text_id]:
+            assert jaccard(texts[row], texts[text_id]) >= 0.5
+
+
+def test_dissimilar_texts_never_merged(tmp_path, monkeypatch):
+    texts = ["stars arrived time case works great not worth money better",
+             "looking headphones works great not worth money",
+             long_text]
+    text_ids = run_dedup(tmp_path, monkeypatch, texts)
+
+    assert text_ids == [0, 1, 2]